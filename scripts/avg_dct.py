@@ -7,9 +7,13 @@ __date__ = "07/06/23"
 import argparse
 import os
 import logging
+from functools import partial
 import numpy as np
 from util import Transform
-from avg_embed import get_seqs, cons_pos, get_embed
+from dct_db import build_db, load_transforms
+from fam_pool import map_fams, save_part
+from avg_embed import get_seqs
+from cons_embed import cons_pos, load_embed, cons_avg
 
 log_filename = 'data/logs/avg_dct.log'  #pylint: disable=C0103
 os.makedirs(os.path.dirname(log_filename), exist_ok=True)
@@ -23,92 +27,139 @@ def transform_avg(
     iDCT vector of the averaged embedding as a numpy array.
 
     :param fam: Pfam family
-    :param positions: dict where seq id is key with list of positions as value
-    :param embeddings: dict where seq is key with list of embeddings as value
+    :param positions: dict where seq id is key with tuple of columns and rows as value
+    :param embeddings: dict where seq id is key with embedding as value
     :param args: argparse.Namespace object with dct dimensions
     :return: numpy array of iDCT vector
     """
 
-    # Create a dict of lists where each list contains the embeddings for a position in the consensus
-    seq_embed = {}
-    for seqid, position in positions.items():  # Go through positions for each sequence
-        for pos in position:
-            if pos not in seq_embed:  # Initialize key and value
-                seq_embed[pos] = []
-            seq_embed[pos].append(embeddings[seqid][pos])  # Add embedding to list for that pos
-
-    # Sort dictionary by key (out of order for some reason)
-    seq_embed = dict(sorted(seq_embed.items()))
-
-    # Move through each position (list of embeddings) and average them
-    avg_embed = []
-    for pos, embed in seq_embed.items():
-        avg_embed.append(np.mean(embed, axis=0))  # Find mean for each position (float)
+    avg_embed = cons_avg(positions, embeddings)
 
     # Perform idct on avg_embed
-    avg_embed = Transform(fam, np.array(avg_embed), None)
+    avg_embed = Transform(fam, avg_embed, None)
     avg_embed.quant_2D(args.s1, args.s2)
 
     return avg_embed
 
 
+def avg_fam(fam: str, args: argparse.Namespace) -> str:
+    """Saves the DCT of the average embedding for a Pfam family as a partial result, unless it
+    was saved by an earlier run.
+
+    :param fam: Pfam family
+    :param args: argparse.Namespace object with directory of embeddings and dct dimensions
+    :return: path to partial result
+    """
+
+    part = f'{part_dir(args, "avg")}/{fam}.npy'
+    if os.path.exists(part):
+        return part
+
+    # Get sequences and their consensus positions
+    sequences = get_seqs(fam)
+    positions = cons_pos(sequences)
+
+    # Get embeddings for each sequence in family and average them
+    embed_direc = f'{args.d}/{fam}'
+    embeddings = load_embed(embed_direc)
+
+    # Transform average embedding and save it
+    avg_dct = transform_avg(fam, positions, embeddings, args)
+    save_part(part, avg_dct.trans)
+
+    return part
+
+
 def get_avgs(args: argparse.Namespace):
     """ Saves the DCT of the average embedding for each Pfam family to the same file.
 
     :param args: argparse.Namespace object with directory of embeddings and dct dimensions
     """
 
+    os.makedirs(part_dir(args, 'avg'), exist_ok=True)
+    fams = sorted(os.listdir(args.d))
+    for i, (fam, _) in enumerate(map_fams(partial(avg_fam, args=args), fams, args.p)):
+        logging.info('Averaged embeddings for %s, %s', fam, i)
+
+    # Merge partial results in family order
     dcts = []
-    for i, fam in enumerate(os.listdir(args.d)):
-        logging.info('Averaging embeddings for %s, %s', fam, i)
+    for fam in fams:
+        avg_dct = np.load(f'{part_dir(args, "avg")}/{fam}.npy', allow_pickle=True)
+        if avg_dct[1] is not None:
+            dcts.append(avg_dct)
 
-        # Get sequences and their consensus positions
-        sequences = get_seqs(fam)
-        positions = cons_pos(sequences)
+    # Save all dcts to file
+    np.save(f'{part_dir(args, "avg")}.npy', dcts)
 
-        # Get embeddings for each sequence in family and average them
-        embed_direc = f'{args.d}/{fam}'
-        embeddings = get_embed(embed_direc, sequences)
 
-        # Transform average embedding and store in list
-        avg_dct = transform_avg(fam, positions, embeddings, args)
-        if avg_dct.trans[1] is not None:
-            dcts.append(avg_dct.trans)
+def sum_fam(fam: str, args: argparse.Namespace) -> str:
+    """Saves the sum, sum of squares, and number of a Pfam family's transforms as a partial
+    result, unless it was saved by an earlier run.
 
-    # Save all dcts to file
-    enclay = '_'.join(args.d.split('/')[-1].split('_')[:2])  # enc/layer used to embed
-    np.save(f'data/{enclay}_{args.s1}{args.s2}_avg.npy', dcts)
+    :param fam: Pfam family
+    :param args: argparse.Namespace object with name of transform directory
+    :return: path to partial result
+    """
+
+    part = f'{part_dir(args, "sums")}/{fam}.npz'
+    if os.path.exists(part):
+        return part
+
+    ids, dcts = load_transforms(f'{args.d}/{fam}/transform.npy')
+    save_part(part, {'sum': dcts.sum(axis=0), 'sumsq': (dcts * dcts).sum(axis=0),
+                     'count': np.int64(len(ids)), 'members': np.array(ids, dtype=object),
+                     'read': np.int64(len(ids)), 'done': True})
+
+    return part
 
 
 def avg_transforms(args: argparse.Namespace):
-    """Saves the average DCT of a Pfam family's transforms to file.
+    """Saves the average DCT of a Pfam family's transforms to file. The sum and count of each
+    family's transforms are kept in a DCT database so families can be updated later without
+    averaging every family again (see dct_db.py).
 
     :param args: argparse.Namespace object with name of transform directory
     """
 
-    dcts = []
-    for i, fam in enumerate(os.listdir(args.d)):
-        logging.info('Averaging transformations for %s, %s', fam, i)
+    os.makedirs(part_dir(args, 'sums'), exist_ok=True)
+    fams = sorted(os.listdir(args.d))
+    for i, (fam, _) in enumerate(map_fams(partial(sum_fam, args=args), fams, args.p)):
+        logging.info('Summed transformations for %s, %s', fam, i)
 
-        # Load transforms for the family as a numpy array
-        transforms = np.load(f'{args.d}/{fam}/transform.npy', allow_pickle=True)
-
-        # Average the transforms
-        avg_dct = np.mean([trans[1] for trans in transforms], axis=0, dtype=int)
-        avg_dct = Transform(fam, None, avg_dct)
-        dcts.append(avg_dct.trans)
+    # Merge partial results into database
+    db = build_db(part_dir(args, 'db'), part_dir(args, 'sums'), args.s1 * args.s2)
 
     # Save avg transform to file
+    np.save(f'{part_dir(args, "avg")}.npy', db.to_array())
+
+
+def part_dir(args: argparse.Namespace, kind: str) -> str:
+    """Returns the name of the directory for partial results (or the database file without its
+    extension), named after the encoder/layer used to embed and the dct dimensions.
+
+    :param args: argparse.Namespace object with directory of embeddings and dct dimensions
+    :param kind: avg, sums, or db
+    :return: path without extension
+    """
+
     enclay = '_'.join(args.d.split('/')[-1].split('_')[:2])  # enc/layer used to embed
-    np.save(f'data/{enclay}_{args.s1}{args.s2}_avg.npy', dcts)
+    return f'data/{enclay}_{args.s1}{args.s2}_{kind}'
 
 
 def main():
-    """Main 
+    """Main averages the embeddings (if -d is a directory of embeddings) or transforms (if -d is
+    a directory of transforms) of each Pfam family and saves the average DCTs to file.
+
+    args:
+        -d: directory of embeddings or transforms
+        -p: number of processes
+        -s1: first dimension of dct
+        -s2: second dimension of dct
     """
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', type=str, default='data/esm2_17_embed')
+    parser.add_argument('-p', type=int, default=1)
     parser.add_argument('-s1', type=int, default=6)
     parser.add_argument('-s2', type=int, default=50)
     args = parser.parse_args()
@@ -0,0 +1,330 @@
+"""This script benchmarks the search and transform functions with synthetic data, so their speed
+can be measured without Pfam or an encoder. Databases and embeddings are generated at a chosen
+scale with sequence lengths drawn from a distribution similar to Pfam domains, each function is
+timed with warmup and repeated trials, and the results are written to a JSON file that can be
+compared to the results of another version.
+
+__author__ = "Ben Iovino"
+__date__ = "09/20/23"
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from cons_embed import cons_avg
+from util import Embedding, Transform
+
+
+def seq_lengths(num: int, rng: np.random.Generator, median: int, sigma: float) -> np.ndarray:
+    """Returns sequence lengths drawn from a log-normal distribution, which is close to the
+    distribution of Pfam domain lengths.
+
+    :param num: number of lengths
+    :param rng: random number generator
+    :param median: median length
+    :param sigma: standard deviation of log length
+    :return: array of lengths
+    """
+
+    lengths = rng.lognormal(np.log(median), sigma, num)
+    return np.clip(lengths, 10, 2000).astype(int)
+
+
+def synth_embed(length: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    """Returns a random embedding with start and end tokens, like an ESM2 embedding.
+
+    :param length: sequence length
+    :param dim: embedding dimension
+    :param rng: random number generator
+    :return: embedding (length+2 x dim)
+    """
+
+    return rng.standard_normal((length+2, dim), dtype=np.float32)
+
+
+def synth_dct_db(fams: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    """Returns a database of random DCT vectors in the same format as avg_dct.py.
+
+    :param fams: number of families
+    :param dim: length of DCT vectors
+    :param rng: random number generator
+    :return: array of family names and DCT vectors
+    """
+
+    db = np.empty((fams, 2), dtype=object)
+    for i in range(fams):
+        db[i] = [f'fam{i}', rng.integers(0, 128, dim, dtype=np.int8)]
+
+    return db
+
+
+def synth_anchor_db(fams: int, anchors: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    """Returns a database of random anchor embeddings in the same format as get_anchors.py.
+
+    :param fams: number of families
+    :param anchors: number of anchors per family
+    :param dim: embedding dimension
+    :param rng: random number generator
+    :return: array of family names and anchor embeddings
+    """
+
+    db = np.empty((fams, 2), dtype=object)
+    for i in range(fams):
+        db[i] = [f'fam{i}', rng.standard_normal((anchors, dim), dtype=np.float32)]
+
+    return db
+
+
+def synth_family(seqs: int, length: int, dim: int, rng: np.random.Generator) -> tuple:
+    """Returns index maps and embeddings for a random family, in the same format as
+    cons_embed.cons_pos() and cons_embed.load_embed().
+
+    :param seqs: number of sequences in family
+    :param length: number of consensus columns
+    :param dim: embedding dimension
+    :param rng: random number generator
+    :return: tuple of dicts, positions and embeddings
+    """
+
+    positions, embeddings = {}, {}
+    for i in range(seqs):
+        cols = np.flatnonzero(rng.random(length) < 0.9)  # Each sequence covers most columns
+        positions[f'seq{i}'] = (cols, np.arange(len(cols)))
+        embeddings[f'seq{i}'] = synth_embed(len(cols), dim, rng)[1:-1]
+
+    return positions, embeddings
+
+
+def peak_rss() -> float:
+    """Returns the peak resident set size of this process in MB.
+
+    :return: peak RSS
+    """
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10  # bytes on macOS, KB on Linux
+
+
+def time_trials(func, inputs: list, warmup: int, trials: int) -> np.ndarray:
+    """Returns the time of each call to a function, cycling through a list of inputs, after
+    calling it a number of times without timing.
+
+    :param func: function that takes one input
+    :param inputs: list of inputs
+    :param warmup: number of calls before timing
+    :param trials: number of timed calls
+    :return: array of times in seconds
+    """
+
+    for i in range(warmup):
+        func(inputs[i % len(inputs)])
+
+    times = np.empty(trials)
+    for i in range(trials):
+        start = time.perf_counter()
+        func(inputs[i % len(inputs)])
+        times[i] = time.perf_counter() - start
+
+    return times
+
+
+def summarize(bench: str, params: dict, times: np.ndarray) -> dict:
+    """Returns a summary of the times of a benchmark.
+
+    :param bench: name of benchmark
+    :param params: parameters of benchmark (scale)
+    :param times: array of times in seconds
+    :return: dict of benchmark, parameters, queries/s, latency percentiles, and peak RSS
+    """
+
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+    return {'bench': bench, **params, 'trials': len(times), 'qps': len(times) / times.sum(),
+            'mean_ms': times.mean() * 1000, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+            'peak_rss_mb': peak_rss()}
+
+
+def bench_transform_search(args: argparse.Namespace, rng: np.random.Generator) -> list:
+    """Returns summaries of Transform.search for each number of families.
+
+    :param args: argparse.Namespace object with benchmark parameters
+    :param rng: random number generator
+    :return: list of summaries
+    """
+
+    results, dim = [], args.s1 * args.s2
+    queries = []
+    for i in range(args.q):
+        query = Transform(f'query{i}', None, None)
+        query.trans[1] = rng.integers(0, 128, dim, dtype=np.int8)
+        queries.append(query)
+    for fams in args.f:
+        db = synth_dct_db(fams, dim, rng)
+        times = time_trials(lambda query: query.search(db, args.t),  #pylint: disable=W0640
+                             queries, args.w, args.n)
+        results.append(summarize('transform_search', {'fams': fams, 'dim': dim}, times))
+
+    return results
+
+
+def bench_embed_search(args: argparse.Namespace, rng: np.random.Generator) -> list:
+    """Returns summaries of Embedding.search for each number of families.
+
+    :param args: argparse.Namespace object with benchmark parameters
+    :param rng: random number generator
+    :return: list of summaries
+    """
+
+    results, queries = [], []
+    for i, length in enumerate(seq_lengths(args.q, rng, args.lm, args.ls)):
+        queries.append(Embedding(f'query{i}', None, synth_embed(length, args.d, rng)))
+    for fams in args.af:
+        db = synth_anchor_db(fams, args.a, args.d, rng)
+        times = time_trials(lambda query: query.search(db, args.t, None),  #pylint: disable=W0640
+                             queries, args.w, args.n)
+        results.append(summarize('embed_search',
+                                 {'fams': fams, 'anchors': args.a, 'dim': args.d}, times))
+
+    return results
+
+
+def bench_quant_2D(args: argparse.Namespace, rng: np.random.Generator) -> list:
+    """Returns a summary of Transform.quant_2D.
+
+    :param args: argparse.Namespace object with benchmark parameters
+    :param rng: random number generator
+    :return: list of summaries
+    """
+
+    lengths = seq_lengths(args.q, rng, args.lm, args.ls)
+    embeds = [synth_embed(length, args.d, rng) for length in lengths]
+    def quant(embed):
+        Transform('query', embed, None).quant_2D(args.s1, args.s2)
+    times = time_trials(quant, embeds, args.w, args.n)
+
+    return [summarize('quant_2D', {'dim': args.d, 's1': args.s1, 's2': args.s2}, times)]
+
+
+def bench_cons_avg(args: argparse.Namespace, rng: np.random.Generator) -> list:
+    """Returns a summary of averaging a family's embeddings over its consensus positions.
+
+    :param args: argparse.Namespace object with benchmark parameters
+    :param rng: random number generator
+    :return: list of summaries
+    """
+
+    fams = [synth_family(args.sq, length, args.d, rng)
+            for length in seq_lengths(min(args.q, 8), rng, args.lm, args.ls)]
+    times = time_trials(lambda fam: cons_avg(*fam), fams, args.w, args.n)
+
+    return [summarize('cons_avg', {'seqs': args.sq, 'dim': args.d}, times)]
+
+
+BENCHES = {'transform_search': bench_transform_search, 'embed_search': bench_embed_search,
+           'quant_2D': bench_quant_2D, 'cons_avg': bench_cons_avg}  #pylint: disable=C0103
+
+
+def git_commit() -> str:
+    """Returns the current git commit, or None if it cannot be found.
+
+    :return: commit hash
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                        stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: dict, new: dict):
+    """Prints the speedup of each benchmark in new results over the same benchmark in old results.
+
+    :param old: results from an earlier run
+    :param new: results from this run
+    """
+
+    def key(res):
+        return tuple((k, v) for k, v in res.items() if k in ('bench', 'fams', 'anchors', 'dim',
+                                                           's1', 's2', 'seqs'))
+    old_res = {key(res): res for res in old['results']}
+    for res in new['results']:
+        if key(res) in old_res:
+            before = old_res[key(res)]
+            print(f"{dict(key(res))}: {before['p50_ms']:.3f} -> {res['p50_ms']:.3f} ms p50, "
+                  f"{res['qps'] / before['qps']:.2f}x qps")
+
+
+def main():
+    """Main runs each benchmark and writes the results to a JSON file.
+
+    args:
+        -a: number of anchors per family
+        -af: numbers of families for embed_search
+        -b: benchmarks to run
+        -c: JSON file of earlier results to compare to
+        -d: embedding dimension
+        -f: numbers of families for transform_search
+        -lm: median sequence length
+        -ls: standard deviation of log sequence length
+        -n: number of timed trials
+        -o: JSON file to write results to
+        -q: number of synthetic queries
+        -r: seed for random number generator
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+        -sq: number of sequences per family for cons_avg
+        -t: number of results to return from search
+        -w: number of warmup calls
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', type=int, default=3)
+    parser.add_argument('-af', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('-b', type=str, nargs='+', default=list(BENCHES), choices=list(BENCHES))
+    parser.add_argument('-c', type=str, default='')
+    parser.add_argument('-d', type=int, default=2560)
+    parser.add_argument('-f', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('-lm', type=int, default=130)
+    parser.add_argument('-ls', type=float, default=0.6)
+    parser.add_argument('-n', type=int, default=20)
+    parser.add_argument('-o', type=str, default='data/bench.json')
+    parser.add_argument('-q', type=int, default=20)
+    parser.add_argument('-r', type=int, default=0)
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    parser.add_argument('-sq', type=int, default=50)
+    parser.add_argument('-t', type=int, default=100)
+    parser.add_argument('-w', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.r)
+    results = []
+    for bench in args.b:
+        for res in BENCHES[bench](args, rng):
+            print(f"{res['bench']} {res.get('fams', '')}: {res['qps']:.2f} q/s, "
+                  f"p50 {res['p50_ms']:.3f} ms, p99 {res['p99_ms']:.3f} ms")
+            results.append(res)
+
+    # Write results with enough information to compare runs
+    output = {'date': str(datetime.datetime.now()), 'commit': git_commit(),
+              'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'args': vars(args), 'results': results}
+    if os.path.dirname(args.o):
+        os.makedirs(os.path.dirname(args.o), exist_ok=True)
+    with open(args.o, 'w', encoding='utf8') as file:
+        json.dump(output, file, indent=2)
+
+    if args.c:
+        with open(args.c, 'r', encoding='utf8') as file:
+            compare(json.load(file), output)
+
+
+if __name__ == '__main__':
+    main()
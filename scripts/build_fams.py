@@ -0,0 +1,114 @@
+"""This script builds the average embedding, anchor residues, and average DCT for each Pfam family
+in one pass. Each family's alignment and embeddings are loaded once and used for all three,
+instead of being loaded again by avg_embed.py, get_anchors.py, and avg_dct.py.
+
+__author__ = "Ben Iovino"
+__date__ = "09/15/23"
+"""
+
+import argparse
+import logging
+import os
+from functools import partial
+import numpy as np
+from avg_embed import get_seqs
+from cons_embed import cons_pos, load_embed, cons_avg
+from fam_pool import map_fams, save_part
+from get_anchors import find_anchors
+from util import Embedding, Transform
+
+
+def out_files(fam: str, args: argparse.Namespace) -> tuple:
+    """Returns the files that the average embedding, anchors, and average DCT of a family are
+    saved to. These are the same files written by avg_embed.py, get_anchors.py, and avg_dct.py.
+
+    :param fam: Pfam family
+    :param args: argparse.Namespace object with directory of embeddings and dct dimensions
+    :return: tuple of paths to average embedding, anchors, and average DCT
+    """
+
+    enclay = '_'.join(args.d.split('/')[-1].split('_')[:2])  # enc/layer used to embed
+    return (f'data/avg_embed/{fam}/avg_embed.npy', f'data/anchors/{fam}/anchors.npy',
+            f'data/{enclay}_{args.s1}{args.s2}_avg/{fam}.npy')
+
+
+def build_fam(fam: str, args: argparse.Namespace) -> tuple:
+    """Saves the average embedding, anchors, and average DCT of a Pfam family, unless all three
+    were saved by an earlier run.
+
+    :param fam: Pfam family
+    :param args: argparse.Namespace object with directory of embeddings, number of anchors, and
+        dct dimensions
+    :return: tuple of paths to average embedding, anchors, and average DCT
+    """
+
+    files = out_files(fam, args)
+    if all(os.path.exists(file) for file in files):
+        logging.info('Skipping %s', fam)
+        return files
+
+    # Load alignment and embeddings once
+    sequences = get_seqs(fam)
+    positions = cons_pos(sequences)
+    embeddings = load_embed(f'{args.d}/{fam}')
+
+    # Average embedding
+    avg_embed = cons_avg(positions, embeddings)
+    for file in files:
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+    save_part(files[0], avg_embed)
+
+    # Anchors
+    anchor_embed = find_anchors(avg_embed, positions, embeddings, args.a)
+    save_part(files[1], Embedding(fam, None, anchor_embed).embed)
+
+    # Average DCT
+    avg_dct = Transform(fam, avg_embed, None)
+    avg_dct.quant_2D(args.s1, args.s2)
+    save_part(files[2], avg_dct.trans)
+
+    return files
+
+
+def main():
+    """Main builds the average embedding, anchors, and average DCT for each family and then merges
+    the anchors and DCTs of every family into one file each.
+
+    args:
+        -a: number of anchor residues to find
+        -d: directory of embeddings
+        -p: number of processes
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+    """
+
+    log_filename = 'data/logs/build_fams.log'  #pylint: disable=C0103
+    os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+    logging.basicConfig(filename=log_filename, filemode='w',
+                     level=logging.INFO, format='%(message)s', force=True)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', type=int, default=3)
+    parser.add_argument('-d', type=str, default='data/esm2_17_embed')
+    parser.add_argument('-p', type=int, default=1)
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    args = parser.parse_args()
+
+    anchors, dcts = [], []
+    fams = sorted(os.listdir(args.d))
+    for i, (fam, files) in enumerate(map_fams(partial(build_fam, args=args), fams, args.p)):
+        logging.info('Built %s, %s', fam, i)
+        anchors.append(np.load(files[1], allow_pickle=True))
+        avg_dct = np.load(files[2], allow_pickle=True)
+        if avg_dct[1] is not None:
+            dcts.append(avg_dct)
+
+    # Save anchors and dcts as one file each
+    enclay = '_'.join(args.d.split('/')[-1].split('_')[:2])  # enc/layer used to embed
+    np.save('data/anchors.npy', anchors, allow_pickle=True)
+    np.save(f'data/{enclay}_{args.s1}{args.s2}_avg.npy', dcts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""This script defines a two level index for searching a DCT database. Families in the same Pfam
+clan are grouped together and each group is represented by one centroid DCT, and families that are
+not in a clan are their own group. A query is first compared to every centroid, and then only the
+rows of the groups with the closest centroids (the beam) are searched. With multiple rows per
+family (_cluster entries) and clans of many families, most rows are never compared to the query.
+
+Running this script embeds the queries in the manifest and reports how many of the top results
+from a flat search of every row are found by the index for each beam width.
+
+__author__ = "Ben Iovino"
+__date__ = "09/25/23"
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+from scipy.spatial.distance import cdist
+from make_queries import read_queries
+from parse_clans import load_clans
+from util import load_model, fam_rows, max_fams, embed_batch, Transform
+import timing
+
+
+class ClanIndex:
+    """This class groups the rows of a DCT database by clan and searches the rows of the groups
+    whose centroids are closest to a query.
+    """
+
+
+    def __init__(self, names: list, dcts: np.ndarray, fam_clans: dict):
+        """Defines ClanIndex class. The centroid of each group is the median of its rows in each
+        dimension, which is the point with the least total Manhattan distance to them.
+
+        :param names: name of each row in the database (family or family_cluster)
+        :param dcts: array of DCTs (rows x dim)
+        :param fam_clans: dict returned by parse_clans.load_clans
+        """
+
+        self.names = names
+        self.dcts = dcts.astype(np.float64)  # cdist converts to float for every search otherwise
+        self.fams, self.row_fams = fam_rows(names)
+        groups = {}
+        for row, fam in enumerate(self.row_fams):
+            clan = fam_clans.get(self.fams[fam], -1)
+            groups.setdefault(f'clan{clan}' if clan >= 0 else self.fams[fam], []).append(row)
+        self.groups = [np.array(rows) for rows in groups.values()]
+        self.centroids = np.stack([np.median(self.dcts[rows], axis=0) for rows in self.groups])
+
+
+    def candidates(self, query: np.ndarray, beam: int) -> np.ndarray:
+        """Returns the rows of the groups whose centroids are closest to a query.
+
+        :param query: DCT of query
+        :param beam: number of groups to search
+        :return: array of rows in database order
+        """
+
+        dists = cdist(query[None].astype(np.float64), self.centroids, 'cityblock')[0]
+        best = np.argsort(dists, kind='stable')[:beam]
+
+        return np.sort(np.concatenate([self.groups[group] for group in best]))
+
+
+    def search(self, query: np.ndarray, top: int, beam: int) -> dict:
+        """Searches a query against the rows of the closest groups. Results are in the same order
+        as Transform.search for the families that are searched.
+
+        :param query: DCT of query
+        :param top: number of results to return
+        :param beam: number of groups to search (0 to search every row)
+        :return: dict where keys are family names and values are similarity scores
+        """
+
+        rows = self.candidates(query, beam) if beam else np.arange(len(self.names))
+        timing.count('dct candidates', len(self.centroids) * bool(beam) + len(rows))
+        sims = 1 - cdist(query[None].astype(np.float64), self.dcts[rows], 'cityblock')[0]
+
+        return max_fams(sims, self.row_fams[rows], self.fams, top)
+
+
+def measure_recall(index: ClanIndex, queries: np.ndarray, top: int, beam: int) -> dict:
+    """Returns the recall of the index against a flat search, the fraction of queries with the
+    same top result, the average number of DCTs compared to each query, and the time per query.
+
+    :param index: ClanIndex object
+    :param queries: array of query DCTs (queries x dim)
+    :param top: number of results for each query
+    :param beam: number of groups to search
+    :return: dict of results
+    """
+
+    flat = [list(index.search(query, top, 0)) for query in queries]
+    found, same = 0, 0
+    start = time.perf_counter()
+    for query, flat_fams in zip(queries, flat):
+        results = index.search(query, top, beam)
+        found += len(set(results) & set(flat_fams))
+        same += bool(results) and next(iter(results)) == flat_fams[0]
+    secs = time.perf_counter() - start
+    compared = sum(len(index.centroids) + len(index.candidates(query, beam)) for query in queries)
+
+    return {'beam': beam, 'recall': found / sum(map(len, flat)), 'top1': same / len(queries),
+            'compared': compared / len(queries), 'ms': secs / len(queries) * 1000}
+
+
+def embed_queries(args: argparse.Namespace) -> np.ndarray:
+    """Returns the DCT of each query in the manifest that is large enough to be transformed.
+
+    :param args: argparse.Namespace object with manifest, encoder, and DCT dimensions
+    :return: array of query DCTs (queries x dim)
+    """
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # pylint: disable=E1101
+    tokenizer, model = load_model(args.e, device)
+    seqs = [(query[1], query[2]) for query in read_queries(args.q)]
+    dcts = []
+    for i in range(0, len(seqs), args.bs):
+        for embed in embed_batch(seqs[i:i+args.bs], tokenizer, model, device, args.e, args.l):
+            dct = Transform(embed.embed[0], embed.embed[1], None)
+            dct.quant_2D(args.s1, args.s2)
+            if dct.trans[1] is not None:
+                dcts.append(dct.trans[1])
+
+    return np.stack(dcts)
+
+
+def main():
+    """Main builds a clan index of a DCT database, embeds the queries in the manifest, and prints
+    the recall of the index against a flat search for each beam width.
+
+    args:
+        -b: beam widths (number of groups searched)
+        -bs: number of queries embedded at once
+        -c: file from parse_clans.py
+        -dct: database of dct vectors
+        -e: encoder model
+        -l: layer of model to use (for esm2 only)
+        -q: query manifest from make_queries.py
+        -t: number of results for each query
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('-bs', type=int, default=16)
+    parser.add_argument('-c', type=str, default='data/clans.npz')
+    parser.add_argument('-dct', type=str, default='data/esm2_17_875_clusters.npy')
+    parser.add_argument('-e', type=str, default='esm2')
+    parser.add_argument('-l', type=int, default=17)
+    parser.add_argument('-q', type=str, default='data/queries.fa')
+    parser.add_argument('-t', type=int, default=10)
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    args = parser.parse_args()
+
+    dct_db = np.load(args.dct, allow_pickle=True)
+    index = ClanIndex([dct[0] for dct in dct_db], np.stack([dct[1] for dct in dct_db]),
+                      load_clans(args.c))
+    print(f'{len(index.names)} rows in {len(index.groups)} groups')
+    queries = embed_queries(args)
+
+    # Time of a flat search for comparison, one query at a time like the index
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, args.t, 0)
+    print(f'Flat: {len(index.names)} compared, '
+          f'{(time.perf_counter() - start) / len(queries) * 1000:.3f} ms/query')
+    for beam in args.b:
+        res = measure_recall(index, queries, args.t, beam)
+        print(f"Beam {beam}: Recall@{args.t}: {res['recall']:.4f}, Top1: {res['top1']:.4f}, "
+              f"{res['compared']:.1f} compared, {res['ms']:.3f} ms/query")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""This script builds a DCT database with more than one DCT for each Pfam family. The DCTs of each
+family's sequences are clustered with k-medoids under Manhattan distance, the same distance used
+to search, and the medoid of each cluster is saved as family_cluster#. Families are given more
+clusters only while each one lowers the total distance of the family's sequences to their medoids
+by enough, and never more than one cluster for every few sequences, so the database only grows
+for families that are spread out.
+
+__author__ = "Ben Iovino"
+__date__ = "09/26/23"
+"""
+
+import argparse
+import logging
+import os
+import zlib
+from functools import partial
+import numpy as np
+from scipy.spatial.distance import cdist
+from dct_db import load_transforms
+from fam_pool import map_fams, save_part
+
+log_filename = 'data/logs/cluster_dct.log'  #pylint: disable=C0103
+os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+logging.basicConfig(filename=log_filename, filemode='w',
+                     level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+def kmedoids(dists: np.ndarray, k: int, rng: np.random.Generator, iters: int = 20) -> tuple:
+    """Returns k medoids of a set of points. Medoids are initialized like k-means++ and then
+    each medoid is replaced by the point in its cluster with the least total distance to the
+    others until the medoids do not change.
+
+    :param dists: distance between every pair of points (n x n)
+    :param k: number of medoids
+    :param rng: random number generator
+    :param iters: largest number of updates
+    :return: tuple of array of medoids, cluster of each point, and total distance to medoids
+    """
+
+    medoids = [int(rng.integers(len(dists)))]
+    for _ in range(1, k):
+        near = dists[:, medoids].min(axis=1)
+        if near.sum() == 0:  # Every point is a medoid already
+            break
+        medoids.append(int(rng.choice(len(dists), p=near / near.sum())))
+    medoids = np.array(medoids)
+
+    for _ in range(iters):
+        labels = dists[:, medoids].argmin(axis=1)
+        new = medoids.copy()
+        for i in range(len(medoids)):
+            members = np.flatnonzero(labels == i)
+            if len(members):
+                new[i] = members[dists[np.ix_(members, members)].sum(axis=1).argmin()]
+        if np.array_equal(new, medoids):
+            break
+        medoids = new
+    labels = dists[:, medoids].argmin(axis=1)
+
+    return medoids, labels, dists[np.arange(len(dists)), medoids[labels]].sum()
+
+
+def cluster_dcts(dcts: np.ndarray, args: argparse.Namespace, rng: np.random.Generator) -> tuple:
+    """Returns the medoids of a family's DCTs. The number of clusters is increased until adding
+    one more lowers the total distance to the medoids by less than a fraction (-g), or the
+    family has fewer than -n sequences for each cluster, or it reaches -k.
+
+    :param dcts: array of DCTs (sequences x dim)
+    :param args: argparse.Namespace object with clustering parameters
+    :param rng: random number generator
+    :return: tuple of array of medoids and cluster of each DCT
+    """
+
+    dists = cdist(dcts, dcts, 'cityblock')
+    cap = max(1, min(args.k, len(dcts) // args.n))
+    best = kmedoids(dists, 1, rng)
+    for k in range(2, cap+1):
+        res = kmedoids(dists, k, rng)
+        if best[2] == 0 or (best[2] - res[2]) / best[2] < args.g:
+            break
+        best = res
+
+    return best[0], best[1]
+
+
+def cluster_fam(fam: str, args: argparse.Namespace) -> str:
+    """Saves the medoids of a Pfam family's DCTs as a partial result, unless it was saved by an
+    earlier run.
+
+    :param fam: Pfam family
+    :param args: argparse.Namespace object with directory of transforms and clustering parameters
+    :return: path to partial result
+    """
+
+    part = f'{part_dir(args)}/{fam}.npy'
+    if os.path.exists(part):
+        return part
+
+    # Same sample and clusters for a family no matter which process or order it is run in
+    rng = np.random.default_rng([args.r, zlib.crc32(fam.encode())])
+    _, dcts = load_transforms(f'{args.d}/{fam}/transform.npy')
+    if len(dcts) > args.m:
+        dcts = dcts[np.sort(rng.choice(len(dcts), args.m, replace=False))]
+
+    db = np.empty((0, 2), dtype=object)
+    if len(dcts):
+        medoids, labels = cluster_dcts(dcts, args, rng)
+        db = np.empty((len(medoids), 2), dtype=object)
+        for i, medoid in enumerate(medoids):
+            db[i] = [f'{fam}_cluster{i}', dcts[medoid].astype(np.int8)]
+        logging.info('%s: %s sequences, cluster sizes %s', fam, len(dcts),
+                     np.bincount(labels, minlength=len(medoids)).tolist())
+    save_part(part, db)
+
+    return part
+
+
+def part_dir(args: argparse.Namespace) -> str:
+    """Returns the name of the directory for partial results (or the database file without its
+    extension), named after the encoder/layer used to embed and the dct dimensions.
+
+    :param args: argparse.Namespace object with directory of transforms and dct dimensions
+    :return: path without extension
+    """
+
+    enclay = '_'.join(args.d.split('/')[-1].split('_')[:2])  # enc/layer used to embed
+    return f'data/{enclay}_{args.s1}{args.s2}_clusters'
+
+
+def main():
+    """Main clusters the transforms of each family and saves the medoids of every family to one
+    file, which can be searched like the average DCTs from avg_dct.py.
+
+    args:
+        -d: directory of transforms (from embed_pfam.py -t transform)
+        -g: smallest fraction the total distance must drop by to add a cluster
+        -k: largest number of clusters for a family
+        -m: largest number of sequences clustered for a family (sampled if more)
+        -n: smallest number of sequences for each cluster
+        -p: number of processes
+        -r: seed for random number generator
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', type=str, default='data/esm2_17_transform')
+    parser.add_argument('-g', type=float, default=0.1)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('-m', type=int, default=1000)
+    parser.add_argument('-n', type=int, default=10)
+    parser.add_argument('-p', type=int, default=1)
+    parser.add_argument('-r', type=int, default=0)
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    args = parser.parse_args()
+
+    os.makedirs(part_dir(args), exist_ok=True)
+    fams = sorted(os.listdir(args.d))
+    for i, (fam, _) in enumerate(map_fams(partial(cluster_fam, args=args), fams, args.p)):
+        logging.info('Clustered transforms for %s, %s', fam, i)
+
+    # Merge partial results in family order
+    dcts = [np.load(f'{part_dir(args)}/{fam}.npy', allow_pickle=True) for fam in fams]
+    db = np.concatenate(dcts)
+    logging.info('%s clusters for %s families', len(db), len(fams))
+    np.save(f'{part_dir(args)}.npy', db)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,44 @@
-"""Reads results from search.log, finds predicted structure of missed queries and
+"""Reads results from search.jsonl, finds predicted structure of missed queries and
 their top results, and measures similarity between them.
 
 __author__ = "Ben Iovino"
 __date__ = "08/24/23"
 """
 
+import argparse
+import hashlib
 import logging
 import os
 import subprocess
+from functools import partial
 import esm
+import numpy as np
 import torch
 from Bio import SeqIO
+from fam_pool import map_fams
+from fasta_index import FastaIndex
+from parse_logs import read_results
 
 log_filename = 'data/logs/comp_str.log'  #pylint: disable=C0103
 os.makedirs(os.path.dirname(log_filename), exist_ok=True)
 logging.basicConfig(filename=log_filename, filemode='w',
                      level=logging.INFO, format='%(message)s')
 
+MAX_LEN = 800  # Longest sequence folded
+
 
 def parse_log(file: str) -> dict:
-    """Returns a dict of queries and their top search results.
+    """Returns a dict of queries and their top search results. Only queries whose top result is
+    not their family are kept.
 
-    :param file: path to search log file
+    :param file: path to JSONL results file from search.py
     :return: dictionary where key is named of query and value is list of top search results
     """
 
-    with open(file, 'r', encoding='utf8') as sefile:
-        in_result = False
-        results = {}
-        for line in sefile:
-
-            # Skip line inbetween queries
-            if line.startswith(('2023', 'ANCHORS', 'DCT')):
-                in_result = False
-                continue
-            if not in_result:  # Get query family name
-                query = line.strip('\n')
-                results[query] = []
-            else:  # Get top search results
-                results[query].append(line.strip('\n').split(',')[0])
-            in_result = True
+    results = {}
+    for rec in read_results(file):
+        if rec['stage'] != 'skipped' and rec['fams'] and rec['fams'][0] != rec['fam']:
+            results[f"{rec['fam']}/{rec['query']}"] = rec['fams'][:5]
 
     return results
 
@@ -71,12 +70,14 @@ def get_query_seqs(missed_queries: dict) -> dict:
     """
 
     seqs = {}
+    index = FastaIndex('data/full_seqs.idx')
     for key in missed_queries.keys():
-        fam, seq = key.split('/')[0], key.split('/')[1]
-        with open(f'data/full_seqs/{fam}/seqs.fa', 'r', encoding='utf8') as f:
-            for record in SeqIO.parse(f, 'fasta'):
-                if record.id == seq:
-                    seqs[key] = str(record.seq)
+        fam, seqid = key.split('/')[0], key.split('/')[1]
+        if fam not in index.fams:
+            continue
+        record = index.fetch(seqid, fam)  # Only the domain in the query's family
+        if record is not None:
+            seqs[key] = record[1]
 
     return seqs
 
@@ -110,6 +111,17 @@ def get_result_seqs(missed_queries: dict) -> dict:
     return seqs
 
 
+def seq_hash(seq: str) -> str:
+    """Returns a hash of a sequence, used to name its structure so the same sequence is only folded
+    once no matter how many queries it appears for.
+
+    :param seq: protein sequence
+    :return: hex digest of sequence
+    """
+
+    return hashlib.blake2b(seq.encode(), digest_size=16).hexdigest()
+
+
 def esm_fold(seq: str, sfile: str, model):
     """Writes an esm-fold predicted structure to file.
 
@@ -119,107 +131,221 @@ def esm_fold(seq: str, sfile: str, model):
     """
 
     # Tried multiprocessing but only loaded on one GPU
-    if len(seq) > 800:
-        logging.info('Sequence too long')
-        return
-
-    # Predict and write
     with torch.no_grad():
         output = model.infer_pdb(seq)
-    with open(sfile, 'w', encoding='utf8') as pdb:
+
+    # Replace file only when finished so partial structures are not cached
+    with open(f'{sfile}.tmp', 'w', encoding='utf8') as pdb:
         pdb.write(output)
+    os.replace(f'{sfile}.tmp', sfile)
 
 
-def predict_str(model, query_seqs: dict, missed_queries: dict):
-    """Writes esm-fold predicted structures to file.
+def stub_fold(seq: str, sfile: str):
+    """Writes a CA-only structure of a sequence as an ideal alpha helix, in place of esm-fold so the
+    pipeline can be run without a GPU or model weights.
+
+    :param seq: sequence to write structure of
+    :param sfile: file to write structure to
+    """
+
+    with open(f'{sfile}.tmp', 'w', encoding='utf8') as pdb:
+        for i, _ in enumerate(seq):
+            x, y, z = 2.3 * np.cos(np.radians(100 * i)), 2.3 * np.sin(np.radians(100 * i)), 1.5 * i
+            pdb.write(f'ATOM  {i+1:>5}  CA  ALA A{i+1:>4}    {x:>8.3f}{y:>8.3f}{z:>8.3f}'
+                      '  1.00  0.00           C\n')
+        pdb.write('END\n')
+    os.replace(f'{sfile}.tmp', sfile)
+
+
+def fold_list(query_seqs: dict, missed_queries: dict, direc: str) -> dict:
+    """Returns the sequences that still need a predicted structure. Each query shares its result
+    families with many other queries, so sequences are only listed once. Sequences with a
+    structure already in direc, and sequences longer than MAX_LEN, which are never folded, are
+    left out.
 
-    :param model: esm-fold model
     :param query_seqs: dict where key is query name and value is query sequence
     :param missed_queries: dict where key is query name and value is a dict where key is result
     name and value is it's sequence
+    :param direc: directory of structures
+    :return: dict where key is sequence hash and value is sequence
     """
 
-    direc = 'data/structures'
-    if not os.path.exists(direc):
-        os.mkdir(direc)
-
-    # Each query calls 7 predictions: query, query family, and top 5 results from search
+    seqs = {}
     for query, seq in query_seqs.items():
-        query_fam, query_seq = query.split('/')[0], query.split('/')[1]
+        for sequence in [seq, *missed_queries[query].values()]:
+            key = seq_hash(sequence)
+            if key in seqs or os.path.exists(f'{direc}/{key}.pdb'):
+                continue
+            if len(sequence) > MAX_LEN:
+                logging.info('%s too long to fold (%s)', key, len(sequence))
+                continue
+            seqs[key] = sequence
 
-        # Skip set of sequences if already predicted
-        if os.path.exists(f'{direc}/{query_fam}'):
-            continue
-        os.mkdir(f'{direc}/{query_fam}')
+    return seqs
 
-        # Predict structure of query sequence
-        logging.info('Predicting %s', f'{query_fam}/{query_seq}')
-        filename = f'{direc}/{query_fam}/query-{query_seq}.pdb'
-        esm_fold(seq, filename, model)
 
-        # Predict representative sequences for query/result families
-        count = 0
-        for result, result_seq in missed_queries[query].items():
-            logging.info('Predicting %s', result)
-            filename = f'{direc}/{query_fam}/result{count}-{result}.pdb'
-            esm_fold(result_seq, filename, model)
-            count += 1
+def predict_str(fold, seqs: dict, direc: str):
+    """Writes predicted structures to file, named by the hash of their sequence.
+
+    :param fold: function that takes a sequence and file and writes its structure
+    :param seqs: dict where key is sequence hash and value is sequence
+    :param direc: directory to write structures to
+    """
+
+    os.makedirs(direc, exist_ok=True)
+    for i, (key, seq) in enumerate(seqs.items()):
+        logging.info('Predicting %s (%s/%s)', key, i+1, len(seqs))
+        fold(seq, f'{direc}/{key}.pdb')
 
 
-def compare_str() -> dict:
-    """Returns a dict of p-values from FATCAT structural alignment.
+def fatcat(pair: tuple, binary: str, direc: str) -> str:
+    """Returns the p-value of a FATCAT structural alignment between two structures.
 
-    return: dict where key is query and value is a dict where key is result and value is p-value
+    :param pair: tuple of sequence hashes of both structures
+    :param binary: path to FATCAT
+    :param direc: directory of structures
+    :return: p-value, or None if FATCAT failed to align
     """
 
-    pvalues = {}
-    for direc in os.listdir('data/structures'):
+    result = subprocess.run([binary, '-p1', f'{direc}/{pair[0]}.pdb',
+                             '-p2', f'{direc}/{pair[1]}.pdb', '-q'],
+                             capture_output=True, text=True, check=False).stdout
+    try:
+        return result.split('\n')[2].split()[1]
+    except IndexError:  # FATCAT failed to align
+        return None
 
-        # Query is first then results are in order
-        files = sorted(os.listdir(f'data/structures/{direc}'))
-        if files == []:  # Skip empty directories (structures too big to fold)
-            continue
-        query = f"{direc}/{files[0].split('-')[1].split('.')[0]}"  # query fam/seq
-        pvalues[query] = {}
-
-        # Compare query to each result (result0 is actually query family representative)
-        for file in files[1:]:
-            result = subprocess.getoutput(f'FATCAT -p1 data/structures/{direc}/{files[0]} '
-                      f'-p2 data/structures/{direc}/{file} -q')
-            result_name = file.split('-')[1].split('.')[0]
-            try:
-                pvalues[query][result_name] = result.split('\n')[2].split()[1]
-            except IndexError:  # FATCAT failed to align
-                continue
 
-        # Write pvalues to file
-        with open('data/pvalues.txt', 'a', encoding='utf8') as pfile:
-            for result, pvalue in pvalues[query].items():
-                pfile.write(f'{query} {result} {pvalue}\n')
+def stub_fatcat(pair: tuple, direc: str) -> str:
+    """Returns a p-value from the difference in length of two structures, in place of FATCAT so the
+    pipeline can be run without it.
+
+    :param pair: tuple of sequence hashes of both structures
+    :param direc: directory of structures
+    :return: p-value
+    """
+
+    lengths = []
+    for key in pair:
+        with open(f'{direc}/{key}.pdb', 'r', encoding='utf8') as pdb:
+            lengths.append(sum(1 for line in pdb if line.startswith('ATOM')))
+
+    return f'{1 - min(lengths) / max(lengths):.2e}'
+
+
+def load_pvalues(file: str) -> dict:
+    """Returns the p-values of structure pairs that were already compared.
+
+    :param file: tsv file of sequence hashes and p-value (NA if FATCAT failed)
+    :return: dict where key is tuple of sequence hashes and value is p-value or None
+    """
+
+    pvalues = {}
+    if os.path.exists(file):
+        with open(file, 'r', encoding='utf8') as pfile:
+            for line in pfile:
+                fields = line.split()
+                if len(fields) == 3:  # Skip incomplete lines
+                    pvalues[(fields[0], fields[1])] = None if fields[2] == 'NA' else fields[2]
 
     return pvalues
 
 
+def compare_str(query_seqs: dict, missed_queries: dict, compare, direc: str, procs: int) -> dict:
+    """Returns a dict of p-values from structural alignment of each query to its results. Each pair
+    of structures is only compared once, and its p-value is kept in a cache file in direc, so
+    queries that share a structure pair or a later run do not compare it again.
+
+    :param query_seqs: dict where key is query name and value is query sequence
+    :param missed_queries: dict where key is query name and value is a dict where key is result
+    name and value is it's sequence
+    :param compare: picklable function that takes a pair of sequence hashes and returns a p-value
+    :param direc: directory of structures
+    :param procs: number of processes comparing structures
+    :return: dict where key is query and value is a dict where key is result and value is p-value
+    """
+
+    # Pairs of structures that have not been compared (structures too big to fold are skipped)
+    pvalues = load_pvalues(f'{direc}/pvalues.tsv')
+    pairs = {}
+    for query, seq in query_seqs.items():
+        for result_seq in missed_queries[query].values():
+            pair = (seq_hash(seq), seq_hash(result_seq))
+            if pair not in pvalues and all(os.path.exists(f'{direc}/{key}.pdb') for key in pair):
+                pairs[pair] = None
+
+    # Compare in parallel, adding each p-value to the cache as it finishes
+    logging.info('Comparing %s structure pairs', len(pairs))
+    with open(f'{direc}/pvalues.tsv', 'a', encoding='utf8') as pfile:
+        for pair, pvalue in map_fams(compare, list(pairs), procs, chunk=4):
+            pvalues[pair] = pvalue
+            pfile.write(f'{pair[0]}\t{pair[1]}\t{pvalue or "NA"}\n')
+            pfile.flush()
+
+    # Query is first then results are in order (first result is query family representative)
+    results = {}
+    for query, seq in query_seqs.items():
+        results[query] = {}
+        for result, result_seq in missed_queries[query].items():
+            pvalue = pvalues.get((seq_hash(seq), seq_hash(result_seq)))
+            if pvalue is not None:
+                results[query][result] = pvalue
+
+    return results
+
+
 def main():
     """Initializes esm fold model to predict structures of missed queries and their top search
-    results. Then compares predicted structures using FATCAT.
+    results. Then compares predicted structures using FATCAT. Structures and p-values are cached,
+    so only new sequences are folded and only new pairs are compared.
+
+    args:
+        -d: directory of structures and p-value cache
+        -f: fold with esmfold or stub (writes a helix, for testing without a model)
+        -fc: path to FATCAT binary, or stub (compares lengths, for testing without FATCAT)
+        -j: JSONL results file from search.py
+        -o: file to write p-values to
+        -p: number of processes comparing structures
     """
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', type=str, default='data/structures')
+    parser.add_argument('-f', type=str, default='esmfold', choices=['esmfold', 'stub'])
+    parser.add_argument('-fc', type=str, default='FATCAT')
+    parser.add_argument('-j', type=str, default='data/logs/search.jsonl')
+    parser.add_argument('-o', type=str, default='data/pvalues.txt')
+    parser.add_argument('-p', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
     # Get missed queries and their top search results
-    results = parse_log('data/logs/search.log')
+    results = parse_log(args.j)
     missed_queries = parse_results(results)
 
     # Get their respective sequences
     query_seqs = get_query_seqs(missed_queries)
     missed_queries = get_result_seqs(missed_queries)
 
-    # Load model and predict/compare structures
+    # Predict each structure not already predicted, loading model only if needed
+    seqs = fold_list(query_seqs, missed_queries, args.d)
+    logging.info('%s structures to predict', len(seqs))
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  #pylint: disable=E1101
-    model = esm.pretrained.esmfold_v1()
-    model = model.eval().cuda()
-    model.to(device)
-    predict_str(model, query_seqs, missed_queries)
-    compare_str()
+    fold = stub_fold
+    if seqs and args.f == 'esmfold':
+        model = esm.pretrained.esmfold_v1()
+        model = model.eval().to(device)
+        fold = partial(esm_fold, model=model)
+    predict_str(fold, seqs, args.d)
+
+    # Compare structures and write p-values
+    if args.fc == 'stub':
+        compare = partial(stub_fatcat, direc=args.d)
+    else:
+        compare = partial(fatcat, binary=args.fc, direc=args.d)
+    pvalues = compare_str(query_seqs, missed_queries, compare, args.d, args.p)
+    with open(args.o, 'w', encoding='utf8') as pfile:
+        for query, result_pvalues in pvalues.items():
+            for result, pvalue in result_pvalues.items():
+                pfile.write(f'{query} {result} {pvalue}\n')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+"""This script defines vectorized functions for averaging embeddings over the consensus positions
+of a Pfam family's alignment. Each aligned sequence is turned into an index map that pairs
+alignment columns with rows in that sequence's embedding, which lets the embeddings be gathered
+and summed with numpy instead of building lists of vectors for every position.
+
+__author__ = "Ben Iovino"
+__date__ = "09/11/23"
+"""
+
+import numpy as np
+
+GAP = ord('.')
+
+
+def index_map(cons_seq: str, seq: str) -> tuple:
+    """Returns the alignment columns where both the consensus and the sequence are not gaps and
+    the row in the sequence's embedding that corresponds to each of those columns.
+
+    :param cons_seq: aligned consensus sequence
+    :param seq: aligned sequence
+    :return: tuple of arrays, alignment columns and embedding rows
+    """
+
+    cons = np.frombuffer(str(cons_seq).encode(), dtype=np.uint8)
+    seq = np.frombuffer(str(seq).encode(), dtype=np.uint8)
+
+    # Row of the embedding is the number of residues (non-gaps) seen before each column
+    res = seq != GAP
+    rows = np.cumsum(res) - 1
+    keep = res & (cons != GAP)
+
+    return np.flatnonzero(keep), rows[keep]
+
+
+def cons_pos(sequences: dict) -> dict:
+    """Returns a dict with the index map of each sequence in a dictionary of aligned sequences.
+
+    :param sequences: dictionary of sequences, including the consensus sequence
+    :return: seq id is key with tuple of alignment columns and embedding rows as value
+    """
+
+    # Get consensus sequence and remove it so it is not compared to itself
+    cons_seq = sequences['consensus']
+    del sequences['consensus']
+
+    positions = {}
+    for seqid, seq in sequences.items():
+        positions[seqid] = index_map(cons_seq, seq)
+
+    return positions
+
+
+def load_embed(direc: str) -> dict:
+    """Returns a dictionary of embeddings from an embedding directory.
+
+    :param direc: directory containing embed.npy
+    :return: dict where seq id is key with embedding (n x m array) as value
+    """
+
+    embeddings = {}
+    embed = np.load(f'{direc}/embed.npy', allow_pickle=True)
+    for sid, emb in embed:
+        embeddings[sid] = np.asarray(emb)
+
+    return embeddings
+
+
+def cons_sums(positions: dict, embeddings: dict) -> tuple:
+    """Returns the sum of embeddings and the number of embeddings at each alignment column.
+
+    :param positions: dict where seq id is key with tuple of columns and rows as value
+    :param embeddings: dict where seq id is key with embedding as value
+    :return: tuple of arrays, sums (columns x dim) and counts (columns)
+    """
+
+    length = max((cols[-1]+1 for cols, _ in positions.values() if len(cols)), default=0)
+    dim = next(iter(embeddings.values())).shape[1]
+    sums = np.zeros((length, dim), dtype=np.float64)
+    counts = np.zeros(length, dtype=np.int64)
+
+    # Columns are unique for each sequence so they can be added without np.add.at
+    for seqid, (cols, rows) in positions.items():
+        sums[cols] += embeddings[seqid][rows]
+        counts[cols] += 1
+
+    return sums, counts
+
+
+def cons_mean(sums: np.ndarray, counts: np.ndarray, dtype=np.float32) -> np.ndarray:
+    """Returns the average embedding for each alignment column with at least one embedding.
+
+    :param sums: sum of embeddings at each column
+    :param counts: number of embeddings at each column
+    :param dtype: dtype of the returned average embedding
+    :return: average embedding (positions x dim)
+    """
+
+    cols = counts > 0
+    return (sums[cols] / counts[cols, None]).astype(dtype)
+
+
+def cons_index(counts: np.ndarray) -> np.ndarray:
+    """Returns an array that maps each alignment column to its position in the average embedding,
+    which only includes columns with at least one embedding.
+
+    :param counts: number of embeddings at each column
+    :return: array of positions (-1 for columns without any embeddings)
+    """
+
+    index = np.cumsum(counts > 0) - 1
+    index[counts == 0] = -1
+
+    return index
+
+
+def cons_avg(positions: dict, embeddings: dict) -> np.ndarray:
+    """Returns the average embedding for the consensus positions of a family.
+
+    :param positions: dict where seq id is key with tuple of columns and rows as value
+    :param embeddings: dict where seq id is key with embedding as value
+    :return: average embedding (positions x dim)
+    """
+
+    sums, counts = cons_sums(positions, embeddings)
+    return cons_mean(sums, counts)
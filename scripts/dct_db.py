@@ -0,0 +1,317 @@
+"""This script defines the DCT database class, which stores the sum, sum of squares, and number of
+DCT vectors for each Pfam family instead of only their average. Sequences can be added to or
+removed from a family, and families can be added or dropped, by updating only the affected rows.
+
+The database is a directory with one .npy file for each statistic, which are opened as memory
+maps so rows can be updated in place, and an index that maps each family to its row, holds the
+ids of the sequences in each family, and is versioned each time the database is saved.
+
+__author__ = "Ben Iovino"
+__date__ = "09/13/23"
+"""
+
+import argparse
+import os
+import pickle
+import numpy as np
+from numpy.lib.format import open_memmap
+from util import Transform
+
+
+class DCTDatabase:
+    """This class stores sufficient statistics for the DCT vectors of each Pfam family.
+    """
+
+
+    def __init__(self, path: str):
+        """Opens an existing database.
+
+        :param path: directory of database
+        """
+
+        self.path = path
+        with open(f'{path}/index.pkl', 'rb') as file:
+            index = pickle.load(file)
+        self.version = index['version']
+        self.dim = index['dim']
+        self.fams = index['fams']  # family names in row order
+        self.members = index['members']  # family name -> set of sequence ids
+        self.rows = {fam: i for i, fam in enumerate(self.fams)}
+        self.sums = open_memmap(f'{path}/sums.npy', mode='r+')
+        self.sumsq = open_memmap(f'{path}/sumsq.npy', mode='r+')
+        self.counts = open_memmap(f'{path}/counts.npy', mode='r+')
+
+
+    @classmethod
+    def create(cls, path: str, dim: int, capacity: int = 1024):
+        """Returns a new empty database.
+
+        :param path: directory of database
+        :param dim: length of DCT vectors
+        :param capacity: number of rows to allocate
+        :return: DCTDatabase object
+        """
+
+        os.makedirs(path, exist_ok=True)
+        for stat, shape in [('sums', (capacity, dim)), ('sumsq', (capacity, dim)),
+                            ('counts', (capacity,))]:
+            arr = open_memmap(f'{path}/{stat}.npy', mode='w+', dtype=np.int64, shape=shape)
+            del arr
+        write_index(path, {'version': 0, 'dim': dim, 'fams': [], 'members': {}})
+
+        return cls(path)
+
+
+    def grow(self, capacity: int):
+        """Copies each statistic to a larger file so more families can be added.
+
+        :param capacity: new number of rows
+        """
+
+        for stat in ['sums', 'sumsq', 'counts']:
+            old = getattr(self, stat)
+            new = open_memmap(f'{self.path}/{stat}.tmp.npy', mode='w+', dtype=np.int64,
+                               shape=(capacity,) + old.shape[1:])
+            new[:len(self.fams)] = old[:len(self.fams)]
+            new.flush()
+            del new, old
+            os.replace(f'{self.path}/{stat}.tmp.npy', f'{self.path}/{stat}.npy')
+            setattr(self, stat, open_memmap(f'{self.path}/{stat}.npy', mode='r+'))
+
+
+    def add_fam(self, fam: str) -> int:
+        """Adds an empty family to the database and returns its row.
+
+        :param fam: Pfam family
+        :return: row of family
+        """
+
+        if fam in self.rows:
+            return self.rows[fam]
+        if len(self.fams) == len(self.counts):
+            self.grow(2 * len(self.counts))
+
+        row = len(self.fams)
+        self.sums[row], self.sumsq[row], self.counts[row] = 0, 0, 0
+        self.fams.append(fam)
+        self.members[fam] = set()
+        self.rows[fam] = row
+
+        return row
+
+
+    def drop_fam(self, fam: str):
+        """Removes a family from the database by moving the last row into its place.
+
+        :param fam: Pfam family
+        """
+
+        row, last = self.rows.pop(fam), len(self.fams) - 1
+        if row != last:
+            self.sums[row] = self.sums[last]
+            self.sumsq[row] = self.sumsq[last]
+            self.counts[row] = self.counts[last]
+            self.fams[row] = self.fams[last]
+            self.rows[self.fams[row]] = row
+        self.fams.pop()
+        del self.members[fam]
+
+
+    def add_seqs(self, fam: str, ids: list, dcts: np.ndarray):
+        """Adds DCT vectors to a family, which is added to the database if it is not in it.
+        Sequences that are already in the family, or repeated in ids, are only added once.
+
+        :param fam: Pfam family
+        :param ids: list of sequence ids
+        :param dcts: DCT vectors (n x dim)
+        """
+
+        row = self.add_fam(fam)
+        keep, seen = [], set()
+        for i, seqid in enumerate(ids):
+            if seqid not in self.members[fam] and seqid not in seen:
+                keep.append(i)
+                seen.add(seqid)
+        dcts = np.asarray(dcts, dtype=np.int64)[keep]
+        self.sums[row] += dcts.sum(axis=0)
+        self.sumsq[row] += (dcts * dcts).sum(axis=0)
+        self.counts[row] += len(keep)
+        self.members[fam].update(ids[i] for i in keep)
+
+
+    def remove_seqs(self, fam: str, ids: list, dcts: np.ndarray):
+        """Removes DCT vectors from a family. Sequences that are not in the family are skipped,
+        and sequences repeated in ids are only removed once.
+
+        :param fam: Pfam family
+        :param ids: list of sequence ids
+        :param dcts: DCT vectors (n x dim) that were added for each sequence
+        """
+
+        row = self.rows[fam]
+        keep, seen = [], set()
+        for i, seqid in enumerate(ids):
+            if seqid in self.members[fam] and seqid not in seen:
+                keep.append(i)
+                seen.add(seqid)
+        dcts = np.asarray(dcts, dtype=np.int64)[keep]
+        self.sums[row] -= dcts.sum(axis=0)
+        self.sumsq[row] -= (dcts * dcts).sum(axis=0)
+        self.counts[row] -= len(keep)
+        self.members[fam].difference_update(ids[i] for i in keep)
+
+
+    def save(self):
+        """Flushes each statistic to disk and then writes the index with a new version.
+        """
+
+        for stat in [self.sums, self.sumsq, self.counts]:
+            stat.flush()
+        self.version += 1
+        write_index(self.path, {'version': self.version, 'dim': self.dim, 'fams': self.fams,
+                                'members': self.members})
+
+
+    def means(self) -> tuple:
+        """Returns the average DCT of every family with at least one sequence.
+
+        :return: tuple of family names and average DCTs (families x dim)
+        """
+
+        size = len(self.fams)
+        counts = np.asarray(self.counts[:size])
+        keep = np.flatnonzero(counts)
+        avgs = np.asarray(self.sums[:size])[keep] // counts[keep, None]
+
+        return [self.fams[i] for i in keep], avgs
+
+
+    def variances(self) -> np.ndarray:
+        """Returns the variance of each coefficient for every family with at least one sequence.
+
+        :return: variances (families x dim)
+        """
+
+        size = len(self.fams)
+        counts = np.asarray(self.counts[:size])
+        keep = np.flatnonzero(counts)
+        counts = counts[keep, None]
+        sums = np.asarray(self.sums[:size])[keep]
+
+        return np.asarray(self.sumsq[:size])[keep] / counts - (sums / counts) ** 2
+
+
+    def to_array(self) -> list:
+        """Returns the average DCT of each family in the same format as other DCT databases,
+        which can be saved with np.save and searched with Transform.search().
+
+        :return: list of arrays containing family name and average DCT
+        """
+
+        fams, avgs = self.means()
+        return [Transform(fam, None, avg).trans for fam, avg in zip(fams, avgs)]
+
+
+def write_index(path: str, index: dict):
+    """Writes the index of a database, replacing the old one only after the new one is written.
+
+    :param path: directory of database
+    :param index: dict with version, dim, family names, and members
+    """
+
+    with open(f'{path}/index.pkl.tmp', 'wb') as file:
+        pickle.dump(index, file)
+    os.replace(f'{path}/index.pkl.tmp', f'{path}/index.pkl')
+
+
+def load_transforms(file: str) -> tuple:
+    """Returns the sequence ids and DCT vectors from a file of transforms.
+
+    :param file: .npy file of transforms (from embed_pfam.py -t transform)
+    :return: tuple of sequence ids and DCT vectors (n x dim)
+    """
+
+    transforms = np.load(file, allow_pickle=True)
+    ids = [trans[0] for trans in transforms]
+    dcts = np.array([trans[1] for trans in transforms], dtype=np.int64)
+
+    return ids, dcts
+
+
+def build_db(path: str, direc: str, dim: int) -> DCTDatabase:
+    """Returns a new database built from a directory of family transforms (embed_pfam.py) or
+    family accumulators (full_dct.py).
+
+    :param path: directory of database
+    :param direc: directory of transforms or accumulators
+    :param dim: length of DCT vectors
+    :return: DCTDatabase object
+    """
+
+    db = DCTDatabase.create(path, dim, max(len(os.listdir(direc)), 1))
+    for fam in sorted(os.listdir(direc)):
+
+        # Accumulators already hold the sums for each family
+        if fam.endswith('.npz'):
+            acc = np.load(f'{direc}/{fam}', allow_pickle=True)
+            if not acc['done']:
+                continue
+            row = db.add_fam(fam[:-len('.npz')])
+            db.sums[row], db.sumsq[row], db.counts[row] = acc['sum'], acc['sumsq'], acc['count']
+            db.members[db.fams[row]] = set(acc['members'])
+            continue
+
+        ids, dcts = load_transforms(f'{direc}/{fam}/transform.npy')
+        if len(ids):
+            db.add_seqs(fam, ids, dcts)
+    db.save()
+
+    return db
+
+
+def main():
+    """Main builds, updates, or exports a DCT database.
+
+    args:
+        -db: directory of database
+        -build: directory of transforms or accumulators to build the database from
+        -add: family and transform file of sequences to add to the family
+        -rm: family and transform file of sequences to remove from the family
+        -drop: family to drop from the database
+        -export: file to save average DCTs to
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-db', type=str, default='data/esm2_17_875_db')
+    parser.add_argument('-build', type=str, default='')
+    parser.add_argument('-add', type=str, nargs=2, default=None)
+    parser.add_argument('-rm', type=str, nargs=2, default=None)
+    parser.add_argument('-drop', type=str, default='')
+    parser.add_argument('-export', type=str, default='')
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    args = parser.parse_args()
+
+    if args.build:
+        db = build_db(args.db, args.build, args.s1 * args.s2)
+    else:
+        db = DCTDatabase(args.db)
+
+    # Update families
+    if args.add:
+        db.add_seqs(args.add[0], *load_transforms(args.add[1]))
+    if args.rm:
+        db.remove_seqs(args.rm[0], *load_transforms(args.rm[1]))
+    if args.drop:
+        db.drop_fam(args.drop)
+    if args.add or args.rm or args.drop:
+        db.save()
+
+    if args.export:
+        np.save(args.export, db.to_array())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""This script defines functions for processing Pfam families in parallel. Families are split into
+chunks that are sent to a pool of processes, with only a few chunks in flight at once so results
+do not pile up in memory, and results are returned in the same order as the families were given.
+
+__author__ = "Ben Iovino"
+__date__ = "09/14/23"
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
+
+
+def run_chunk(func, chunk: list) -> list:
+    """Returns the result of calling a function on each family in a chunk.
+
+    :param func: function that takes a family name
+    :param chunk: list of family names
+    :return: list of tuples containing family name and result
+    """
+
+    return [(fam, func(fam)) for fam in chunk]
+
+
+def map_fams(func, fams: list, procs: int, chunk: int = 8):
+    """Yields the result of calling a function on each family, in the same order as fams. If
+    procs is greater than 1, families are processed by a pool of processes with at most two
+    chunks per process submitted at once.
+
+    :param func: picklable function that takes a family name (use functools.partial for args)
+    :param fams: list of family names
+    :param procs: number of processes
+    :param chunk: number of families sent to a process at once
+    :yield: tuple of family name and result
+    """
+
+    if procs <= 1:
+        for fam in fams:
+            yield fam, func(fam)
+        return
+
+    chunks = iter([fams[i:i+chunk] for i in range(0, len(fams), chunk)])
+    with ProcessPoolExecutor(procs) as pool:
+        pending = deque(pool.submit(run_chunk, func, c) for c in islice(chunks, 2 * procs))
+        while pending:
+            results = pending.popleft().result()
+            for c in islice(chunks, 1):  # Replace finished chunk with next one
+                pending.append(pool.submit(run_chunk, func, c))
+            yield from results
+
+
+def save_part(file: str, result):
+    """Saves the partial result of a family, replacing the old file only after the new one is
+    written so an interrupted build never leaves a partial result that looks finished.
+
+    :param file: path to partial result
+    :param result: array (saved with np.save) or dict of arrays (saved with np.savez)
+    """
+
+    with open(f'{file}.tmp', 'wb') as f:
+        if isinstance(result, dict):
+            np.savez(f, **result)
+        else:
+            np.save(f, result)
+    os.replace(f'{file}.tmp', file)
@@ -0,0 +1,221 @@
+"""This script defines the fasta index class, which stores the location of every sequence in a
+directory of family fasta files (data/full_seqs, data/families_nogaps, ...) so that a sequence can
+be read by its id, or sampled from its family, without parsing the family's whole file.
+
+The index is a directory of .npy files that are memory mapped when loaded. For each sequence it
+holds the file it is in, its byte offset and length, and a 64-bit hash of its id. Hashes are sorted
+so an id is found with a binary search.
+
+__author__ = "Ben Iovino"
+__date__ = "09/18/23"
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import numpy as np
+
+
+def hash_id(seqid: str) -> np.uint64:
+    """Returns a 64-bit hash of a sequence id.
+
+    :param seqid: sequence id
+    :return: hash of id
+    """
+
+    return np.frombuffer(hashlib.blake2b(seqid.encode(), digest_size=8).digest(), dtype='<u8')[0]
+
+
+class FastaIndex:
+    """This class stores the location of each sequence in a directory of family fasta files.
+    """
+
+
+    def __init__(self, path: str):
+        """Loads an index.
+
+        :param path: directory of index
+        """
+
+        arrs = {name: np.load(f'{path}/{name}.npy', mmap_mode='r') for name in
+                ['files', 'file_fams', 'file_start', 'offsets', 'lengths', 'hashes', 'order']}
+        self.files = [str(file) for file in arrs['files']]
+        self.file_fams = [str(fam) for fam in arrs['file_fams']]
+        self.file_start = arrs['file_start']  # first record of each file, and number of records
+        self.offsets = arrs['offsets']
+        self.lengths = arrs['lengths']
+        self.hashes = arrs['hashes']  # sorted hashes of sequence ids
+        self.order = arrs['order']  # record of each sorted hash
+        self.fams = {fam: i for i, fam in enumerate(self.file_fams)}
+
+
+    @classmethod
+    def build(cls, tree: str, path: str):
+        """Returns a new index of every sequence in a directory of family fasta files
+        ({tree}/{fam}/seqs.fa). Consensus sequences are not indexed.
+
+        :param tree: directory of families
+        :param path: directory to save index
+        :return: FastaIndex object
+        """
+
+        files, file_fams, file_start = [], [], [0]
+        offsets, lengths, hashes = [], [], []
+        for fam in sorted(os.listdir(tree)):
+            file = f'{tree}/{fam}/seqs.fa'
+            if not os.path.exists(file):
+                continue
+            for offset, length, seqid in scan_fasta(file):
+                offsets.append(offset)
+                lengths.append(length)
+                hashes.append(hash_id(seqid))
+            files.append(file)
+            file_fams.append(fam)
+            file_start.append(len(offsets))
+
+        # Sort hashes for binary search
+        hashes = np.array(hashes, dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        os.makedirs(path, exist_ok=True)
+        for name, arr in [('files', np.array(files)), ('file_fams', np.array(file_fams)),
+                          ('file_start', np.array(file_start, dtype=np.int64)),
+                          ('offsets', np.array(offsets, dtype=np.int64)),
+                          ('lengths', np.array(lengths, dtype=np.int64)),
+                          ('hashes', hashes[order]), ('order', order)]:
+            np.save(f'{path}/{name}.npy', arr)
+
+        return cls(path)
+
+
+    def file_of(self, rec: int) -> int:
+        """Returns the file that a record is in.
+
+        :param rec: record number
+        :return: file number
+        """
+
+        return int(np.searchsorted(self.file_start, rec, side='right')) - 1
+
+
+    def read(self, rec: int) -> tuple:
+        """Returns a record from its file.
+
+        :param rec: record number
+        :return: tuple of sequence id, sequence, and description
+        """
+
+        with open(self.files[self.file_of(rec)], 'rb') as file:
+            file.seek(int(self.offsets[rec]))
+            lines = file.read(int(self.lengths[rec])).decode('utf8').splitlines()
+        desc = lines[0][1:]
+
+        return desc.split()[0], ''.join(lines[1:]), desc
+
+
+    def fetch(self, seqid: str, fam: str = None) -> tuple:
+        """Returns the first record with a sequence id. The id can be the sequence id alone
+        (A0A1B2C3D4) or include its region (A0A1B2C3D4/10-120). A protein with domains in more
+        than one family has a record in each of them, so the family can be given to only return
+        the record from that family.
+
+        :param seqid: sequence id
+        :param fam: Pfam family to search (None to search every family)
+        :return: tuple of sequence id, sequence, and description (None if not found)
+        """
+
+        sid, _, region = seqid.partition('/')
+        key = hash_id(sid)
+        start = np.searchsorted(self.hashes, key, side='left')
+        end = np.searchsorted(self.hashes, key, side='right')
+        first, last = (0, len(self.offsets)) if fam is None else self.fam_range(fam)
+
+        # Check each record with the same hash in case of collisions
+        for rec in sorted(int(rec) for rec in self.order[start:end]):
+            if not first <= rec < last:
+                continue
+            record = self.read(rec)
+            desc = record[2].split('\t')
+            if desc[0] == sid and (not region or (len(desc) > 1 and desc[1] == region)):
+                return record
+
+        return None
+
+
+    def fam_range(self, fam: str) -> tuple:
+        """Returns the first and last (exclusive) record of a family.
+
+        :param fam: Pfam family
+        :return: tuple of record numbers
+        """
+
+        i = self.fams[fam]
+        return int(self.file_start[i]), int(self.file_start[i+1])
+
+
+    def fetch_fam(self, fam: str) -> list:
+        """Returns every record in a family.
+
+        :param fam: Pfam family
+        :return: list of tuples of sequence id, sequence, and description
+        """
+
+        start, end = self.fam_range(fam)
+        return [self.read(rec) for rec in range(start, end)]
+
+
+    def sample(self, fam: str, k: int = 1, rng: random.Random = random) -> list:
+        """Returns records chosen uniformly at random from a family, without replacement. Only
+        the chosen records are read.
+
+        :param fam: Pfam family
+        :param k: number of records (all of them if the family has fewer)
+        :param rng: random number generator
+        :return: list of tuples of sequence id, sequence, and description
+        """
+
+        start, end = self.fam_range(fam)
+        recs = rng.sample(range(start, end), min(k, end - start))
+        return [self.read(rec) for rec in recs]
+
+
+def scan_fasta(file: str):
+    """Yields the byte offset, byte length, and sequence id of each record in a fasta file,
+    skipping consensus sequences.
+
+    :param file: fasta file
+    :yield: tuple of offset, length, and sequence id
+    """
+
+    pos, start, seqid = 0, 0, None
+    with open(file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if seqid is not None:
+                    yield start, pos - start, seqid
+                seqid = line[1:].split()[0].decode('utf8')
+                seqid = None if seqid == 'consensus' else seqid
+                start = pos
+            pos += len(line)
+    if seqid is not None:
+        yield start, pos - start, seqid
+
+
+def main():
+    """Main builds an index for each directory of family fasta files, saved as {direc}.idx.
+
+    args:
+        -d: directories of families
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', type=str, nargs='+',
+                        default=['data/full_seqs', 'data/families_nogaps'])
+    args = parser.parse_args()
+
+    for tree in args.d:
+        FastaIndex.build(tree, f'{tree}.idx')
+
+
+if __name__ == '__main__':
+    main()
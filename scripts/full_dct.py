@@ -0,0 +1,240 @@
+"""This script builds the average DCT for each Pfam family using sequences from both the
+Pfam-A.seed and Pfam-A.full databases. Families are read one at a time and sequences are embedded
+in batches. Each DCT is added to a running sum for its family, so memory stays the same no matter
+how many sequences a family has. Accumulators are saved after every batch so an interrupted build
+can be resumed.
+
+__author__ = "Ben Iovino"
+__date__ = "09/12/23"
+"""
+
+import argparse
+import logging
+import os
+import numpy as np
+import torch
+from Bio import SeqIO
+from util import load_model, embed_batch, Transform
+
+log_filename = 'data/logs/full_dct.log'  #pylint: disable=C0103
+os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+logging.basicConfig(filename=log_filename, filemode='w',
+                     level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+def read_excluded(file: str) -> set:
+    """Returns a set of sequences that should not be added to any family, i.e. queries.
+
+    :param file: file with one query per line (fam/seq description)
+    :return: set of sequence descriptions
+    """
+
+    excluded = set()
+    if not file or not os.path.exists(file):
+        return excluded
+    with open(file, 'r', encoding='utf8') as f:
+        for line in f:
+            excluded.add(line.split('/', maxsplit=1)[1].strip('\n'))
+
+    return excluded
+
+
+def fam_seqs(fam: str, excluded: set):
+    """Yields sequences for a family, first from Pfam-A.seed and then from Pfam-A.full, skipping
+    excluded sequences and sequences from Pfam-A.full that were already read from Pfam-A.seed.
+
+    :param fam: Pfam family
+    :param excluded: set of sequence descriptions to skip
+    :yield: tuple of sequence description and sequence
+    """
+
+    seen = set()
+    for direc in ['data/families_nogaps', 'data/full_seqs']:
+        if not os.path.exists(f'{direc}/{fam}/seqs.fa'):
+            continue
+        with open(f'{direc}/{fam}/seqs.fa', 'r', encoding='utf8') as f:
+            for seq in SeqIO.parse(f, 'fasta'):
+                if seq.id == 'consensus' or seq.description in excluded:
+                    continue
+                if seq.description in seen:
+                    continue
+                seen.add(seq.description)
+                yield seq.description, str(seq.seq)
+
+
+def load_acc(file: str, dim: int) -> dict:
+    """Returns the accumulator for a family, either from file or a new one.
+
+    :param file: path to accumulator file
+    :param dim: length of the DCT vectors
+    :return: dict with sum, sum of squares, count, members, number of seqs read, and done flag
+    """
+
+    if os.path.exists(file):
+        acc = np.load(file, allow_pickle=True)
+        return {key: acc[key] for key in acc.files}
+
+    return {'sum': np.zeros(dim, dtype=np.int64), 'sumsq': np.zeros(dim, dtype=np.int64),
+            'count': np.int64(0), 'members': np.array([], dtype=object),
+            'read': np.int64(0), 'done': False}
+
+
+def save_acc(file: str, acc: dict):
+    """Saves the accumulator for a family, replacing the old file only after the new one is
+    written so a crash never leaves a partial accumulator.
+
+    :param file: path to accumulator file
+    :param acc: accumulator dict
+    """
+
+    with open(f'{file}.tmp', 'wb') as f:
+        np.savez(f, **acc)
+    os.replace(f'{file}.tmp', file)
+
+
+def add_batch(acc: dict, batch: list, tokenizer, model, device: str, args: argparse.Namespace):
+    """Embeds and transforms a batch of sequences and adds each DCT to the accumulator.
+
+    :param acc: accumulator dict
+    :param batch: list of tuples containing sequence description and sequence
+    :param tokenizer: tokenizer
+    :param model: encoder model
+    :param device: cpu or gpu
+    :param args: command line arguments
+    """
+
+    members = []
+    for embed in embed_batch(batch, tokenizer, model, device, args.e, args.l):
+        dct = Transform(embed.embed[0], embed.embed[1], None)
+        dct.quant_2D(args.s1, args.s2)
+        if dct.trans[1] is None:  # Sequence too small for transformation dimensions
+            continue
+        vec = dct.trans[1].astype(np.int64)
+        acc['sum'] += vec
+        acc['sumsq'] += vec * vec
+        members.append(dct.trans[0])
+
+    acc['count'] = np.int64(acc['count'] + len(members))
+    acc['members'] = np.concatenate((acc['members'], np.array(members, dtype=object)))
+    acc['read'] = np.int64(acc['read'] + len(batch))
+
+
+def build_fam(fam: str, excluded: set, tokenizer, model, device: str, args: argparse.Namespace):
+    """Adds the DCT of up to args.c sequences from a family to its accumulator, resuming from
+    the last saved batch if the family was only partially read.
+
+    :param fam: Pfam family
+    :param excluded: set of sequence descriptions to skip
+    :param tokenizer: tokenizer
+    :param model: encoder model
+    :param device: cpu or gpu
+    :param args: command line arguments
+    """
+
+    file = f'{args.o}/{fam}.npz'
+    acc = load_acc(file, args.s1 * args.s2)
+    if acc['done']:
+        logging.info('Skipping %s', fam)
+        return
+
+    # Sequences are always read in the same order, so skip the ones already read
+    batch = []
+    for i, seq in enumerate(fam_seqs(fam, excluded)):
+        if i < acc['read']:
+            continue
+        if acc['count'] + len(batch) >= args.c:
+            break
+        batch.append(seq)
+        if len(batch) == args.b:
+            add_batch(acc, batch, tokenizer, model, device, args)
+            save_acc(file, acc)
+            batch = []
+    if batch:
+        add_batch(acc, batch, tokenizer, model, device, args)
+
+    acc['done'] = True
+    save_acc(file, acc)
+    logging.info('Finished %s with %s sequences', fam, acc['count'])
+
+
+def fam_stats(acc: dict) -> tuple:
+    """Returns the average DCT and the variance of each coefficient for a family.
+
+    :param acc: accumulator dict
+    :return: tuple of average DCT (int) and variance (float)
+    """
+
+    count = int(acc['count'])
+    avg = acc['sum'] // count
+    var = acc['sumsq'] / count - (acc['sum'] / count) ** 2
+
+    return avg, var
+
+
+def merge_accs(args: argparse.Namespace):
+    """Saves the average DCT of every family with at least args.m sequences to a single file,
+    along with a second file holding the variance of each coefficient.
+
+    :param args: command line arguments
+    """
+
+    dcts, variances = [], []
+    for file in sorted(os.listdir(args.o)):
+        if not file.endswith('.npz'):
+            continue
+        fam = file[:-len('.npz')]
+        acc = load_acc(f'{args.o}/{file}', args.s1 * args.s2)
+        if not acc['done'] or acc['count'] < args.m:
+            logging.info('Not enough sequences in %s', fam)
+            continue
+        avg, var = fam_stats(acc)
+        dcts.append(Transform(fam, None, avg).trans)
+        variances.append(np.array([fam, var], dtype=object))
+
+    np.save(f'{args.o}.npy', dcts)
+    np.save(f'{args.o}_var.npy', variances)
+
+
+def main():
+    """Main goes through each family in data/full_seqs and adds the DCT of its sequences to a
+    running sum for that family, then averages them and saves all families to one file.
+
+    args:
+        -b: number of sequences to embed at once
+        -c: maximum number of sequences per family
+        -e: encoder model
+        -l: layer of model to use (for esm2 only)
+        -m: minimum number of sequences for a family to be saved
+        -o: directory for family accumulators (database saved as {o}.npy)
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+        -x: file of queries to exclude from families
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', type=int, default=16)
+    parser.add_argument('-c', type=int, default=500)
+    parser.add_argument('-e', type=str, default='esm2')
+    parser.add_argument('-l', type=int, default=17)
+    parser.add_argument('-m', type=int, default=10)
+    parser.add_argument('-o', type=str, default='data/dct_full')
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    parser.add_argument('-x', type=str, default='data/queries.txt')
+    args = parser.parse_args()
+
+    # Load tokenizer and encoder
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # pylint: disable=E1101
+    tokenizer, model = load_model(args.e, device)
+
+    os.makedirs(args.o, exist_ok=True)
+    excluded = read_excluded(args.x)
+    for i, fam in enumerate(sorted(os.listdir('data/full_seqs'))):
+        logging.info('Embedding %s, %s', fam, i)
+        build_fam(fam, excluded, tokenizer, model, device, args)
+
+    merge_accs(args)
+
+
+if __name__ == '__main__':
+    main()
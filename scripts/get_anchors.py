@@ -8,10 +8,13 @@ __date__ = "05/19/23"
 import argparse
 import logging
 import os
+from functools import partial
 from math import ceil
 import numpy as np
-from avg_embed import get_seqs, cons_pos, get_embed
+from avg_embed import get_seqs
+from cons_embed import cons_pos, load_embed, cons_index
 from util import Embedding
+from fam_pool import map_fams, save_part
 
 log_filename = 'data/logs/get_anchors.log'  #pylint: disable=C0103
 os.makedirs(os.path.dirname(log_filename), exist_ok=True)
@@ -19,93 +22,119 @@ logging.basicConfig(filename=log_filename, filemode='w',
                      level=logging.INFO, format='%(message)s')
 
 
-def embed_pos(positions: dict, embeddings: dict) -> dict:
-    """Returns a dictionary of embeddings corresponding to positions in the consensus sequence
-    of a Pfam family.
+def embed_pos(positions: dict) -> dict:
+    """Returns a dictionary of index maps where each alignment column is replaced by its position
+    in the average embedding of a Pfam family.
 
-    :param positions: dict where seq id is key with list of positions as value
-    :param embeddings: dict where seq id is key with list of embeddings as value
-    :return: dict where position is key with list of embeddings as value
+    :param positions: dict where seq id is key with tuple of columns and rows as value
+    :return: dict where seq id is key with tuple of average embedding positions and rows as value
     """
 
-    # Create a dict of lists where each list contains the embeddings for a position in the consensus
-    seq_embed = {}
-    for seqid, position in positions.items():  # Go through positions for each sequence
-        for pos in position:
-            if pos not in seq_embed:  # Initialize key and value
-                seq_embed[pos] = []
-            seq_embed[pos].append(embeddings[seqid][pos])  # Add embedding to list for that pos
+    # Columns without any embeddings are not included in the average embedding
+    counts = np.bincount(np.concatenate([cols for cols, _ in positions.values()]))
+    index = cons_index(counts)
 
-    # Sort dictionary by key (out of order for some reason)
-    seq_embed = dict(sorted(seq_embed.items()))
-
-    # Set key values to be from 0 to n
     cons_embed = {}
-    for i, embed in enumerate(seq_embed.values()):
-        cons_embed[i] = embed
+    for seqid, (cols, rows) in positions.items():
+        cons_embed[seqid] = (index[cols], rows)
 
     return cons_embed
 
 
-def get_cos_sim(family: str, embeddings: dict) -> list:
-    """Returns a dictionary of cosine similarities between the average embedding and each
-    individual embedding for that position.
+def get_cos_sim(
+        avg_embed: np.ndarray, positions: dict, embeddings: dict, block: int = 65536) -> list:
+    """Returns a list of average cosine similarities between the average embedding and each
+    individual embedding for that position. Embeddings are normalized and gathered into blocks of
+    rows so the similarities for many sequences are found with one row-wise product.
 
-    :param family: name of Pfam family
-    :param embeddings: dict where position is key with list of embeddings from each seq as value
+    :param avg_embed: average embedding of Pfam family
+    :param positions: dict where seq id is key with tuple of average embedding positions and rows
+    :param embeddings: dict where seq id is key with embedding as value
+    :param block: maximum number of embedding rows to gather at once
     :return: list of average cosine similarities for each position
     """
 
-    # Get average embedding
-    avg_embed = np.load(f'data/avg_embed/{family}/avg_embed.npy')
-
-    # Get cosine similarity between average embedding and each position
-    cos_sim = {}
-    avg_cos = []
-    for pos, embed in embeddings.items():
-        cos_sim[pos] = []
-        avg_vec = avg_embed[pos]  # Average embedding for that position
-
-        # Calculate cosine similarity between average embedding and each embedding for that position
-        for emb in embed:
-            sim = np.dot(avg_vec, emb) / (np.linalg.norm(avg_vec) * np.linalg.norm(emb))
-            cos_sim[pos].append(sim)
+    avg_unit = avg_embed / np.linalg.norm(avg_embed, axis=1, keepdims=True)
+    cos_sim = np.zeros(len(avg_embed), dtype=np.float64)
+    counts = np.zeros(len(avg_embed), dtype=np.int64)
+
+    # Split sequences into blocks of about block rows
+    blocks, curr, size = [], [], 0
+    for seqid, (pos, _) in positions.items():
+        curr.append(seqid)
+        size += len(pos)
+        if size >= block:
+            blocks.append(curr)
+            curr, size = [], 0
+    if curr:
+        blocks.append(curr)
+
+    # Find similarities for all rows in a block at once
+    for seqids in blocks:
+        pos = np.concatenate([positions[sid][0] for sid in seqids])
+        emb = np.concatenate([embeddings[sid][positions[sid][1]] for sid in seqids])
+        emb = emb / np.linalg.norm(emb, axis=1, keepdims=True)
+        sims = np.einsum('ij,ij->i', avg_unit[pos], emb)
+        cos_sim += np.bincount(pos, weights=sims, minlength=len(avg_embed))
+        counts += np.bincount(pos, minlength=len(avg_embed))
+
+    # Get average cosine similarity
+    avg_cos = cos_sim / counts
+
+    return list(avg_cos)
+
+
+def find_runs(avg_cos: np.ndarray, thresholds: np.ndarray) -> list:
+    """Returns the start and end (exclusive) of each run of consecutive positions with cosine
+    similarity greater than or equal to each threshold. Runs for every threshold are found at once
+    from the edges of a (thresholds x positions) boolean array.
+
+    :param avg_cos: array of average cosine similarities for each position
+    :param thresholds: array of thresholds
+    :return: list of tuples containing arrays of starts and ends, one tuple per threshold
+    """
 
-        # Get average cosine similarity
-        avg_cos.append(np.mean(cos_sim[pos]))
+    high = avg_cos[None, :] >= thresholds[:, None]
+    edges = np.diff(np.pad(high, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    level, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)  # same order as starts, one end for every start
 
-    return avg_cos
+    bounds = np.searchsorted(level, np.arange(len(thresholds) + 1))
+    return [(starts[a:b], ends[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
 
 
 def get_regions(
-        avg_cos: list, regions: dict, threshold: float, reg_length: int) -> dict:
+        avg_cos: np.ndarray, regions: dict, runs: tuple, reg_length: int) -> dict:
     """Adds a region to the dict if the average cosine similarity of the entire region is
     greater than the threshold.
 
-    :param avg_cos: list of average cosine similarities for each position
+    A region is only added once a position below the threshold follows it, so a run that reaches
+    the last position is never added. If the middle of a region is already in the dict, the region
+    is not added and is instead joined with the next run.
+
+    :param avg_cos: array of average cosine similarities for each position
     :param regions: dict where region is key with list of positions and average cosine similarity
-    :param threshold: minimum average cosine similarity for a position to be added to region
+    :param runs: tuple of arrays of starts and ends of runs above the threshold
     :param reg_length: minimum number of positions in a region
     :return: dict where region number is key with list of regions and average cosine similarity
     """
 
-    curr_region, in_region, sim_region = [], False, 0
-    for i, sim in enumerate(avg_cos):  # For each position in the embedding
+    curr_region, sim_region = [], 0
+    for start, end in zip(*runs):
+        if end == len(avg_cos):  # No position below threshold after this run
+            break
 
-        # If cosine similarity is high, add to current region
-        if sim >= (threshold):
-            curr_region.append(i)
-            in_region = True
-            sim_region += sim
+        # Add run to current region, summing similarities in order
+        curr_region = curr_region + list(range(start, end))
+        sim_region = np.cumsum(np.concatenate(([sim_region], avg_cos[start:end])))[-1]
 
-        # If cosine similarity is low, end current region
-        else:
-            if in_region and len(curr_region) >= reg_length:
-                mid = ceil(np.mean(curr_region))
-                if mid in regions:  # Skip if anchor already found for that position
-                    continue
-                regions[mid] = [curr_region, sim_region/len(curr_region)]
-            curr_region, in_region, sim_region = [], False, 0
+        # End current region
+        if len(curr_region) >= reg_length:
+            mid = ceil(np.mean(curr_region))
+            if mid in regions:  # Skip if anchor already found for that position
+                continue
+            regions[mid] = [curr_region, sim_region/len(curr_region)]
+        curr_region, sim_region = [], 0
 
     return regions
 
@@ -124,28 +153,29 @@ def determine_regions(avg_cos: list, num_anchors: int) -> dict:
     # Find continuous regions (start with >= 2 positions) of relatively high cosine similarity
     regions, num_regions, reg_length = {}, 0, 2
 
-    # Want at least num_anchors identified per family, may have to lower threshold to get them
+    # Threshold is lowered up to 10 times to find num_anchors, find runs for all of them at once
     mean, std, count = np.mean(avg_cos), np.std(avg_cos), 0
+    avg_cos = np.asarray(avg_cos)
+    all_runs = find_runs(avg_cos, mean + std * 0.5 ** np.arange(10))
     while num_regions < num_anchors and count < 10:
         if count > 3:  # If still not enough regions, lower minimum region length
             reg_length = 1
 
         # Get regions with high cosine similarity and filter out regions with same middle pos
-        regions = get_regions(avg_cos, regions, mean + std, reg_length)
+        regions = get_regions(avg_cos, regions, all_runs[count], reg_length)
 
         # Lower threshold and find more regions if not enough found
         num_regions = len(regions)
         count += 1
-        std *= 0.50
     logging.info('Regions: %s', regions)
 
     return regions
 
 
-def get_anchors(family: str, regions: dict) -> np.ndarray:
-    """Writes the anchor residues (embeddings) for each family to a file.
+def get_anchors(avg_embed: np.ndarray, regions: dict) -> np.ndarray:
+    """Returns the anchor residues (embeddings) for a family.
 
-    :param family: name of Pfam family
+    :param avg_embed: average embedding of Pfam family
     :param regions: dict where region is key with list of positions and average cosine similarity
     :return: array of anchor residues (embeddings)
     """
@@ -154,7 +184,6 @@ def get_anchors(family: str, regions: dict) -> np.ndarray:
     logging.info('Anchor positions: %s', list(regions.keys()))
 
     # Grab embeddings from average embedding
-    avg_embed = np.load(f'data/avg_embed/{family}/avg_embed.npy')
     anchor_embed = []
     for pos in list(regions.keys()):
         anchor_embed.append(avg_embed[pos])
@@ -162,45 +191,78 @@ def get_anchors(family: str, regions: dict) -> np.ndarray:
     return np.asarray(anchor_embed)
 
 
+def find_anchors(
+        avg_embed: np.ndarray, positions: dict, embeddings: dict, num: int) -> np.ndarray:
+    """Returns the anchor residues of a family, which are the positions in the average embedding
+    at the middle of the regions with the highest cosine similarity to the family's embeddings.
+
+    :param avg_embed: average embedding of Pfam family
+    :param positions: dict where seq id is key with tuple of columns and rows as value
+    :param embeddings: dict where seq id is key with embedding as value
+    :param num: number of anchor residues to find
+    :return: array of anchor residues (embeddings)
+    """
+
+    # Find regions of high cosine similarity to consensus embedding
+    cons_embed = embed_pos(positions)
+    avg_cos = get_cos_sim(avg_embed, cons_embed, embeddings)
+    regions = determine_regions(avg_cos, num)
+
+    # Sort by average cosine similarity, highest to lowest and take top num regions
+    regions = dict(sorted(regions.items(), key=lambda item: item[1][1], reverse=True))
+    regions = dict(list(regions.items())[:num])
+
+    return get_anchors(avg_embed, regions)
+
+
+def anchor_fam(family: str, args: argparse.Namespace) -> str:
+    """Saves the anchor residues for a Pfam family as a partial result, unless they were saved by
+    an earlier run.
+
+    :param family: name of Pfam family
+    :param args: argparse.Namespace object with number of anchors and directory of embeddings
+    :return: path to partial result
+    """
+
+    # Check if anchors already exist
+    part = f'data/anchors/{family}/anchors.npy'
+    if os.path.exists(part):
+        logging.info('Anchor residues already exist for %s', family)
+        return part
+    logging.info('Getting anchor for %s', family)
+
+    # Get sequences and their consensus positions
+    sequences = get_seqs(family)
+    positions = cons_pos(sequences)
+
+    # Get embeddings for each sequence in family and find anchors
+    embeddings = load_embed(f'{args.d}/{family}')
+    avg_embed = np.load(f'data/avg_embed/{family}/avg_embed.npy')
+    anchor_embed = find_anchors(avg_embed, positions, embeddings, args.a)
+    anchor_embed = Embedding(family, None, anchor_embed)
+    os.makedirs(f'data/anchors/{family}', exist_ok=True)
+    save_part(part, anchor_embed.embed)
+
+    return part
+
+
 def main():
     """Main goes through each family with an average embedding and finds anchor residues for each
     family based on cosine similarity between each embedding in the family to the average embedding.
+    Families can be processed in parallel with -p, and the anchors for each family are saved
+    separately before being merged into one file.
     """
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', type=int, help='Number of anchor residues to find', default=3)
     parser.add_argument('-d', type=str, help='direc of embeds to avg', default='data/esm2_17_embed')
+    parser.add_argument('-p', type=int, help='Number of processes', default=1)
     args = parser.parse_args()
 
+    fams = sorted(os.listdir(args.d))
     anchors = []
-    for i, family in enumerate(os.listdir(args.d)):
-
-        # Check if anchors already exist
-        if os.path.exists(f'data/anchors/{family}/anchor_embed.txt'):
-            logging.info('Anchor residues already exist for %s, %s', family, i)
-            continue
-        logging.info('Getting anchor for %s, %s', family, i)
-
-        # Get sequences and their consensus positions
-        sequences = get_seqs(family)
-        positions = cons_pos(sequences)
-
-        # Get embeddings for each sequence in family and take only consensus positions
-        embeddings = get_embed(f'{args.d}/{family}', sequences)
-        cons_embed = embed_pos(positions, embeddings)
-
-        # Find regions of high cosine similarity to consensus embedding
-        avg_cos = get_cos_sim(family, cons_embed)  #pylint: disable=W0612
-        regions = determine_regions(avg_cos, args.a)
-
-        # Sort by average cosine similarity, highest to lowest and take top num regions
-        regions = dict(sorted(regions.items(), key=lambda item: item[1][1], reverse=True))
-        regions = dict(list(regions.items())[:args.a])
-
-        # Get anchor residues (embedding) for each sequence
-        anchor_embed = get_anchors(family, regions)
-        anchor_embed = Embedding(family, None, anchor_embed)
-        anchors.append(anchor_embed.embed)
+    for _, part in map_fams(partial(anchor_fam, args=args), fams, args.p):
+        anchors.append(np.load(part, allow_pickle=True))
 
     # Save anchors as one file
     np.save('data/anchors.npy', anchors, allow_pickle=True)
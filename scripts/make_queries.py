@@ -0,0 +1,134 @@
+"""This script builds the set of query sequences used by search.py, testing.py, and
+mmseqs_search.py. Pfam-A.fasta is read once and k sequences are picked from each family with
+reservoir sampling, so the query set is the same for every run with the same seed. The queries
+are written to a fasta manifest (data/queries.fa) that includes their sequences, along with a list
+of queries to leave out when building databases (data/queries.txt).
+
+__author__ = "Ben Iovino"
+__date__ = "09/19/23"
+"""
+
+import argparse
+import os
+import random
+from parse_fasta import format_seq, open_pfam, parse_id
+
+
+def sample_queries(pfam: str, k: int, seed: int) -> dict:
+    """Returns k sequences chosen uniformly at random from each family in a Pfam database file,
+    reading the file once. Families with k or fewer sequences keep all of them.
+
+    :param pfam: Pfam database file (can be gzipped)
+    :param k: number of queries per family
+    :param seed: seed for random number generator
+    :return: dict where key is family and value is list of tuples containing seq id and sequence
+    """
+
+    rng = random.Random(seed)
+    reservoirs, counts = {}, {}
+    slot, seq_id, fam, seq = None, '', '', []
+    with open_pfam(pfam) as file:
+        for line in file:
+
+            # ID line, new seq
+            if line.startswith('>'):
+                if slot is not None:  # Store previous seq if it was sampled
+                    reservoirs[fam][slot] = (seq_id, ''.join(seq))
+                seq_id, fam = parse_id(line)
+                seq = []
+
+                # Fill reservoir, then replace a random query with decreasing probability
+                count = counts.get(fam, 0)
+                counts[fam] = count + 1
+                if count < k:
+                    reservoirs.setdefault(fam, []).append(None)
+                    slot = count
+                else:
+                    slot = rng.randrange(count + 1)
+                    slot = slot if slot < k else None
+                continue
+
+            # Only keep sequence lines of sampled seqs
+            if slot is not None:
+                seq.append(line.strip())
+
+    # Store last seq
+    if slot is not None:
+        reservoirs[fam][slot] = (seq_id, ''.join(seq))
+
+    return reservoirs
+
+
+def write_queries(queries: dict, manifest: str, excluded: str):
+    """Writes queries to a fasta manifest and, if given a file, to a list of sequences to leave
+    out of databases (one fam/description per line).
+
+    :param queries: dict where key is family and value is list of tuples containing seq id and
+        sequence
+    :param manifest: fasta file to write queries to
+    :param excluded: file to write excluded sequences to (empty string to skip)
+    """
+
+    with open(manifest, 'w', encoding='utf8') as file:
+        for fam in sorted(queries):
+            for seq_id, seq in queries[fam]:
+                file.write(format_seq(seq_id, fam, seq))
+
+    if excluded:
+        with open(excluded, 'w', encoding='utf8') as file:
+            for fam in sorted(queries):
+                for seq_id, _ in queries[fam]:
+                    sid, region = seq_id.split('/')
+                    file.write(f'{fam}/{sid}\t{region}\t{fam}\n')
+
+
+def read_queries(manifest: str) -> list:
+    """Returns each query in a fasta manifest written by write_queries.
+
+    :param manifest: fasta file of queries
+    :return: list of tuples containing family, seq id, sequence, and description
+    """
+
+    queries, desc, seq = [], '', []
+    with open(manifest, 'r', encoding='utf8') as file:
+        for line in file:
+            if line.startswith('>'):
+                if desc:
+                    queries.append((desc.split('\t')[2], desc.split('\t')[0], ''.join(seq), desc))
+                desc, seq = line[1:].strip('\n'), []
+                continue
+            seq.append(line.strip())
+    if desc:
+        queries.append((desc.split('\t')[2], desc.split('\t')[0], ''.join(seq), desc))
+
+    return queries
+
+
+def main():
+    """Main samples queries from Pfam-A.fasta and writes the query manifest and exclusion list.
+
+    args:
+        -f: Pfam database file
+        -k: number of queries per family
+        -o: query manifest
+        -r: seed for random number generator
+        -x: list of sequences to leave out of databases (empty string to skip)
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', type=str, default='data/Pfam-A.fasta')
+    parser.add_argument('-k', type=int, default=1)
+    parser.add_argument('-o', type=str, default='data/queries.fa')
+    parser.add_argument('-r', type=int, default=0)
+    parser.add_argument('-x', type=str, default='data/queries.txt')
+    args = parser.parse_args()
+
+    pfam = args.f
+    if not os.path.exists(pfam) and os.path.exists(f'{pfam}.gz'):
+        pfam = f'{pfam}.gz'
+    queries = sample_queries(pfam, args.k, args.r)
+    write_queries(queries, args.o, args.x)
+
+
+if __name__ == '__main__':
+    main()
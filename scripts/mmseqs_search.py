@@ -1,14 +1,23 @@
-"""Searches fasta queries against a db using mmseqs2
+"""Searches fasta queries against a db using mmseqs2. Every query in the manifest is written to one
+fasta file and searched with a single createdb/search/convertalis run against a target database
+that is built once, instead of one mmseqs run per query. The best hit of each query is read from
+the .m8 output in one pass and written to a JSONL file with the same fields as search.py, so
+parse_logs.py can compare both searches.
 
 __author__ = "Ben Iovino"
 __date__ = "08/18/23"
 """
 
-import datetime
+import argparse
+import json
 import logging
 import os
-from Bio import SeqIO
-
+import subprocess
+import tempfile
+import time
+from make_queries import read_queries
+import timing
+from timing import stage
 
 log_filename = 'data/logs/mmseqs.log'  #pylint: disable=C0103
 os.makedirs(os.path.dirname(log_filename), exist_ok=True)
@@ -16,42 +25,132 @@ logging.basicConfig(filename=log_filename, filemode='w',
                      level=logging.INFO, format='%(message)s')
 
 
-def main():
+def write_fasta(queries: list, file: str):
+    """Writes queries to a fasta file, using their position in the list as their id so they are
+    unique for mmseqs.
+
+    :param queries: list of tuples containing family, seq id, sequence, and description
+    :param file: fasta file to write queries to
+    """
+
+    with open(file, 'w', encoding='utf8') as f:
+        for i, query in enumerate(queries):
+            f.write(f'>{i}\n{query[2]}\n')
+
+
+def run_mmseqs(args: list):
+    """Runs an mmseqs command, logging its output if it fails.
+
+    :param args: mmseqs binary and its arguments
+    """
+
+    result = subprocess.run(args, capture_output=True, text=True, check=False)
+    if result.returncode != 0:
+        logging.error('%s failed:\n%s%s', ' '.join(args), result.stdout, result.stderr)
+        result.check_returncode()
 
-    # Read queries.txt and get fasta file
-    queries = []
-    with open('data/queries.txt', 'r', encoding='utf8') as f:
-        for line in f:
-            queries.append(line.strip())
 
-    hit_count = 0
-    for i, query in enumerate(queries):
-        fam = query.split('/')[0]
-        seq = query.split('/')[1].split()[0]
+def search_queries(args: argparse.Namespace, query_fa: str, m8: str):
+    """Searches a fasta file of queries against the target database and writes the alignments to
+    an .m8 file. The target database is built from a fasta file if it does not exist.
 
-        with open(f'data/families_nogaps/{fam}/seqs.fa', 'r', encoding='utf8') as f:
-            for record in SeqIO.parse(f, 'fasta'):
-                if record.id == seq:
-                    query = record
+    :param args: argparse.Namespace object with mmseqs binary, databases, and threads
+    :param query_fa: fasta file of queries
+    :param m8: file to write alignments to
+    """
 
-                    # Write query to file
-                    with open('data/query.fa', 'w', encoding='utf8') as f:
-                        SeqIO.write(query, f, 'fasta')
+    if not os.path.exists(args.db):
+        logging.info('Creating target database %s from %s', args.db, args.tf)
+        os.makedirs(os.path.dirname(args.db) or '.', exist_ok=True)
+        with stage('target createdb'):
+            run_mmseqs([args.m, 'createdb', args.tf, args.db])
 
-        # Search db with mmseqs
-        #os.system('mmseqs easy-search data/query.fa data/Pfam-A_seed_noq.fasta alnRes.m8 tmp/')
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(m8) or '.') as tmp:
+        with stage('createdb'):
+            run_mmseqs([args.m, 'createdb', query_fa, f'{tmp}/queryDB'])
+        with stage('search'):
+            run_mmseqs([args.m, 'search', f'{tmp}/queryDB', args.db, f'{tmp}/resultDB',
+                        f'{tmp}/tmp', '--threads', str(args.p)])
+        with stage('convertalis'):
+            run_mmseqs([args.m, 'convertalis', f'{tmp}/queryDB', args.db, f'{tmp}/resultDB', m8,
+                        '--threads', str(args.p)])
 
-        # Read alnRes.m8 and get top hit
-        with open('/home/ben/Desktop/alnRes.m8', 'r', encoding='utf8') as f:
-            for line in f:
-                top_hit = line.split()[1]
-                break
 
-            if top_hit.split('/')[0] == fam:
-                hit_count += 1
-        logging.info(f'{datetime.datetime.now()}\t{fam}/{query.id}\t{top_hit}\t{hit_count}/{i+1}')
+def best_hits(m8: str) -> dict:
+    """Returns the hit with the highest bit score for each query in an .m8 file, reading it one
+    line at a time.
+
+    :param m8: file of alignments in BLAST tabular format
+    :return: dict where key is query id and value is tuple of target and bit score
+    """
+
+    hits = {}
+    with open(m8, 'r', encoding='utf8') as f:
+        for line in f:
+            fields = line.split('\t')
+            if len(fields) < 12:  # Skip incomplete lines
+                continue
+            bits = float(fields[11])
+            if fields[0] not in hits or bits > hits[fields[0]][1]:
+                hits[fields[0]] = (fields[1], bits)
+
+    return hits
+
+
+def main():
+    """Main writes every query to one fasta file, searches them against the target database with
+    mmseqs, and writes the best hit for each query to a JSONL file. Target sequences are named
+    fam/seq, so the family of a hit is the part of its name before the first '/'.
+
+    args:
+        -db: mmseqs target database (built from -tf if it does not exist)
+        -j: JSONL file to write results to
+        -m: mmseqs binary
+        -o: .m8 file to write alignments to
+        -p: number of threads
+        -q: query manifest from make_queries.py
+        -tf: fasta file of target sequences
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-db', type=str, default='data/mmseqs/targetDB')
+    parser.add_argument('-j', type=str, default='data/logs/mmseqs.jsonl')
+    parser.add_argument('-m', type=str, default='mmseqs')
+    parser.add_argument('-o', type=str, default='data/mmseqs/alnRes.m8')
+    parser.add_argument('-p', type=int, default=os.cpu_count())
+    parser.add_argument('-q', type=str, default='data/queries.fa')
+    parser.add_argument('-tf', type=str, default='data/Pfam-A_seed_noq.fasta')
+    args = parser.parse_args()
+
+    # Search all queries at once
+    timing.enable()
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(args.o) or '.', exist_ok=True)
+    with stage('load queries'):
+        queries = read_queries(args.q)
+        write_fasta(queries, f'{args.o}.fa')
+    search_queries(args, f'{args.o}.fa', args.o)
+    with stage('parse'):
+        hits = best_hits(args.o)
+    elapsed = time.perf_counter() - start
+
+    # Stages run once for all queries, so each query is given an equal share of their time
+    times = {name: sum(secs) / max(len(queries), 1) for name, secs in timing.TIMES.items()}
+    matches = 0
+    with open(args.j, 'w', encoding='utf8') as jfile:
+        for i, query in enumerate(queries):
+            target, bits = hits.get(str(i), (None, None))
+            fams = [target.split('/')[0]] if target else []
+            matches += fams[:1] == [query[0]]
+            record = {'query': query[1], 'fam': query[0], 'desc': query[3], 'stage': 'mmseqs',
+                      'results': [[target, bits]] if target else [], 'fams': fams,
+                      'times': times}
+            jfile.write(json.dumps(record) + '\n')
+
+    logging.info('TOTAL: Queries: %s, Matches: %s, No hits: %s, Queries/s: %.2f\n',
+                  len(queries), matches, len(queries) - len(hits), len(queries) / elapsed)
+    logging.info('TIMING:\n%s\n', timing.report())
 
 
 if __name__ == '__main__':
     main()
-
@@ -8,21 +8,24 @@ __date__ = "06/05/23"
 import csv
 import pickle
 import os
+import numpy as np
 
 
 def read_pfam(pfam: str):
     """Writes a dictionary to a file where the key is the Pfam clan and the value is a list of
-    families in that clan.
+    families in that clan. Also writes each family and the id of its clan (index in the list of
+    clans, -1 if the family is not in a clan) to data/clans.npz.
 
     :param pfam: Pfam database file
     """
 
     # Read clans db with csv reader
-    clans = {}
+    clans, fams = {}, []
     with open(pfam, 'r', encoding='utf8', errors='replace') as file:
         reader = csv.reader(file, delimiter='\t')
         for row in reader:
             clan = row[1]
+            fams.append((row[3], clan))
             if clan:  # If this family is a part of a clan, add family to clan dict
                 if clan in clans:
                     clans[clan].append(row[3])
@@ -33,6 +36,61 @@ def read_pfam(pfam: str):
     with open('data/clans.pkl', 'wb') as file:
         pickle.dump(clans, file)
 
+    # Save family -> clan id arrays
+    clan_names = list(clans.keys())
+    clan_rows = {clan: i for i, clan in enumerate(clan_names)}
+    np.savez('data/clans.npz', fams=np.array([fam for fam, _ in fams]),
+             ids=np.array([clan_rows.get(clan, -1) for _, clan in fams], dtype=np.int32),
+             clans=np.array(clan_names))
+
+
+def load_clans(file: str = 'data/clans.npz') -> dict:
+    """Returns a dict mapping each family to the id of its clan.
+
+    :param file: file written by read_pfam
+    :return: dict where key is family and value is clan id (-1 if not in a clan)
+    """
+
+    with np.load(file) as clans:
+        return dict(zip(clans['fams'].tolist(), clans['ids'].tolist()))
+
+
+def clan_ids(fams: list, fam_clans: dict) -> np.ndarray:
+    """Returns the clan id of each family in a list, e.g. the families of a DCT database in row
+    order.
+
+    :param fams: list of families
+    :param fam_clans: dict returned by load_clans
+    :return: array of clan ids (-1 if family is not in a clan)
+    """
+
+    return np.array([fam_clans.get(fam, -1) for fam in fams], dtype=np.int32)
+
+
+def clan_metrics(query_rows: np.ndarray, results_rows: np.ndarray, clans: np.ndarray) -> dict:
+    """Returns counts for matches, top n results, and same clan for all queries at once.
+
+    match: family is top result
+    top: family is in top n results, but not top result
+    clan: family is not in top n results, but top result is in the same clan
+    clan_top: family or another family in the same clan is in top n results
+
+    :param query_rows: row of each query's family (queries,), -1 if not in database
+    :param results_rows: rows of each query's top n results (queries x n), padded with -1
+    :param clans: clan id of each row, -1 if family is not in a clan
+    :return: dict of counts
+    """
+
+    query_clans = np.where(query_rows >= 0, clans[query_rows], -1)[:, None]
+    results_clans = np.where(results_rows >= 0, clans[results_rows], -1)
+    hits = (results_rows == query_rows[:, None]) & (results_rows >= 0)
+    same = (results_clans == query_clans) & (query_clans >= 0)
+    found = hits.any(axis=1)
+
+    return {'match': int(hits[:, 0].sum()), 'top': int((found & ~hits[:, 0]).sum()),
+            'clan': int((same[:, 0] & ~found).sum()),
+            'clan_top': int((found | same.any(axis=1)).sum()), 'total': len(query_rows)}
+
 
 def main():
     """Main detects if Pfam-A.full database is in directory. If not, it will download from Pfam
@@ -5,28 +5,110 @@ __author__ = "Ben Iovino"
 __date__ = "06/05/23"
 """
 
+import gzip
 import os
+from collections import OrderedDict
 
 
-def write_seq(seq_id: str, fam: str, seq: str):
-    """Writes the sequence to a file in the directory named after the family.
+class FamWriter:
+    """This class buffers sequences for each family and writes them to their family's fasta file
+    through a limited pool of open files, closing the least recently used file when it is full.
+    """
+
+
+    def __init__(self, direc: str, max_open: int = 512, max_buf: int = 1 << 28):
+        """Defines FamWriter class.
+
+        :param direc: directory to store families
+        :param max_open: maximum number of files open at once
+        :param max_buf: maximum number of characters buffered before all buffers are written
+        """
+
+        self.direc = direc
+        self.max_open = max_open
+        self.max_buf = max_buf
+        self.buffers, self.buf_size = {}, 0
+        self.handles = OrderedDict()
+        self.dirs = set(os.listdir(direc))  # family directories that already exist
+        self.opened = set()  # families whose file was opened during this run
+
+
+    def write(self, fam: str, text: str):
+        """Adds text to a family's buffer, writing every buffer if too much text is buffered.
+
+        :param fam: family name
+        :param text: text to write to family's file
+        """
+
+        self.buffers.setdefault(fam, []).append(text)
+        self.buf_size += len(text)
+        if self.buf_size >= self.max_buf:
+            self.flush()
+
+
+    def get_handle(self, fam: str):
+        """Returns an open file for a family. Files are truncated the first time they are opened
+        during a run and appended to after that.
+
+        :param fam: family name
+        :return: file object
+        """
+
+        if fam in self.handles:
+            self.handles.move_to_end(fam)
+            return self.handles[fam]
+
+        # Close least recently used file if too many are open
+        if len(self.handles) >= self.max_open:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+
+        if fam not in self.dirs:
+            os.makedirs(f'{self.direc}/{fam}', exist_ok=True)
+            self.dirs.add(fam)
+        mode = 'a' if fam in self.opened else 'w'
+        self.opened.add(fam)
+        file = f'{self.direc}/{fam}/seqs.fa'
+        self.handles[fam] = open(file, mode, encoding='utf8')  #pylint: disable=R1732
+
+        return self.handles[fam]
+
+
+    def flush(self):
+        """Writes every family's buffer to its file.
+        """
+
+        for fam, buffer in self.buffers.items():
+            self.get_handle(fam).write(''.join(buffer))
+        self.buffers, self.buf_size = {}, 0
+
+
+    def close(self):
+        """Writes every buffer and closes all files.
+        """
+
+        self.flush()
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = OrderedDict()
+
+
+def format_seq(seq_id: str, fam: str, seq: str) -> str:
+    """Returns the sequence as a fasta entry with newline characters every 50 chars.
 
     :param seq_id: sequence id
     :param fam: family name
     :param seq: fasta sequence
+    :return: fasta entry
     """
 
     # Split seq_id for file name
-    sid = seq_id.split('/')[0]
-    region = seq_id.split('/')[1]
+    sid, region = seq_id.split('/')[0], seq_id.split('/')[1]
 
     # Add newline characters to seq
-    seq = [seq[i:i+50] for i in range(0, len(seq), 50)]
-    seq = '\n'.join(seq)
+    seq = '\n'.join(seq[i:i+50] for i in range(0, len(seq), 50))
 
-    # Write to file
-    with open(f'data/full_seqs/{fam}/seqs.fa', 'a', encoding='utf8') as file:
-        file.write(f'{sid}\t{region}\t{fam}\n{seq}\n')
+    return f'>{sid}\t{region}\t{fam}\n{seq}\n'
 
 
 def parse_id(line: str) -> tuple:
@@ -37,20 +119,34 @@ def parse_id(line: str) -> tuple:
     """
 
     line = line.split()
-    seq_id = line[0]  # Seq id and region
+    seq_id = line[0][1:]  # Seq id and region, without '>'
     fam = line[2].split(';')[1]  # Take GF ID, not AC ID
 
     return seq_id, fam
 
 
-def read_pfam(pfam: str):
-    """Writes each sequence in Pfam-A.full database to a fasta file corresponding to the family.
+def open_pfam(pfam: str):
+    """Returns Pfam database file opened for reading, decompressing it if it is gzipped.
 
     :param pfam: Pfam database file
+    :return: file object
     """
 
-    seq_id, fam, seq = '', '', ''
-    with open(pfam, 'r', encoding='utf8', errors='replace') as file:
+    if pfam.endswith('.gz'):
+        return gzip.open(pfam, 'rt', encoding='utf8', errors='replace')
+    return open(pfam, 'r', encoding='utf8', errors='replace')  #pylint: disable=R1732
+
+
+def read_pfam(pfam: str, direc: str):
+    """Writes each sequence in Pfam-A.full database to a fasta file corresponding to the family.
+
+    :param pfam: Pfam database file (can be gzipped)
+    :param direc: directory to store families
+    """
+
+    writer = FamWriter(direc)
+    seq_id, fam, seq = '', '', []
+    with open_pfam(pfam) as file:
         for line in file:
 
             # ID line, new seq
@@ -58,41 +154,45 @@ def read_pfam(pfam: str):
 
                 # Write previous seq to file
                 if seq_id:
-                    write_seq(seq_id, fam, seq)
+                    writer.write(fam, format_seq(seq_id, fam, ''.join(seq)))
 
                 # Get new seq id and family
                 seq_id, fam = parse_id(line)
-                if not os.path.exists(f'data/full_seqs/{fam}'):
-                    os.mkdir(f'data/full_seqs/{fam}')
-                seq = ''
+                seq = []
                 continue
 
             # Add to seq
-            seq += line.strip()
+            seq.append(line.strip())
+
+    # Write last seq to file
+    if seq_id:
+        writer.write(fam, format_seq(seq_id, fam, ''.join(seq)))
+    writer.close()
 
 
 def main():
-    """Main detects if Pfam-A.full database is in directory. If not, it will download from Pfam
-    website and unzip. Then, it will call read_pfam to parse each family into individual fasta
-    files.
+    """Main detects if Pfam-A.full database is in directory. If not, it will download it from the
+    Pfam website. Then, it will call read_pfam to parse each family into individual fasta files,
+    reading from the gzipped file if it was not unzipped.
     """
 
     # Read Pfam-A.fasta if it exists
     pfam_full = 'data/Pfam-A.fasta'
     if not os.path.exists(pfam_full):
-        print('Pfam-A.seed not found. Downloading from Pfam...')
+        pfam_full = 'data/Pfam-A.fasta.gz'
+    if not os.path.exists(pfam_full):
+        print('Pfam-A.fasta not found. Downloading from Pfam...')
         if not os.path.exists('data'):
             os.mkdir('data')
         os.system('wget -P data ' \
             'https://ftp.ebi.ac.uk/pub/databases/Pfam/releases/Pfam35.0/Pfam-A.fasta.gz')
-        os.system('gunzip data/Pfam-A.fasta.gz')
 
     # Create directories for families
     if not os.path.exists('data/full_seqs'):
         os.mkdir('data/full_seqs')
 
     # Parse all fasta seqs
-    read_pfam(pfam_full)
+    read_pfam(pfam_full, 'data/full_seqs')
 
 
 if __name__ == '__main__':
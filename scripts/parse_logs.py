@@ -6,8 +6,14 @@ __date__ = "07/25/23"
 
 import argparse
 import datetime
+import json
+from collections import Counter
+import numpy as np
 import matplotlib.pyplot as plt
 from Bio import SeqIO
+from parse_clans import load_clans
+
+TIME_BINS = np.logspace(-5, 3, 81)  # Edges of timing histogram bins, 10 us to 1000 s
 
 
 def parse_search(file: str) -> dict:  #\\NOSONAR
@@ -63,17 +69,103 @@ def parse_search(file: str) -> dict:  #\\NOSONAR
     return results
 
 
-def missed_queries(results: dict):
+def read_results(file: str):
+    """Yields each record in a JSONL results file from search.py, one at a time.
+
+    :param file: path to JSONL results file
+    :yield: dict with query, family, stage, results, families of results, and times
+    """
+
+    with open(file, 'r', encoding='utf8') as rfile:
+        for line in rfile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def analyze_results(file: str, clans_file: str = '') -> dict:
+    """Returns accuracy, top n, clan, per family misses, and timing histograms for every query
+    in a JSONL results file. Records are read one at a time and only counts are kept, so memory
+    does not grow with the number of queries.
+
+    :param file: path to JSONL results file
+    :param clans_file: file from parse_clans.py (empty string to skip clan results)
+    :return: dict of counts, family counts (queries, misses), and histograms of each stage
+    """
+
+    fam_clans = load_clans(clans_file) if clans_file else {}
+    counts, stages = Counter(), Counter()
+    fams = {}  # family -> [queries, misses]
+    hists = {}  # stage -> counts in TIME_BINS
+    for rec in read_results(file):
+        for name, secs in rec['times'].items():
+            hist = hists.setdefault(name, np.zeros(len(TIME_BINS)+1, dtype=np.int64))
+            hist[np.searchsorted(TIME_BINS, secs)] += 1
+        stages[rec['stage']] += 1
+        if rec['stage'] == 'skipped':
+            continue
+
+        # Same counts as search.search_results, fams holds the family of every result (-t)
+        fam, results_fams = rec['fam'], rec['fams']
+        fam_counts = fams.setdefault(fam, [0, 0])
+        fam_counts[0] += 1
+        counts['total'] += 1
+        if results_fams and fam == results_fams[0]:
+            counts['match'] += 1
+            continue
+        fam_counts[1] += 1
+        if fam in results_fams:
+            counts['top'] += 1
+            continue
+        clan = fam_clans.get(fam, -1)
+        if results_fams and clan >= 0 and fam_clans.get(results_fams[0], -1) == clan:
+            counts['clan'] += 1
+
+    return {'counts': dict(counts), 'stages': dict(stages), 'fams': fams, 'hists': hists}
+
+
+def hist_percentile(hist: np.ndarray, pct: float) -> float:
+    """Returns an upper bound on a percentile of a timing histogram (upper edge of its bin).
+
+    :param hist: counts in TIME_BINS
+    :param pct: percentile (0-100)
+    :return: time in seconds
+    """
+
+    cum = np.cumsum(hist)
+    i = int(np.searchsorted(cum, cum[-1] * pct / 100))
+    return TIME_BINS[min(i, len(TIME_BINS)-1)]
+
+
+def print_analysis(analysis: dict):
+    """Prints the results of analyze_results.
+
+    :param analysis: dict returned by analyze_results
+    """
+
+    counts = analysis['counts']
+    total = max(counts.get('total', 0), 1)
+    print(f"Queries: {counts.get('total', 0)}, Skipped: {analysis['stages'].get('skipped', 0)}")
+    for name in ['match', 'top', 'clan']:
+        print(f'{name}: {counts.get(name, 0)} ({counts.get(name, 0)/total:.4f})')
+    missed = sorted(analysis['fams'].items(), key=lambda item: item[1][1], reverse=True)
+    print('Most missed families: ' + ', '.join(f'{fam} ({c[1]}/{c[0]})' for fam, c in missed[:10]))
+    for name, hist in analysis['hists'].items():
+        print(f'{name}: p50 <= {hist_percentile(hist, 50)*1000:.2f} ms, '
+              f'p95 <= {hist_percentile(hist, 95)*1000:.2f} ms, '
+              f'p99 <= {hist_percentile(hist, 99)*1000:.2f} ms')
+
+
+def missed_queries(file: str):
     """Plots information about the queries that were not found in a search.
 
-    :param results: dictionary where query is key and top result is value
+    :param file: path to JSONL results file from search.py
     """
 
     # Get family names of missed queries
     missed = []
-    for query, result in results.items():
-        if result[2] == 'incorrect':
-            missed.append(query.split('/', maxsplit=1)[0])
+    for rec in read_results(file):
+        if rec['stage'] != 'skipped' and rec['fams'] and rec['fams'][0] != rec['fam']:
+            missed.append(rec['fam'])
 
     # Read number of sequences in each missed family and their average length
     fams = {}
@@ -231,14 +323,19 @@ def compare_missed_queries(file1: str, file2: str) -> list:
 
 def main():
     """Main function parses log files from data directory for desired information.
+
+    args:
+        -d: JSONL results file from search.py
+        -c: file from parse_clans.py (empty string to skip clan results)
     """
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-d', type=str, default='data/logs/search.log')
+    parser.add_argument('-d', type=str, default='data/logs/search.jsonl')
+    parser.add_argument('-c', type=str, default='data/clans.npz')
     args = parser.parse_args()
 
-    results = parse_search(args.d)
-    missed_queries(results)
+    print_analysis(analyze_results(args.d, args.c))
+    missed_queries(args.d)
 
 
 if __name__ == '__main__':
@@ -5,8 +5,15 @@ __author__ = "Ben Iovino"
 __date__ = "05/01/23"
 """
 
+import argparse
+import gzip
 import os
-import regex as re
+from functools import partial
+from fam_pool import map_fams
+
+CONS_GAPS = str.maketrans('+-', 'XX')  # replace +/- with X for embedding purposes
+CONS_NOGAPS = str.maketrans('+-', 'XX', '.')
+NOGAPS = str.maketrans('', '', '.')
 
 
 def clean_fasta(seq: str, cons: bool, gaps: bool) -> str:
@@ -18,23 +25,12 @@ def clean_fasta(seq: str, cons: bool, gaps: bool) -> str:
     :return: string containing fasta sequence with newline characters
     """
 
-    if gaps is True:  # Gaps included
-        if cons is False:  # All other sequences
-            seq = '\n'.join(seq[i:i+50] for i in range(0, len(seq), 50))
-        else:  # Consensus sequence
-            seq = re.sub(r'[\+\-]', 'X', seq)  # replace +/- with X for embedding purposes
-            seq = '\n'.join(seq[i:i+50] for i in range(0, len(seq), 50))
-
-    else:  # Gaps are not included
-        if cons is False:  # All other sequences
-            seq = re.sub(r'\.', '', seq)
-            seq = '\n'.join(seq[i:i+50] for i in range(0, len(seq), 50))
-        else:  # Consensus sequence
-            seq = re.sub(r'[\+\-]', 'X', seq)  # replace +/- with X for embedding purposes
-            seq = re.sub(r'\.', '', seq)
-            seq = '\n'.join(seq[i:i+50] for i in range(0, len(seq), 50))
+    if cons is True:  # Consensus sequence
+        seq = seq.translate(CONS_GAPS if gaps else CONS_NOGAPS)
+    elif gaps is False:  # All other sequences, gaps are not included
+        seq = seq.translate(NOGAPS)
 
-    return seq
+    return '\n'.join(seq[i:i+50] for i in range(0, len(seq), 50))
 
 
 def write_fasta(family: str, seqs: list, gaps: bool, fam_dir: str):
@@ -46,7 +42,7 @@ def write_fasta(family: str, seqs: list, gaps: bool, fam_dir: str):
     :param fam_dir: name of directory to store families
     """
 
-    os.mkdir(f'{fam_dir}/{family}')
+    os.makedirs(f'{fam_dir}/{family}', exist_ok=True)
     with open(f'{fam_dir}/{family}/seqs.fa', 'w', encoding='utf8') as file:
         for line in seqs:
 
@@ -66,67 +62,123 @@ def write_fasta(family: str, seqs: list, gaps: bool, fam_dir: str):
                 file.write(f'>{seq_id}\t{region}\t{family}\n{seq}\n')
 
 
-def read_pfam(pfam: str, gaps: bool, fam_dir: str):
-    """Writes each sequence in Pfam-A.seed database to a fasta file corresponding to the family.
+def read_pfam(lines, fam_dirs: tuple) -> int:
+    """Writes each sequence in Pfam-A.seed database to a fasta file corresponding to the family,
+    once with gaps and once without, from the same block of lines for each family.
+
+    :param lines: iterable of lines from Pfam database file
+    :param fam_dirs: tuple of directories to store families with and without gaps
+    :return: number of families written
+    """
+
+    in_fam, seqs, count = False, [], 0  # Flag to indicate if we are in a family and list of seqs
+    for line in lines:
+
+        # Read until you reach #=GF ID
+        if line.startswith('#=GF ID'):
+            family = line.split()[2]
+            in_fam = True
+
+        # If in a family, read sequences and write each one to a file
+        elif in_fam:
+            if line.startswith('#'):  # Skip GR, GF, GS lines
+                if line.startswith('#=GC seq_cons'):  # Except for consensus seq
+                    seqs.append(line)
+                continue
+            if line.startswith('//'):  # End of family
+                write_fasta(family, seqs, True, fam_dirs[0])
+                write_fasta(family, seqs, False, fam_dirs[1])
+                in_fam, seqs, count = False, [], count + 1
+                continue
+            if line.strip():
+                seqs.append(line)
+
+    return count
+
+
+def fam_offsets(pfam: str, num: int) -> list:
+    """Returns byte ranges of an uncompressed Pfam database file that each contain up to num
+    families, split at the // line at the end of each family.
 
     :param pfam: Pfam database file
-    :param gaps: flag to indicate if gaps should be included in sequences
-    :param fam_dir: name of directory to store families
+    :param num: number of families in each range
+    :return: list of tuples containing start and end of each range
     """
 
-    with open(pfam, 'r', encoding='utf8', errors='replace') as file:
-        in_fam, seqs = False, []  # Flag to indicate if we are in a family and list to store seqs
+    offsets, pos, fams = [0], 0, 0
+    with open(pfam, 'rb') as file:
         for line in file:
+            pos += len(line)
+            if line.startswith(b'//'):
+                fams += 1
+                if fams % num == 0:
+                    offsets.append(pos)
+    if offsets[-1] != pos:
+        offsets.append(pos)
 
-            # Read until you reach #=GF ID
-            if line.startswith('#=GF ID'):
-                family = line.split()[2]
-                in_fam = True
-
-            # If in a family, read sequences and write each one to a file
-            elif in_fam:
-                if line.startswith('#'):  # Skip GR, GF, GS lines
-                    if line.startswith('#=GC seq_cons'):  # Except for consensus seq
-                        seqs.append(line)
-                        continue
-                    continue
-                if line.startswith('//'):  # End of family
-                    write_fasta(family, seqs, gaps, fam_dir)
-                    in_fam, seqs = False, []
-                    continue
-                seqs.append(line)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_range(rng: tuple, pfam: str, fam_dirs: tuple) -> int:
+    """Writes each family in a byte range of an uncompressed Pfam database file.
+
+    :param rng: tuple containing start and end of range
+    :param pfam: Pfam database file
+    :param fam_dirs: tuple of directories to store families with and without gaps
+    :return: number of families written
+    """
+
+    with open(pfam, 'rb') as file:
+        file.seek(rng[0])
+        block = file.read(rng[1] - rng[0])
+    lines = block.decode('utf8', errors='replace').splitlines(keepends=True)
+
+    return read_pfam(lines, fam_dirs)
 
 
 def main():
     """Main detects if Pfam-A.seed database is in directory. If not, it will download from Pfam
-    website and unzip. Then, it will call read_pfam to parse each family into individual fasta
-    files.
+    website. Then, it will call read_pfam to parse each family into individual fasta files,
+    reading the gzipped file if it was not unzipped. An unzipped file can be split at the end
+    of families and parsed by multiple processes.
+
+    args:
+        -p: number of processes (only for unzipped Pfam-A.seed)
     """
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', type=int, default=1)
+    args = parser.parse_args()
+
     # Read Pfam-A.seed if it exists
     pfam_seed = 'data/Pfam-A.seed'
-    if not os.path.exists('data/Pfam-A.seed'):
+    if not os.path.exists(pfam_seed):
+        pfam_seed = 'data/Pfam-A.seed.gz'
+    if not os.path.exists(pfam_seed):
         print('Pfam-A.seed not found. Downloading from Pfam...')
         if not os.path.exists('data'):
             os.mkdir('data')
         os.system('wget -P data ' \
              'https://ftp.ebi.ac.uk/pub/databases/Pfam/releases/Pfam35.0/Pfam-A.seed.gz')
-        os.system('gunzip data/Pfam-A.seed.gz')
 
     # Create directories for families
-    fam_gaps, fam_nogaps = 'data/families_gaps', 'data/families_nogaps'
-    if not os.path.exists(fam_gaps):
-        os.mkdir(fam_gaps)
-    if not os.path.exists(fam_nogaps):
-        os.mkdir(fam_nogaps)
-
-    # Parse once with gaps and once without
-    for gaps in [True, False]:
-        if gaps is True:
-            fam_dir = fam_gaps
-        else:
-            fam_dir = fam_nogaps
-        read_pfam(pfam_seed, gaps, fam_dir)
+    fam_dirs = ('data/families_gaps', 'data/families_nogaps')
+    for fam_dir in fam_dirs:
+        if not os.path.exists(fam_dir):
+            os.mkdir(fam_dir)
+
+    # Parse once, writing families with and without gaps
+    if args.p > 1 and not pfam_seed.endswith('.gz'):
+        ranges = fam_offsets(pfam_seed, 64)
+        func = partial(read_range, pfam=pfam_seed, fam_dirs=fam_dirs)
+        for _ in map_fams(func, ranges, args.p):
+            continue
+        return
+    if args.p > 1:
+        print('Pfam-A.seed is gzipped, parsing with one process...')
+    opener = gzip.open if pfam_seed.endswith('.gz') else open
+    with opener(pfam_seed, 'rt', encoding='utf8', errors='replace') as file:
+        read_pfam(file, fam_dirs)
 
 
 if __name__ == "__main__":
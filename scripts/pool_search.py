@@ -0,0 +1,229 @@
+"""This script searches anchors with a smaller query embedding. Embedding.search compares every
+anchor to every residue of the query, so its time grows with the length of the query. Instead,
+the query can be pooled over windows of residues (mean or max of each window), or a first pass
+can compare anchors to the mean of each window and keep only the residues in the windows closest
+to each anchor (cand). The top families from the smaller query are then rescored with every
+residue of the query, so their scores are exact.
+
+Running this script embeds the queries in the manifest and prints how the results and time per
+query of each pooling method compare to searching with every residue.
+
+__author__ = "Ben Iovino"
+__date__ = "09/29/23"
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+from scipy.spatial.distance import cdist
+from make_queries import read_queries
+from shm_db import stack_anchors
+from util import load_model, embed_batch
+
+
+def anchor_block(names: np.ndarray, anchors: np.ndarray, offsets: np.ndarray) -> tuple:
+    """Returns the anchors of every family stacked into one block (shm_db.stack_anchors, or the
+    arrays hosted by shm_db.py) with the row of each family, built once before searching.
+
+    :param names: array of families
+    :param anchors: anchors of every family (total anchors x dim)
+    :param offsets: first anchor of each family (families+1)
+    :return: tuple of dict of family rows, families, anchors, and offsets
+    """
+
+    return {str(fam): i for i, fam in enumerate(names)}, names, anchors, offsets
+
+
+def pool_windows(embed: np.ndarray, size: int, method: str) -> np.ndarray:
+    """Returns the mean or max of each window of residues in an embedding. The last window is
+    shorter if the length is not a multiple of size.
+
+    :param embed: embedding (length x dim)
+    :param size: number of residues in each window
+    :param method: mean or max
+    :return: pooled embedding (windows x dim)
+    """
+
+    starts = np.arange(0, len(embed), size)
+    if method == 'max':
+        return np.maximum.reduceat(embed, starts, axis=0)
+
+    return np.add.reduceat(embed, starts, axis=0) / np.diff(np.append(starts, len(embed)))[:, None]
+
+
+def family_rows(block: tuple, fams: list) -> np.ndarray:
+    """Returns the rows of the families in a block that have anchors.
+
+    :param block: tuple returned by anchor_block()
+    :param fams: list of families (None for every family)
+    :return: array of rows in database order
+    """
+
+    rows, _, _, offsets = block
+    if fams is None:
+        idx = np.arange(len(rows))
+    else:
+        idx = np.sort([rows[fam] for fam in set(fams) if fam in rows]).astype(np.int64)
+
+    return idx[offsets[idx+1] > offsets[idx]]  # No anchors for family
+
+
+def anchor_scores(query: np.ndarray, block: tuple, fams: list) -> dict:
+    """Returns the score of each family, the same as Embedding.search: the average over its
+    anchors of the similarity to their most similar query row.
+
+    :param query: query rows (residues or pooled windows x dim)
+    :param block: tuple returned by anchor_block()
+    :param fams: list of families to score (None for every family)
+    :return: dict where keys are family names and values are scores, in database order
+    """
+
+    _, names, anchors, offsets = block
+    idx = family_rows(block, fams)
+    if not len(idx) or not len(query):
+        return {}
+    counts = offsets[idx+1] - offsets[idx]
+    sel = np.concatenate([np.arange(offsets[i], offsets[i+1]) for i in idx])
+
+    sims = 1 - cdist(anchors[sel], query, 'cityblock').min(axis=1)
+    scores = np.add.reduceat(sims, np.concatenate(([0], np.cumsum(counts)[:-1]))) / counts
+
+    return {str(names[i]): score for i, score in zip(idx, scores)}
+
+
+def candidate_rows(embed: np.ndarray, block: tuple, fams: list, size: int,
+                    keep: int) -> np.ndarray:
+    """Returns the residues in the windows closest to each anchor, found by comparing anchors to
+    the mean of each window.
+
+    :param embed: query embedding (length x dim)
+    :param block: tuple returned by anchor_block()
+    :param fams: list of families to search (None for every family)
+    :param size: number of residues in each window
+    :param keep: number of windows kept for each anchor
+    :return: array of residues
+    """
+
+    _, _, anchors, offsets = block
+    idx = family_rows(block, fams)
+    if not len(idx):
+        return np.arange(0)
+    if fams is not None:
+        anchors = anchors[np.concatenate([np.arange(offsets[i], offsets[i+1]) for i in idx])]
+    pooled = pool_windows(embed, size, 'mean')
+    dists = cdist(anchors, pooled, 'cityblock')
+    keep = min(keep, len(pooled))
+    windows = np.unique(np.argpartition(dists, keep-1, axis=1)[:, :keep])
+    res = windows[:, None] * size + np.arange(size)
+
+    return res[res < len(embed)]
+
+
+def pooled_search(embed: np.ndarray, block: tuple, top: int, fams: list,
+                   args: argparse.Namespace) -> dict:
+    """Searches a query against anchors with a pooled query embedding, and rescores the top
+    families with every residue.
+
+    :param embed: query embedding (length x dim)
+    :param block: tuple returned by anchor_block()
+    :param top: number of results to return
+    :param fams: optional list of specific families to search in db
+    :param args: argparse.Namespace object with pooling method (-pq), window size (-pw), windows
+        kept for each anchor (-pk), and number of families rescored (-pr)
+    :return: dict where keys are family names and values are similarity scores
+    """
+
+    embed = np.asarray(embed, dtype=np.float32)
+    if args.pq == 'cand':
+        query = embed[candidate_rows(embed, block, fams, args.pw, args.pk)]
+    else:
+        query = pool_windows(embed, args.pw, args.pq)
+    sims = anchor_scores(query, block, fams)
+    order = sorted(sims, key=sims.get, reverse=True)
+
+    # Rescore best families with every residue
+    rescored = anchor_scores(embed, block, order[:args.pr])
+    results = dict(sorted(rescored.items(), key=lambda item: item[1], reverse=True))
+    for fam in order[args.pr:]:
+        results[fam] = sims[fam]
+
+    return dict(list(results.items())[:top])
+
+
+def compare_pooling(queries: list, block: tuple, args: argparse.Namespace) -> dict:
+    """Returns how often the top family and the top results of a pooled search are the same as
+    searching with every residue, and the time per query of each search.
+
+    :param queries: list of query embeddings
+    :param block: tuple returned by anchor_block()
+    :param args: argparse.Namespace object with pooling parameters and number of results (-t)
+    :return: dict of results
+    """
+
+    same, found, secs = 0, 0, np.zeros((len(queries), 2))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        sims = anchor_scores(query, block, None)
+        exact = sorted(sims, key=sims.get, reverse=True)[:args.t]
+        secs[i, 0] = time.perf_counter() - start
+        start = time.perf_counter()
+        results = pooled_search(query, block, args.t, None, args)
+        secs[i, 1] = time.perf_counter() - start
+        same += next(iter(results)) == exact[0]
+        found += len(set(results) & set(exact))
+
+    return {'top1': same / len(queries), 'recall': found / (len(queries) * args.t),
+            'exact_ms': secs[:, 0].mean() * 1000, 'pooled_ms': secs[:, 1].mean() * 1000,
+            'pooled_p95_ms': np.percentile(secs[:, 1], 95) * 1000}
+
+
+def main():
+    """Main embeds the queries in the manifest and prints the recall and time per query of each
+    pooling method and window size against searching with every residue.
+
+    args:
+        -a: anchors from get_anchors.py
+        -e: encoder model
+        -l: layer of model to use (for esm2 only)
+        -m: pooling methods (mean, max, cand)
+        -n: number of queries
+        -pk: windows kept for each anchor (cand only)
+        -pr: number of top families rescored with every residue
+        -pw: window sizes
+        -q: query manifest from make_queries.py
+        -t: number of results for each query
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', type=str, default='data/anchors.npy')
+    parser.add_argument('-e', type=str, default='esm2')
+    parser.add_argument('-l', type=int, default=17)
+    parser.add_argument('-m', type=str, nargs='+', default=['mean', 'max', 'cand'])
+    parser.add_argument('-n', type=int, default=100)
+    parser.add_argument('-pk', type=int, default=2)
+    parser.add_argument('-pr', type=int, default=10)
+    parser.add_argument('-pw', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('-q', type=str, default='data/queries.fa')
+    parser.add_argument('-t', type=int, default=10)
+    args = parser.parse_args()
+
+    block = anchor_block(*stack_anchors(np.load(args.a, allow_pickle=True)))
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # pylint: disable=E1101
+    tokenizer, model = load_model(args.e, device)
+    seqs = [(query[1], query[2]) for query in read_queries(args.q)[:args.n]]
+    queries = [embed.embed[1] for i in range(0, len(seqs), 16)
+               for embed in embed_batch(seqs[i:i+16], tokenizer, model, device, args.e, args.l)]
+
+    sizes = args.pw
+    for method in args.m:
+        for size in sizes:
+            args.pq, args.pw = method, size
+            res = compare_pooling(queries, block, args)
+            print(f"{method} {size}: Top1: {res['top1']:.4f}, "
+                  f"Recall@{args.t}: {res['recall']:.4f}, exact {res['exact_ms']:.3f} ms/query, "
+                  f"pooled {res['pooled_ms']:.3f} ms/query (p95 {res['pooled_p95_ms']:.3f})")
+
+
+if __name__ == '__main__':
+    main()
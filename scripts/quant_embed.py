@@ -0,0 +1,278 @@
+"""This script stores average embeddings and anchor embeddings as int8 instead of float32. Each
+vector (row) is quantized separately with its own scale and zero point, so a vector is
+reconstructed as scale * (codes - zero), and takes a quarter of the memory it did before.
+
+Anchors are searched without reconstructing them. Scales are powers of two, so only a few
+different scales are used across all anchors. The query is put on the grid of each scale once
+(divided by the scale), each anchor's codes are shifted by its zero point, and the Manhattan
+distance between a residue and an anchor is the scale times the distance between their integer
+values, computed with int16 arithmetic. The top families can then be rescored with the
+reconstructed anchors. Running this script quantizes the anchors (and average embeddings with -ae)
+and prints how much the results of Embedding.search change for the queries in the manifest.
+
+__author__ = "Ben Iovino"
+__date__ = "09/27/23"
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from scipy.spatial.distance import cdist
+from make_queries import read_queries
+from util import load_model, embed_batch
+
+GRID = 2**14  # Integer values are clipped to +/- GRID so differences fit in int16
+
+
+def quantize(vecs: np.ndarray) -> tuple:
+    """Returns int8 codes of each row of an array with the scale and zero point of each row. The
+    scale is the smallest power of two that fits the row's range in 256 codes. An empty array
+    (family with no anchors) gives empty codes.
+
+    :param vecs: array of vectors (n x dim)
+    :return: tuple of codes (n x dim), scales (n,), and zero points (n,)
+    """
+
+    vecs = np.atleast_2d(vecs).astype(np.float64)
+    if not vecs.size:
+        return np.empty((0, vecs.shape[1]), np.int8), np.empty(0, np.float32), np.empty(0, np.int32)
+    low, high = vecs.min(axis=1), vecs.max(axis=1)
+    step = (high - low) / 255
+    step[step == 0] = 1  # Constant vectors
+    scale = np.exp2(np.ceil(np.log2(step)))
+    zero = np.rint(-128 - low / scale).astype(np.int32)
+    codes = np.clip(np.rint(vecs / scale[:, None]) + zero[:, None], -128, 127).astype(np.int8)
+
+    return codes, scale.astype(np.float32), zero
+
+
+def dequantize(codes: np.ndarray, scale: np.ndarray, zero: np.ndarray) -> np.ndarray:
+    """Returns the vectors reconstructed from int8 codes.
+
+    :param codes: int8 codes (n x dim)
+    :param scale: scale of each row (n,)
+    :param zero: zero point of each row (n,)
+    :return: array of vectors (n x dim)
+    """
+
+    return (scale[:, None] * (codes.astype(np.int32) - zero[:, None])).astype(np.float32)
+
+
+def quantize_db(anchor_db: np.ndarray) -> np.ndarray:
+    """Returns an anchor database (get_anchors.py) with the anchors of each family quantized.
+    Families with no anchors are kept with empty codes, and are skipped when searched.
+
+    :param anchor_db: array of family names and anchor embeddings
+    :return: array of family names, codes, scales, and zero points
+    """
+
+    q8_db = np.empty((len(anchor_db), 4), dtype=object)
+    for i, (fam, anchors) in enumerate(anchor_db):
+        q8_db[i] = [fam, *quantize(anchors)]
+
+    return q8_db
+
+
+def query_grid(query: np.ndarray, scale: np.float32, grids: dict) -> np.ndarray:
+    """Returns a query embedding put on the grid of a scale, computed once for each scale.
+
+    :param query: query embedding (length x dim)
+    :param scale: scale of anchor
+    :param grids: dict where key is scale and value is query on its grid
+    :return: query on grid (length x dim)
+    """
+
+    grid = grids.get(scale)
+    if grid is None:
+        grid = np.clip(np.rint(query * (1 / scale)), -GRID, GRID).astype(np.int16)
+        grids[scale] = grid
+
+    return grid
+
+
+def anchor_sims(query: np.ndarray, codes: np.ndarray, scale: np.ndarray, zero: np.ndarray,
+                 grids: dict, buf: np.ndarray) -> np.ndarray:
+    """Returns the similarity of each anchor to its most similar query residue, computed with
+    integer arithmetic. Query residues are not clipped to the anchor's range, so values outside
+    of it still add their full distance.
+
+    :param query: query embedding (length x dim)
+    :param codes: int8 codes of anchors (anchors x dim)
+    :param scale: scale of each anchor
+    :param zero: zero point of each anchor
+    :param grids: dict of query on the grid of each scale, shared by every family for one query
+    :param buf: int16 array the size of the query for differences
+    :return: array of similarities (anchors,)
+    """
+
+    anchors = np.clip(codes.astype(np.int32) - zero[:, None], -GRID, GRID).astype(np.int16)
+    dists = np.empty(len(codes))
+    for i, (anchor, anc_scale) in enumerate(zip(anchors, scale)):
+        np.subtract(query_grid(query, anc_scale, grids), anchor, out=buf)
+        dists[i] = np.abs(buf, out=buf).sum(axis=1, dtype=np.int32).min() * anc_scale
+
+    return 1 - dists
+
+
+def search_q8(query: np.ndarray, q8_db: np.ndarray, top: int, fams: list, rerank: int) -> dict:
+    """Searches a query embedding against a quantized anchor database, scoring families the same
+    way as Embedding.search (average similarity of each anchor to its most similar residue) with
+    integer codes.
+
+    :param query: query embedding (length x dim)
+    :param q8_db: array of family names, codes, scales, and zero points
+    :param top: number of results to return
+    :param fams: optional list of specific families to search in db
+    :param rerank: number of top families rescored with reconstructed anchors (0 for none)
+    :return: dict where keys are family names and values are similarity scores
+    """
+
+    query = np.asarray(query, dtype=np.float32)
+    fams = None if fams is None else set(fams)
+    sims, rows, grids = {}, {}, {}
+    buf = np.empty(query.shape, dtype=np.int16)
+    for fam, codes, scale, zero in q8_db:
+        if (fams is not None and fam not in fams) or not len(codes):  # No anchors for family
+            continue
+        rows[fam] = (codes, scale, zero)
+        sims[fam] = np.mean(anchor_sims(query, codes, scale, zero, grids, buf))
+    order = sorted(sims, key=sims.get, reverse=True)
+
+    # Rescore best families with reconstructed anchors
+    rescored = {}
+    for fam in order[:rerank]:
+        anchors = dequantize(*rows[fam])
+        rescored[fam] = np.mean(1 - cdist(anchors, query, 'cityblock').min(axis=1))
+    rescored = dict(sorted(rescored.items(), key=lambda item: item[1], reverse=True))
+    for fam in order[rerank:]:
+        rescored[fam] = sims[fam]
+
+    return dict(list(rescored.items())[:top])
+
+
+def float_search(query: np.ndarray, anchor_db: np.ndarray, top: int) -> dict:
+    """Returns the results of searching a query against float anchors, the same as
+    Embedding.search, with every anchor of a family compared at once.
+
+    :param query: query embedding (length x dim)
+    :param anchor_db: array of family names and anchor embeddings
+    :param top: number of results to return
+    :return: dict where keys are family names and values are similarity scores
+    """
+
+    sims = {}
+    for fam, anchors in anchor_db:
+        if not np.size(anchors):  # No anchors for family
+            continue
+        dists = cdist(np.atleast_2d(anchors), query, 'cityblock')
+        sims[fam] = np.mean(1 - dists.min(axis=1))
+
+    return dict(sorted(sims.items(), key=lambda item: item[1], reverse=True)[:top])
+
+
+def quantize_avgs(direc: str) -> tuple:
+    """Saves the quantized average embedding of each family next to its float average embedding
+    (avg_embed_q8.npz) and returns the reconstruction error.
+
+    :param direc: directory of average embeddings
+    :return: tuple of mean absolute error and mean cosine similarity of reconstructed rows
+    """
+
+    errors, cosines = [], []
+    for fam in sorted(os.listdir(direc)):
+        avg_embed = np.load(f'{direc}/{fam}/avg_embed.npy')
+        codes, scale, zero = quantize(avg_embed)
+        np.savez(f'{direc}/{fam}/avg_embed_q8.npz', codes=codes, scale=scale, zero=zero)
+        recon = dequantize(codes, scale, zero)
+        errors.append(np.abs(recon - avg_embed).mean())
+        cosines.append(np.mean(np.einsum('ij,ij->i', recon, avg_embed) /
+                               (np.linalg.norm(recon, axis=1) * np.linalg.norm(avg_embed, axis=1))))
+
+    return float(np.mean(errors)), float(np.mean(cosines))
+
+
+def compare_search(queries: list, anchor_db: np.ndarray, q8_db: np.ndarray, top: int,
+                    rerank: int) -> dict:
+    """Returns how often the top family and the top results of searching quantized anchors are
+    the same as searching float anchors, and the time per query of each search.
+
+    :param queries: list of query embeddings
+    :param anchor_db: array of family names and anchor embeddings
+    :param q8_db: quantized anchor database
+    :param top: number of results for each query
+    :param rerank: number of top families rescored with reconstructed anchors
+    :return: dict of results
+    """
+
+    same, found, secs = 0, 0, [0.0, 0.0]
+    for query in queries:
+        start = time.perf_counter()
+        flat = float_search(query, anchor_db, top)
+        secs[0] += time.perf_counter() - start
+        start = time.perf_counter()
+        results = search_q8(query, q8_db, top, None, rerank)
+        secs[1] += time.perf_counter() - start
+        same += next(iter(results)) == next(iter(flat))
+        found += len(set(results) & set(flat))
+
+    return {'top1': same / len(queries), 'recall': found / (len(queries) * top),
+            'float_ms': secs[0] / len(queries) * 1000, 'q8_ms': secs[1] / len(queries) * 1000}
+
+
+def main():
+    """Main quantizes the anchors (and average embeddings), saves them, and prints how the results
+    of searching them compare to searching the float anchors.
+
+    args:
+        -a: anchors from get_anchors.py
+        -ae: directory of average embeddings to quantize (empty string to skip)
+        -e: encoder model
+        -l: layer of model to use (for esm2 only)
+        -n: number of queries to compare searches with (0 to skip)
+        -o: file to save quantized anchors to
+        -q: query manifest from make_queries.py
+        -rr: numbers of top families rescored with reconstructed anchors
+        -t: number of results for each query
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', type=str, default='data/anchors.npy')
+    parser.add_argument('-ae', type=str, default='')
+    parser.add_argument('-e', type=str, default='esm2')
+    parser.add_argument('-l', type=int, default=17)
+    parser.add_argument('-n', type=int, default=100)
+    parser.add_argument('-o', type=str, default='data/anchors_q8.npy')
+    parser.add_argument('-q', type=str, default='data/queries.fa')
+    parser.add_argument('-rr', type=int, nargs='+', default=[0, 10])
+    parser.add_argument('-t', type=int, default=10)
+    args = parser.parse_args()
+
+    # Quantize and save anchors
+    anchor_db = np.load(args.a, allow_pickle=True)
+    q8_db = quantize_db(anchor_db)
+    np.save(args.o, q8_db, allow_pickle=True)
+    float_bytes = sum(np.atleast_2d(anchors).astype(np.float32).nbytes for _, anchors in anchor_db)
+    q8_bytes = sum(codes.nbytes + scale.nbytes + zero.nbytes for _, codes, scale, zero in q8_db)
+    print(f'Anchors: {float_bytes / 2**20:.1f} MB float32, {q8_bytes / 2**20:.1f} MB int8')
+    if args.ae:
+        error, cosine = quantize_avgs(args.ae)
+        print(f'Average embeddings: mean absolute error {error:.5f}, mean cosine {cosine:.6f}')
+    if not args.n:
+        return
+
+    # Embed queries and compare searches
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # pylint: disable=E1101
+    tokenizer, model = load_model(args.e, device)
+    seqs = [(query[1], query[2]) for query in read_queries(args.q)[:args.n]]
+    queries = [embed.embed[1] for i in range(0, len(seqs), 16)
+               for embed in embed_batch(seqs[i:i+16], tokenizer, model, device, args.e, args.l)]
+    for rerank in args.rr:
+        res = compare_search(queries, anchor_db, q8_db, args.t, rerank)
+        print(f"Rerank {rerank}: Top1: {res['top1']:.4f}, Recall@{args.t}: {res['recall']:.4f}, "
+              f"float {res['float_ms']:.3f} ms/query, int8 {res['q8_ms']:.3f} ms/query")
+
+
+if __name__ == '__main__':
+    main()
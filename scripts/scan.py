@@ -0,0 +1,271 @@
+"""This script scans full length proteins for Pfam domains. Each protein is embedded once and the
+DCT of every window of several widths along its embedding is searched against a database of
+family DCTs. Windows whose top results are the same family and overlap are merged into one domain
+call with the coordinates of the region they cover.
+
+The DCT of a window is the same as Transform.quant_2D, but written as matrix products. Keeping the
+first n coefficients of the DCT of a window and taking the iDCT of them is a linear map, so it
+is computed once for each window width (and once for the embedding dimension) and applied to
+every window at once.
+
+__author__ = "Ben Iovino"
+__date__ = "09/23/23"
+"""
+
+import argparse
+import logging
+import os
+import numpy as np
+import torch
+from Bio import SeqIO
+from scipy.fft import dct, idct
+from scipy.spatial.distance import cdist
+from numpy.lib.stride_tricks import sliding_window_view
+from util import load_model, get_fams, Embedding
+
+log_filename = 'data/logs/scan.log'  #pylint: disable=C0103
+os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+logging.basicConfig(filename=log_filename, filemode='w',
+                     level=logging.INFO, format='%(message)s')
+
+
+def idct_matrix(size: int, num: int) -> np.ndarray:
+    """Returns the matrix that keeps the first num coefficients of the DCT of a vector and
+    returns their iDCT, as in Transform.iDCT_quant.
+
+    :param size: length of vector
+    :param num: number of coefficients to keep
+    :return: matrix (num x size)
+    """
+
+    coeffs = dct(np.eye(size), type=2, norm='ortho', axis=0)[:num]
+    return idct(coeffs, type=2, norm='ortho', axis=0)
+
+
+def scale(arr: np.ndarray, axis: int) -> np.ndarray:
+    """Returns an array scaled between 0 and 1 along an axis, as in Transform.scale.
+
+    :param arr: array to be scaled
+    :param axis: axis to scale along
+    :return: scaled array
+    """
+
+    mini = arr.min(axis=axis, keepdims=True)
+    maxi = arr.max(axis=axis, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (arr - mini) / (maxi - mini)
+
+
+class WindowDCT:
+    """This class computes the DCT of every window along an embedding, keeping the matrices for
+    each window width so they are only computed once.
+    """
+
+
+    def __init__(self, s1: int, s2: int, dim: int):
+        """Defines WindowDCT class.
+
+        :param s1: first dimension of dct
+        :param s2: second dimension of dct
+        :param dim: embedding dimension
+        """
+
+        self.s1 = s1
+        self.s2 = s2
+        self.cols = idct_matrix(dim, s2)  # (s2 x dim)
+        self.rows = {}  # window width -> (s1 x width)
+
+
+    def transform(self, embed: np.ndarray, width: int, stride: int, batch: int = 64) -> tuple:
+        """Returns the start of each window along an embedding and its DCT.
+
+        :param embed: embedding without start/end tokens (length x dim)
+        :param width: window width
+        :param stride: distance between the start of each window
+        :param batch: number of windows transformed at once
+        :return: tuple of arrays, window starts and DCTs (windows x s1*s2)
+        """
+
+        if width not in self.rows:
+            self.rows[width] = idct_matrix(width, self.s1)
+        rows = self.rows[width]
+
+        # View of every window (windows x dim x width), no copies
+        windows = sliding_window_view(embed, width, axis=0)[::stride]
+        starts = np.arange(0, len(embed) - width + 1, stride)
+        dcts = np.empty((len(windows), self.s1 * self.s2), dtype=np.int8)
+        for i in range(0, len(windows), batch):
+            win = windows[i:i+batch].astype(np.float64)
+            first = scale(win @ rows.T, axis=2)  # (windows x dim x s1), scaled along s1
+            second = scale(np.einsum('nds,md->nsm', first, self.cols), axis=2)
+            dcts[i:i+batch] = (second * 127).astype('int8').reshape(len(win), -1)
+
+        return starts, dcts
+
+
+def scan_windows(embed: np.ndarray, wdct: WindowDCT, widths: list, stride: int) -> tuple:
+    """Returns the coordinates and DCT of every window of every width along an embedding. If the
+    protein is shorter than every width, the whole protein is one window.
+
+    :param embed: embedding with start/end tokens
+    :param wdct: WindowDCT object
+    :param widths: list of window widths
+    :param stride: distance between the start of each window
+    :return: tuple of arrays, window starts, window ends (exclusive), and DCTs
+    """
+
+    embed = embed[1:-1]
+    widths = [width for width in widths if width <= len(embed)] or [len(embed)]
+    starts, ends, dcts = [], [], []
+    for width in widths:
+        if width < wdct.s1:  # Too small to transform
+            continue
+        start, dct_arr = wdct.transform(embed, width, stride)
+        starts.append(start)
+        ends.append(start + width)
+        dcts.append(dct_arr)
+    if not dcts:
+        return np.array([], dtype=int), np.array([], dtype=int), None
+
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(dcts)
+
+
+def search_windows(dcts: np.ndarray, db: tuple, batch: int = 1024) -> tuple:
+    """Returns the top family and its similarity for each window.
+
+    :param dcts: array of window DCTs
+    :param db: tuple of family names and array of their DCTs (families x dim)
+    :param batch: number of windows searched at once
+    :return: tuple of arrays, top family row and similarity for each window
+    """
+
+    _, db_dcts = db
+    rows = np.empty(len(dcts), dtype=np.int64)
+    sims = np.empty(len(dcts))
+    for i in range(0, len(dcts), batch):
+        dists = cdist(dcts[i:i+batch], db_dcts, 'cityblock')
+        rows[i:i+batch] = dists.argmin(axis=1)
+        sims[i:i+batch] = 1 - dists[np.arange(len(dists)), rows[i:i+batch]]
+
+    return rows, sims
+
+
+def merge_hits(windows: tuple, hits: tuple, fams: list, min_windows: int, overlap: float) -> list:
+    """Returns domain calls from the top family of each window. Overlapping windows with the same
+    top family are merged into one region, and regions are kept from best to worst similarity if
+    they do not overlap a kept region by more than a fraction of their length.
+
+    :param windows: tuple of arrays, window starts and ends (exclusive)
+    :param hits: tuple of arrays, top family row and similarity for each window
+    :param fams: family of each database row
+    :param min_windows: minimum number of windows in a region
+    :param overlap: largest fraction of a region that can overlap a kept region
+    :return: list of tuples containing family, start, end (exclusive), similarity, and windows
+    """
+
+    starts, ends = windows
+    rows, sims = hits
+    names = np.array(fams, dtype=object)[rows]  # Clusters of a family are merged together
+    regions = []
+    for fam in sorted(set(names)):
+        idx = np.flatnonzero(names == fam)
+        idx = idx[np.lexsort((ends[idx], starts[idx]))]
+        region = None
+        for i in idx:
+            if region is not None and starts[i] < region[2]:  # Overlaps current region
+                region[2] = max(region[2], int(ends[i]))
+                region[3] = max(region[3], float(sims[i]))
+                region[4] += 1
+                continue
+            if region is not None:
+                regions.append(region)
+            region = [fam, int(starts[i]), int(ends[i]), float(sims[i]), 1]
+        regions.append(region)
+
+    # Keep best regions that do not overlap
+    calls = []
+    for region in sorted(regions, key=lambda reg: reg[3], reverse=True):
+        if region[4] < min_windows:
+            continue
+        length = region[2] - region[1]
+        if all(min(region[2], call[2]) - max(region[1], call[1]) <= overlap * length
+               for call in calls):
+            calls.append(region)
+
+    return [tuple(call) for call in sorted(calls, key=lambda call: call[1])]
+
+
+def load_db(file: str) -> tuple:
+    """Returns the family names and DCTs of a DCT database (.npy from avg_dct.py or full_dct.py),
+    with cluster names changed to their family.
+
+    :param file: DCT database
+    :return: tuple of list of families and array of DCTs (families x dim)
+    """
+
+    dct_db = np.load(file, allow_pickle=True)
+    fams = [get_fams({dct[0]: None})[0] for dct in dct_db]
+
+    return fams, np.stack([dct[1] for dct in dct_db])
+
+
+def main():
+    """Main embeds each protein in a fasta file, searches the DCT of windows along its embedding
+    against a DCT database, and writes the domains found to a tsv file (query, family, start, end,
+    similarity, windows). Coordinates are 1-based and inclusive.
+
+    args:
+        -dct: database of dct vectors
+        -e: encoder model
+        -f: fasta file of proteins
+        -l: layer of model to use (for esm2 only)
+        -m: minimum number of windows in a domain call
+        -o: tsv file to write domains to
+        -ov: largest fraction of a domain that can overlap another domain
+        -st: distance between the start of each window
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+        -w: window widths
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dct', type=str, default='data/esm2_17_875_avg.npy')
+    parser.add_argument('-e', type=str, default='esm2')
+    parser.add_argument('-f', type=str, required=True)
+    parser.add_argument('-l', type=int, default=17)
+    parser.add_argument('-m', type=int, default=2)
+    parser.add_argument('-o', type=str, default='data/scan.tsv')
+    parser.add_argument('-ov', type=float, default=0.5)
+    parser.add_argument('-st', type=int, default=10)
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    parser.add_argument('-w', type=int, nargs='+', default=[50, 100, 150, 200, 300])
+    args = parser.parse_args()
+
+    # Load tokenizer, encoder, and database
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # pylint: disable=E1101
+    tokenizer, model = load_model(args.e, device)
+    db = load_db(args.dct)
+
+    wdct = None
+    with open(args.f, 'r', encoding='utf8') as ffile, open(args.o, 'w', encoding='utf8') as out:
+        for record in SeqIO.parse(ffile, 'fasta'):
+            embed = Embedding(record.id, str(record.seq), None)
+            embed.embed_seq(tokenizer, model, device, args.e, args.l)
+            if wdct is None:
+                wdct = WindowDCT(args.s1, args.s2, embed.embed[1].shape[1])
+
+            # Search every window and merge them into domains
+            starts, ends, dcts = scan_windows(embed.embed[1], wdct, args.w, args.st)
+            if dcts is None:
+                logging.info('%s was too small to scan', record.id)
+                continue
+            hits = search_windows(dcts, db)
+            calls = merge_hits((starts, ends), hits, db[0], args.m, args.ov)
+            for fam, start, end, sim, count in calls:
+                out.write(f'{record.id}\t{fam}\t{start+1}\t{end}\t{sim}\t{count}\n')
+            logging.info('%s: %s windows, %s domains', record.id, len(dcts), len(calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,21 @@ __date__ = "08/18/23"
 
 import argparse
 import datetime
+import json
 import logging
 import os
-import pickle
-from random import sample
 import numpy as np
-from Bio import SeqIO
 import torch
-from util import load_model, Embedding, Transform
+from util import load_model, get_fams, Embedding, Transform
+from dct_db import DCTDatabase
+from make_queries import read_queries
+from clan_index import ClanIndex
+from quant_embed import search_q8
+from shm_db import SharedDB, stack_anchors
+from pool_search import anchor_block, pooled_search
+from parse_clans import load_clans, clan_ids, clan_metrics
+import timing
+from timing import stage
 
 log_filename = 'data/logs/search.log'  #pylint: disable=C0103
 os.makedirs(os.path.dirname(log_filename), exist_ok=True)
@@ -23,10 +30,10 @@ logging.basicConfig(filename=log_filename, filemode='w',
 
 
 def embed_query(
-    fam: str, tokenizer, model, device: str, args: argparse.Namespace) -> tuple:
+    query: tuple, tokenizer, model, device: str, args: argparse.Namespace) -> tuple:
     """Returns the embedding of a fasta sequence.
 
-    :param fam: family of query sequence
+    :param query: tuple containing family, seq id, sequence, and description of query
     :param tokenizer: tokenizer
     :param model: encoder model
     :param device: cpu or gpu
@@ -34,65 +41,125 @@ def embed_query(
     :return: Embedding and Transform objects
     """
 
-    # Get seqs from file and randomly sample one
-    seqs = {}
-    with open(f'data/full_seqs/{fam}/seqs.fa', 'r', encoding='utf8') as f:
-        for i, seq in enumerate(SeqIO.parse(f, 'fasta')):
-            seqs[i] = (seq.id, str(seq.seq))
-    seq = sample(list(seqs.values()), 1)[0]
-
     # Initialize Embedding object and embed sequence
-    embed = Embedding(seq[0], seq[1], None)
-    embed.embed_seq(tokenizer, model, device, args.e, args.l)
+    embed = Embedding(query[1], query[2], None)
+    with stage('embed'):
+        embed.embed_seq(tokenizer, model, device, args.e, args.l)
 
     # DCT embedding
     transform = Transform(embed.embed[0], embed.embed[1], None)
-    transform.quant_2D(args.s1, args.s2)
+    with stage('quant_2D'):
+        transform.quant_2D(args.s1, args.s2)
 
     return embed, transform
 
 
-def get_fams(results: dict) -> list:
-    """Returns a list of family names from a dictionary of search results:
+def load_db(path: str) -> tuple:
+    """Returns a DCT database along with the sum, count, and average DCT of each family.
 
-    :param results: dict where key is family name and value is similarity score
-    :return: list of family names
+    :param path: directory of DCT database
+    :return: tuple of DCTDatabase object, sums, counts, and averages (families x dim)
     """
 
-    result_fams = []
-    for name in results.keys():
-        if '_cluster' in name:
-            result_fams.append('_'.join(name.split('_')[:-1]))
-        else:
-            result_fams.append(name)
+    db = DCTDatabase(path)
+    size = len(db.fams)
+    sums = np.asarray(db.sums[:size])
+    counts = np.asarray(db.counts[:size])
+    avgs = sums // np.maximum(counts, 1)[:, None]
+
+    return db, sums, counts, avgs
+
+
+def db_search(dct: Transform, fam: str, desc: str, db_stats: tuple, top: int) -> dict:
+    """Searches transform against the average DCT of each family in a database. If the query's
+    family is given and the query is one of the sequences in that family's average, its DCT is
+    subtracted from the family's sum so that it is compared to the average of the other sequences
+    in the family (leave-one-out).
+
+    :param dct: Transform object of query
+    :param fam: family of query sequence (None to search without leave-one-out)
+    :param desc: description of query sequence
+    :param db_stats: tuple returned by load_db()
+    :param top: number of results to return
+    :return: dict where keys are family names and values are similarity scores
+    """
+
+    db, sums, counts, avgs = db_stats
+    query = dct.trans[1].astype(np.int64)
+    sims = 1 - np.abs(avgs - query).sum(axis=1)
+    valid = counts > 0
+
+    # Remove query from its family's average
+    row = db.rows.get(fam)
+    if row is not None and (desc in db.members[fam] or dct.trans[0] in db.members[fam]):
+        count = counts[row] - 1
+        valid[row] = count > 0
+        if count > 0:
+            loo_avg = (sums[row] - query) // count
+            sims[row] = 1 - np.abs(loo_avg - query).sum()
 
-    return result_fams
+    # Sort by similarity, ties stay in database order
+    cands = np.flatnonzero(valid)
+    cands = cands[np.argsort(-sims[cands], kind='stable')][:top]
 
+    return {db.fams[i]: sims[i] for i in cands}
 
-def clan_results(query_fam: str, results_fams: list) -> int:
+
+def clan_results(query_fam: str, results_fams: list, fam_clans: dict) -> int:
     """Returns 1 if query and top result are in the same clan, 0 otherwise.
 
     :param query_fam: family of query sequence
     :param results_fams: list of families of top N results
+    :param fam_clans: dict returned by parse_clans.load_clans
     :return: 1 if query and top result are in the same clan, 0 otherwise
     """
 
-    with open('data/clans.pkl', 'rb') as file:
-        clans = pickle.load(file)
-    for fams in clans.values():
-        if query_fam in fams and results_fams[0] in fams:
-            return 1
-    return 0
+    clan = fam_clans.get(query_fam, -1)
+    return int(clan >= 0 and fam_clans.get(results_fams[0], -1) == clan)
+
+
+def result_rows(results_fams: list, rows: dict, top: int) -> np.ndarray:
+    """Returns the row of each result family in a list of families, padded with -1 to top results.
+
+    :param results_fams: list of families of top N results
+    :param rows: dict where key is family and value is its row
+    :param top: number of results returned from search
+    :return: array of rows
+    """
+
+    fam_rows = np.full(top, -1, dtype=np.int64)
+    fam_rows[:min(len(results_fams), top)] = [rows.get(fam, -1) for fam in results_fams[:top]]
+
+    return fam_rows
+
+
+def write_result(file, query: tuple, step: str, results: dict, times: dict, top: int):
+    """Writes the results of a query to a JSONL file as one record. The family of every result
+    is written, so top n and clan counts from the file are the same as search_results, and only
+    the scores of the first results are written.
+
+    :param file: open JSONL file
+    :param query: tuple containing family, seq id, sequence, and description of query
+    :param step: search that gave the results (dct or anchors), or skipped if query was too small
+    :param results: dict where key is family name and value is similarity score
+    :param times: dict where key is stage name and value is time in seconds for this query
+    :param top: number of scored results to write
+    """
+
+    record = {'query': query[1], 'fam': query[0], 'desc': query[3], 'stage': step,
+              'results': [[name, float(results[name])] for name in list(results)[:top]],
+              'fams': get_fams(results), 'times': times}
+    file.write(json.dumps(record) + '\n')
 
 
-def search_results(query: str, results: dict, counts: dict) -> dict:
+def search_results(query: str, results: dict, counts: dict, fam_clans: dict) -> dict:
     """Returns a dict of counts for matches, top n results, and same clan for all queries in a
     search.
 
     :param query: query sequence
     :param results: dictionary of results from searching query against dcts
     :param counts: dictionary of counts for matches, top n results, and same clan
-    :param top: number of results to return
+    :param fam_clans: dict returned by parse_clans.load_clans
     :return: dict of counts for matches, top n results, and same clan
     """
 
@@ -111,7 +178,7 @@ def search_results(query: str, results: dict, counts: dict) -> dict:
     if query_fam in results_fams:  # Top n results
         counts['top'] += 1
         return counts
-    counts['clan'] += clan_results(query_fam, results_fams)  # Same clan
+    counts['clan'] += clan_results(query_fam, results_fams, fam_clans)  # Same clan
 
     return counts
 
@@ -122,58 +189,170 @@ def main():
 
     args:
         -dct: database of dct vectors
+        -db: DCT database with family sums and counts (searched instead of -dct if given)
+        -shm: manifest from shm_db.py, searches the DCTs and anchors it hosts instead of -dct/-emb
+        -q: query manifest from make_queries.py
+        -ci: number of clan groups to search with a clan index (0 to search every family, not
+            with -db)
+        -loo: remove query from its family's average DCT before searching (requires -db)
         -emb: database of embeddings (leave empty if only searching dct)
+        -pq: pool query residues before searching anchors (mean, max, or cand), empty to not pool
+            (not with -q8)
+        -pw: number of residues in each pooling window
+        -pk: windows kept for each anchor (-pq cand)
+        -pr: number of top families rescored with every query residue after pooling
+        -q8: -emb is a database of int8 anchors from quant_embed.py (not with -shm, which hosts
+            float anchors)
+        -rr: with -q8, number of top families from integer codes rescored with reconstructed
+            anchors
         -e: encoder model
         -l: layer of model to use (for esm2 only)
         -t: number of results to return from search
         -s1: first dimension of dct
         -s2: second dimension of dct
+        -j: JSONL file to write the results of each query to
+        -jt: number of scored results to write for each query (families of all -t are written)
+        -time: log summary of time taken by each stage of search
+        -prof: file to save cProfile stats of search to
     """
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-dct', type=str, default='data/esm2_17_875_clusters.npy')
+    parser.add_argument('-db', type=str, default='')
+    parser.add_argument('-shm', type=str, default='')
+    parser.add_argument('-q', type=str, default='data/queries.fa')
+    parser.add_argument('-ci', type=int, default=0)
+    parser.add_argument('-loo', action='store_true')
     parser.add_argument('-emb', type=str, default='')
+    parser.add_argument('-pq', type=str, default='', choices=['', 'mean', 'max', 'cand'])
+    parser.add_argument('-pw', type=int, default=4)
+    parser.add_argument('-pk', type=int, default=2)
+    parser.add_argument('-pr', type=int, default=10)
+    parser.add_argument('-q8', action='store_true')
+    parser.add_argument('-rr', type=int, default=0)
     parser.add_argument('-e', type=str, default='esm2')
     parser.add_argument('-l', type=int, default=17)
     parser.add_argument('-t', type=int, default=100)
     parser.add_argument('-s1', type=int, default=8)
     parser.add_argument('-s2', type=int, default=75)
+    parser.add_argument('-j', type=str, default='data/logs/search.jsonl')
+    parser.add_argument('-jt', type=int, default=10)
+    parser.add_argument('-time', action='store_true')
+    parser.add_argument('-prof', type=str, default='')
     args = parser.parse_args()
+    if args.q8 and args.shm:
+        parser.error('-q8 cannot be used with -shm, shm_db.py hosts float anchors')
+    if args.q8 and args.pq:
+        parser.error('-pq cannot be used with -q8, pooled search scores float anchors')
+    if args.ci and args.db:
+        parser.error('-ci cannot be used with -db, the clan index is built from -dct or -shm')
+    if args.loo and not args.db:
+        parser.error('-loo requires -db, only its family sums can leave the query out')
+    timing.enable()  # Times are written to JSONL for every query
 
     # Load tokenizer and encoder
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # pylint: disable=E1101
     tokenizer, model = load_model(args.e, device)
 
     # Load embed/dct database
-    dct_db = np.load(args.dct, allow_pickle=True)
-    if args.emb != '':
+    emb_db = None
+    if args.db != '':
+        db_stats = load_db(args.db)
+    elif args.shm != '':
+        shared = SharedDB.attach(args.shm)
+        dct_db = shared.dct_db()
+        if 'anchors' in shared.arrays:
+            emb_db = shared.anchor_db()
+    else:
+        dct_db = np.load(args.dct, allow_pickle=True)
+    if args.emb != '' and emb_db is None:
         emb_db = np.load(args.emb, allow_pickle=True)
-
-    # Call query_search for every query sequence in a folder
+    if args.pq and emb_db is not None:  # Anchors stacked once for pooled search
+        if args.shm != '' and 'anchors' in shared.arrays:
+            block = anchor_block(*(shared.arrays[key] for key in
+                                   ['anchor_fams', 'anchors', 'offsets']))
+        else:
+            block = anchor_block(*stack_anchors(emb_db))
+
+    # Load clan of each family once, in the same order as families in the database
+    if args.db != '':
+        fams = db_stats[0].fams
+    else:
+        fams = list(dict.fromkeys(get_fams(dict.fromkeys(dct[0] for dct in dct_db))))
+    rows = {fam: i for i, fam in enumerate(fams)}
+    fam_clans = load_clans()
+    clans = clan_ids(fams, fam_clans)
+    if args.ci:
+        index = ClanIndex([dct[0] for dct in dct_db], np.stack([dct[1] for dct in dct_db]),
+                          fam_clans)
+    query_rows, results_rows = [], []
+
+    # Call query_search for every query sequence in manifest
+    with stage('load queries'):
+        queries = read_queries(args.q)
     counts = {'match': 0, 'top': 0, 'clan': 0, 'total': 0}
-    for fam in os.listdir('data/full_seqs'):
-
-        # Get random sequence from family and embed/transform sequence
-        embed, dct = embed_query(fam, tokenizer, model, device, args)
-        if dct.trans[1] is None:
-            logging.info('%s\n%s\nQuery was too small for transformation dimensions',
-                          datetime.datetime.now(), embed.embed[0])
-            continue
-
-        # Search dct db - check if top family is same as query family
-        results = dct.search(dct_db, args.t)
-        results_fams = get_fams(results)
-        if fam == results_fams[0] or args.emb == '':
-            counts = search_results(f'{fam}/{dct.trans[0]}', results, counts)
-            logging.info('DCT: Queries: %s, Matches: %s, Top%s: %s, Clan: %s\n',
-                        counts['total'], counts['match'], args.t, counts['top'], counts['clan'])
-            continue
-
-        # If top family is not same as query family, search anchors on top results from DCTs
-        results = embed.search(emb_db, args.t, results_fams)
-        counts = search_results(f'{fam}/{embed.embed[0]}', results, counts)
-        logging.info('ANCHORS: Queries: %s, Matches: %s, Top%s: %s, Clan: %s\n',
-                      counts['total'], counts['match'], args.t, counts['top'], counts['clan'])
+    with timing.profile(args.prof), open(args.j, 'w', encoding='utf8') as jfile:
+        for query in queries:
+            fam, desc = query[0], query[3]
+            marks = timing.mark()
+
+            # Embed/transform query sequence
+            embed, dct = embed_query(query, tokenizer, model, device, args)
+            if dct.trans[1] is None:
+                logging.info('%s\n%s\nQuery was too small for transformation dimensions',
+                              datetime.datetime.now(), embed.embed[0])
+                write_result(jfile, query, 'skipped', {}, timing.since(marks), args.jt)
+                continue
+
+            # Search dct db - check if top family is same as query family
+            with stage('dct search'):
+                if args.db != '':
+                    results = db_search(dct, fam if args.loo else None, desc, db_stats, args.t)
+                    timing.count('dct candidates', len(fams))
+                elif args.ci:
+                    results = index.search(dct.trans[1], args.t, args.ci)
+                elif args.shm != '':
+                    results = shared.search(dct.trans[1], args.t)
+                    timing.count('dct candidates', len(dct_db))
+                else:
+                    results = dct.search(dct_db, args.t)
+                    timing.count('dct candidates', len(dct_db))
+            results_fams = get_fams(results)
+            if fam == results_fams[0] or emb_db is None:
+                with stage('evaluation'):
+                    query_rows.append(rows.get(fam, -1))
+                    results_rows.append(result_rows(results_fams, rows, args.t))
+                    counts = search_results(f'{fam}/{dct.trans[0]}', results, counts, fam_clans)
+                write_result(jfile, query, 'dct', results, timing.since(marks), args.jt)
+                logging.info('DCT: Queries: %s, Matches: %s, Top%s: %s, Clan: %s\n',
+                            counts['total'], counts['match'], args.t, counts['top'], counts['clan'])
+                continue
+
+            # If top family is not same as query family, search anchors on top results from DCTs
+            with stage('anchor search'):
+                if args.pq:
+                    results = pooled_search(embed.embed[1], block, args.t, results_fams, args)
+                elif args.q8:
+                    results = search_q8(embed.embed[1], emb_db, args.t, results_fams, args.rr)
+                else:
+                    results = embed.search(emb_db, args.t, results_fams)
+                timing.count('anchor candidates', len(results_fams))
+            with stage('evaluation'):
+                query_rows.append(rows.get(fam, -1))
+                results_rows.append(result_rows(get_fams(results), rows, args.t))
+                counts = search_results(f'{fam}/{embed.embed[0]}', results, counts, fam_clans)
+            write_result(jfile, query, 'anchors', results, timing.since(marks), args.jt)
+            logging.info('ANCHORS: Queries: %s, Matches: %s, Top%s: %s, Clan: %s\n',
+                          counts['total'], counts['match'], args.t, counts['top'], counts['clan'])
+
+    # Score all queries at once
+    if query_rows:
+        metrics = clan_metrics(np.array(query_rows), np.stack(results_rows), clans)
+        logging.info('TOTAL: Queries: %s, Matches: %s, Top%s: %s, Clan: %s, Top%s Clan: %s\n',
+                      metrics['total'], metrics['match'], args.t, metrics['top'],
+                      metrics['clan'], args.t, metrics['clan_top'])
+    if args.time:
+        logging.info('TIMING:\n%s\n', timing.report())
 
 
 if __name__ == '__main__':
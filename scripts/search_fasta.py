@@ -0,0 +1,200 @@
+"""This script searches every sequence in a fasta file (or from stdin) against a DCT database and
+writes the top results for each sequence as tab separated rows in the same 12 columns as BLAST
+tabular output (-outfmt 6) or mmseqs .m8 files, so it can be used in the same pipelines.
+
+    query, target, pident, length, mismatch, gapopen, qstart, qend, tstart, tend, evalue, bits
+
+The DCT search does not align sequences, so pident, mismatch, gapopen, tstart, and tend are 0,
+the query coordinates cover the whole query, evalue is the Manhattan distance between the query
+and target DCTs (lower is better), and bits is their similarity (1 - distance, higher is better).
+
+Sequences are read, embedded, and searched in batches, with a limited number of batches in flight
+at once so memory does not grow with the size of the fasta file. Rows are written as each batch
+completes, and if the output file already exists, sequences that were already written are skipped.
+
+__author__ = "Ben Iovino"
+__date__ = "09/24/23"
+"""
+
+import argparse
+import logging
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import numpy as np
+import torch
+from Bio import SeqIO
+from scipy.spatial.distance import cdist
+from dct_db import DCTDatabase
+from util import load_model, fam_rows, max_fams, embed_batch, Transform
+
+log_filename = 'data/logs/search_fasta.log'  #pylint: disable=C0103
+os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+logging.basicConfig(filename=log_filename, filemode='w',
+                     level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+def load_targets(args: argparse.Namespace) -> tuple:
+    """Returns the families and DCTs of a DCT database, either a .npy file of DCTs (-dct) or a
+    database from dct_db.py (-db).
+
+    :param args: argparse.Namespace object with database paths
+    :return: tuple of list of families, family index of each row, and array of DCTs (rows x dim)
+    """
+
+    if args.db:
+        names, dcts = DCTDatabase(args.db).means()
+    else:
+        dct_db = np.load(args.dct, allow_pickle=True)
+        names, dcts = [dct[0] for dct in dct_db], np.stack([dct[1] for dct in dct_db])
+
+    return (*fam_rows(names), dcts)
+
+
+def resume(file: str) -> set:
+    """Returns the ids of queries already written to an output file. Rows of the last query in the
+    file (which may not have been fully written) and any incomplete line are removed so that query
+    is searched again.
+
+    :param file: output file
+    :return: set of query ids
+    """
+
+    if not os.path.exists(file):
+        return set()
+
+    done, last, block, pos = set(), None, 0, 0
+    with open(file, 'rb') as out:
+        for line in out:
+            if not line.endswith(b'\n'):  # Incomplete line
+                break
+            query = line.split(b'\t', 1)[0].decode('utf8')
+            if query != last:
+                if last is not None:
+                    done.add(last)
+                last, block = query, pos
+            pos += len(line)
+    with open(file, 'r+b') as out:
+        out.truncate(block)
+
+    return done
+
+
+def read_batches(handle, done: set, batch: int):
+    """Yields batches of sequences from a fasta file, skipping sequences that were already
+    searched.
+
+    :param handle: open fasta file
+    :param done: set of query ids to skip
+    :param batch: number of sequences in each batch
+    :yield: list of tuples containing query id and sequence
+    """
+
+    records = ((rec.id, str(rec.seq)) for rec in SeqIO.parse(handle, 'fasta')
+               if rec.id not in done)
+    while True:
+        seqs = list(islice(records, batch))
+        if not seqs:
+            return
+        yield seqs
+
+
+def search_batch(queries: list, targets: tuple, top: int) -> str:
+    """Returns the rows for the top results of a batch of query DCTs. Each family is scored by its
+    most similar row, so families with many clusters are only one result.
+
+    :param queries: list of tuples containing query id, query length, and DCT
+    :param targets: tuple returned by load_targets()
+    :param top: number of results for each query
+    :return: rows for every query in the batch
+    """
+
+    fams, row_fams, dcts = targets
+    if not queries:
+        return ''
+    sims = 1 - cdist(np.stack([query[2] for query in queries]), dcts, 'cityblock')
+
+    rows = []
+    for (qid, length, _), sim in zip(queries, sims):
+        for fam, score in max_fams(sim, row_fams, fams, top).items():
+            rows.append(f'{qid}\t{fam}\t0.0\t{length}\t0\t0\t1\t{length}\t0\t0\t'
+                        f'{1 - score:.0f}\t{score:.0f}\n')
+
+    return ''.join(rows)
+
+
+def main():
+    """Main reads sequences from a fasta file, embeds and transforms them in batches, and writes
+    the top results from the DCT database for each sequence.
+
+    args:
+        -b: number of sequences embedded at once
+        -db: DCT database from dct_db.py (searched instead of -dct if given)
+        -dct: database of dct vectors
+        -e: encoder model
+        -f: fasta file of queries (- for stdin)
+        -l: layer of model to use (for esm2 only)
+        -o: output file (- for stdout, cannot be resumed)
+        -t: number of results for each query
+        -w: number of batches in flight at once
+        -s1: first dimension of dct
+        -s2: second dimension of dct
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', type=int, default=16)
+    parser.add_argument('-db', type=str, default='')
+    parser.add_argument('-dct', type=str, default='data/esm2_17_875_avg.npy')
+    parser.add_argument('-e', type=str, default='esm2')
+    parser.add_argument('-f', type=str, default='-')
+    parser.add_argument('-l', type=int, default=17)
+    parser.add_argument('-o', type=str, default='data/search_fasta.m8')
+    parser.add_argument('-t', type=int, default=5)
+    parser.add_argument('-w', type=int, default=4)
+    parser.add_argument('-s1', type=int, default=8)
+    parser.add_argument('-s2', type=int, default=75)
+    args = parser.parse_args()
+
+    # Load tokenizer, encoder, and database
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')  # pylint: disable=E1101
+    tokenizer, model = load_model(args.e, device)
+    targets = load_targets(args)
+
+    done = resume(args.o) if args.o != '-' else set()
+    if done:
+        logging.info('Skipping %s queries already in %s', len(done), args.o)
+    #pylint: disable=R1732
+    handle = sys.stdin if args.f == '-' else open(args.f, 'r', encoding='utf8')
+    out = sys.stdout if args.o == '-' else open(args.o, 'a', encoding='utf8')
+
+    # Embed batches while earlier batches are searched, writing them in order as they finish
+    count = 0
+    with ThreadPoolExecutor(1) as pool:
+        pending = deque()
+        for seqs in read_batches(handle, done, args.b):
+            queries = []
+            for embed in embed_batch(seqs, tokenizer, model, device, args.e, args.l):
+                dct = Transform(embed.embed[0], embed.embed[1], None)
+                dct.quant_2D(args.s1, args.s2)
+                if dct.trans[1] is None:
+                    logging.info('%s was too small for transformation dimensions', dct.trans[0])
+                    continue
+                queries.append((dct.trans[0], len(embed.seq[1]), dct.trans[1]))
+            pending.append(pool.submit(search_batch, queries, targets, args.t))
+            while len(pending) >= args.w:
+                out.write(pending.popleft().result())
+                out.flush()
+            count += len(seqs)
+            logging.info('Searched %s queries', count)
+        while pending:
+            out.write(pending.popleft().result())
+            out.flush()
+    for file in (handle, out):
+        if file not in (sys.stdin, sys.stdout):
+            file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""This script hosts a DCT database and anchor database in shared memory so that many search
+processes on the same machine can use one copy of them. The host process copies the DCT matrix,
+the anchors of every family stacked into one block, and the name of every row into shared memory
+segments and writes a manifest of them. Workers attach to the segments by name from the manifest
+and get read-only numpy views of them, without copying or loading anything from disk.
+
+Segments are removed when the host exits (including on SIGTERM or Ctrl+C). Workers only close
+their views when they exit, so the segments stay until the host is done with them.
+
+__author__ = "Ben Iovino"
+__date__ = "09/28/23"
+"""
+
+import argparse
+import atexit
+import json
+import os
+import signal
+import sys
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from scipy.spatial.distance import cdist
+from util import fam_rows, max_fams
+
+
+def stack_anchors(anchor_db: np.ndarray) -> tuple:
+    """Returns the anchors of every family stacked into one array, with the first row of each
+    family's anchors. A family with no anchors has no rows, and is skipped when searched.
+
+    :param anchor_db: array of family names and anchor embeddings (get_anchors.py)
+    :return: tuple of array of families, anchors (total anchors x dim), and offsets (families+1)
+    """
+
+    anchors = [np.atleast_2d(anchor[1]).astype(np.float32) for anchor in anchor_db]
+    dim = max((anc.shape[1] for anc in anchors if anc.size), default=0)
+    anchors = [anc if anc.size else np.empty((0, dim), np.float32) for anc in anchors]
+    offsets = np.concatenate(([0], np.cumsum([len(anc) for anc in anchors]))).astype(np.int64)
+
+    return np.array([anchor[0] for anchor in anchor_db]), np.concatenate(anchors), offsets
+
+
+class SharedDB:
+    """This class holds read-only views of database arrays in shared memory, either created by
+    the host with host() or attached to by a worker with attach().
+    """
+
+
+    def __init__(self, segments: dict, arrays: dict, owner: bool):
+        """Defines SharedDB class.
+
+        :param segments: dict where key is array name and value is SharedMemory object
+        :param arrays: dict where key is array name and value is read-only view of its segment
+        :param owner: True if this process created the segments and should remove them
+        """
+
+        self.segments = segments
+        self.arrays = arrays
+        self.owner = owner
+        self.fams, self.row_fams = fam_rows(arrays['names'].tolist())
+        atexit.register(self.close)
+
+
+    @classmethod
+    def host(cls, prefix: str, arrays: dict) -> 'SharedDB':
+        """Returns a new SharedDB with a copy of each array in its own segment.
+
+        :param prefix: prefix of segment names
+        :param arrays: dict where key is array name and value is array
+        :return: SharedDB object
+        """
+
+        segments, views = {}, {}
+        try:
+            for key, arr in arrays.items():
+                arr = np.ascontiguousarray(arr)
+                shm = shared_memory.SharedMemory(f'{prefix}_{key}', create=True,
+                                                 size=max(arr.nbytes, 1))
+                segments[key] = shm
+                view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+                view[...] = arr
+                view.flags.writeable = False
+                views[key] = view
+        except BaseException:
+            for shm in segments.values():  # Do not leave segments behind if one fails
+                shm.close()
+                shm.unlink()
+            raise
+
+        return cls(segments, views, True)
+
+
+    @classmethod
+    def attach(cls, manifest: str) -> 'SharedDB':
+        """Returns a SharedDB with views of the segments in a manifest written by the host.
+
+        :param manifest: JSON file from write_manifest
+        :return: SharedDB object
+        """
+
+        with open(manifest, 'r', encoding='utf8') as file:
+            info = json.load(file)
+
+        segments, views = {}, {}
+        for key, seg in info['arrays'].items():
+            shm = shared_memory.SharedMemory(seg['name'])
+            resource_tracker.unregister(shm._name, 'shared_memory')  #pylint: disable=W0212
+            segments[key] = shm
+            view = np.ndarray(tuple(seg['shape']), dtype=np.dtype(seg['dtype']), buffer=shm.buf)
+            view.flags.writeable = False
+            views[key] = view
+
+        return cls(segments, views, False)
+
+
+    def write_manifest(self, manifest: str):
+        """Writes the name, shape, and dtype of each segment to a JSON file for workers to attach.
+
+        :param manifest: JSON file to write to
+        """
+
+        info = {'pid': os.getpid(), 'arrays': {
+            key: {'name': self.segments[key].name, 'shape': list(arr.shape),
+                  'dtype': arr.dtype.str} for key, arr in self.arrays.items()}}
+        if os.path.dirname(manifest):
+            os.makedirs(os.path.dirname(manifest), exist_ok=True)
+        with open(f'{manifest}.tmp', 'w', encoding='utf8') as file:
+            json.dump(info, file, indent=2)
+        os.replace(f'{manifest}.tmp', manifest)
+
+
+    def close(self):
+        """Closes the views of each segment, and removes the segments if this process created
+        them. Called when the process exits.
+        """
+
+        self.arrays = {}  # Views must be released before their buffers are closed
+        for shm in self.segments.values():
+            if self.owner:
+                try:
+                    shm.unlink()  # Memory is freed once every process has closed it
+                except FileNotFoundError:
+                    pass
+            try:
+                shm.close()
+            except BufferError:  # Views handed out by dct_db() or anchor_db() still exist
+                continue
+        self.segments = {}
+
+
+    def dct_db(self) -> np.ndarray:
+        """Returns the DCT database in the same format as avg_dct.py, where each DCT is a view of
+        the shared matrix.
+
+        :return: array of names and DCT vectors
+        """
+
+        db = np.empty((len(self.arrays['names']), 2), dtype=object)
+        for i, (name, dct) in enumerate(zip(self.arrays['names'], self.arrays['dcts'])):
+            db[i] = [str(name), dct]
+
+        return db
+
+
+    def anchor_db(self) -> np.ndarray:
+        """Returns the anchor database in the same format as get_anchors.py, where the anchors of
+        each family are a view of the shared block.
+
+        :return: array of family names and anchor embeddings
+        """
+
+        fams, anchors = self.arrays['anchor_fams'], self.arrays['anchors']
+        offsets = self.arrays['offsets']
+        db = np.empty((len(fams), 2), dtype=object)
+        for i, fam in enumerate(fams):
+            db[i] = [str(fam), anchors[offsets[i]:offsets[i+1]]]
+
+        return db
+
+
+    def search(self, query: np.ndarray, top: int, block: int = 4096) -> dict:
+        """Searches a query DCT against the shared DCT matrix in blocks of rows, so only one block
+        is converted to float at a time, with the same results as Transform.search.
+
+        :param query: DCT of query
+        :param top: number of results to return
+        :param block: number of rows compared at once
+        :return: dict where keys are family names and values are similarity scores
+        """
+
+        dcts = self.arrays['dcts']
+        query = query[None].astype(np.float64)
+        sims = np.empty(len(dcts))
+        for i in range(0, len(dcts), block):
+            sims[i:i+block] = 1 - cdist(query, dcts[i:i+block].astype(np.float64), 'cityblock')[0]
+
+        return max_fams(sims, self.row_fams, self.fams, top)
+
+
+def main():
+    """Main loads a DCT database and anchor database, hosts them in shared memory, writes a
+    manifest for workers (search.py -shm), and waits until it is stopped.
+
+    args:
+        -a: anchors from get_anchors.py (empty string to skip)
+        -dct: database of dct vectors
+        -m: manifest to write
+        -n: prefix of segment names
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', type=str, default='data/anchors.npy')
+    parser.add_argument('-dct', type=str, default='data/esm2_17_875_clusters.npy')
+    parser.add_argument('-m', type=str, default='data/shm_db.json')
+    parser.add_argument('-n', type=str, default='dct_db')
+    args = parser.parse_args()
+
+    dct_db = np.load(args.dct, allow_pickle=True)
+    arrays = {'names': np.array([dct[0] for dct in dct_db]),
+              'dcts': np.stack([dct[1] for dct in dct_db])}
+    if args.a:
+        fams, anchors, offsets = stack_anchors(np.load(args.a, allow_pickle=True))
+        arrays.update(anchor_fams=fams, anchors=anchors, offsets=offsets)
+    del dct_db
+
+    # Exit normally on SIGTERM so segments are removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    shared = SharedDB.host(args.n, arrays)
+    del arrays
+    shared.write_manifest(args.m)
+    atexit.register(lambda: os.path.exists(args.m) and os.remove(args.m))
+    size = sum(shm.size for shm in shared.segments.values())
+    print(f'Hosting {size / 2**20:.1f} MB as {args.n}, manifest {args.m}', flush=True)
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""This script sweeps the parameters of the DCT search (ESM2 layer, DCT dimensions, and how each
+family's DCT is aggregated) in one process. The encoder is loaded once and every layer in the
+sweep is taken from the same forward pass, so each query and each family sequence is embedded only
+once. The DCTs for every configuration are cached, so a sweep can be resumed or extended with new
+layers without embedding again, and configurations are searched in parallel.
+
+Aggregations:
+    cons: DCT of the family's average embedding over consensus positions (avg_dct.py)
+    mean: average of the DCTs of each sequence in the family (full_dct.py)
+
+__author__ = "Ben Iovino"
+__date__ = "09/22/23"
+"""
+
+import argparse
+import logging
+import os
+from collections import Counter
+from functools import partial
+import numpy as np
+import torch
+from scipy.spatial.distance import cdist
+from avg_embed import get_seqs
+from cons_embed import cons_pos, cons_sums, cons_mean
+from fam_pool import map_fams, save_part
+from make_queries import read_queries
+from parse_clans import load_clans, clan_ids, clan_metrics
+from util import load_model, embed_layers, Transform
+
+log_filename = 'data/logs/sweep.log'  #pylint: disable=C0103
+os.makedirs(os.path.dirname(log_filename), exist_ok=True)
+logging.basicConfig(filename=log_filename, filemode='w',
+                     level=logging.INFO, format='%(message)s')
+
+
+def dct_key(layer: int, s1: int, s2: int, agg: str = '') -> str:
+    """Returns the key that a DCT is cached under.
+
+    :param layer: layer of ESM2
+    :param s1: first dimension of dct
+    :param s2: second dimension of dct
+    :param agg: aggregation of family DCT (empty for queries)
+    :return: key
+    """
+
+    return f'{agg}_{layer}_{s1}_{s2}' if agg else f'{layer}_{s1}_{s2}'
+
+
+def seq_dct(seqid: str, embed: np.ndarray, s1: int, s2: int) -> np.ndarray:
+    """Returns the DCT of an embedding, or None if the embedding is too small.
+
+    :param seqid: sequence id
+    :param embed: embedding (with start/end tokens)
+    :param s1: first dimension of dct
+    :param s2: second dimension of dct
+    :return: DCT vector
+    """
+
+    transform = Transform(seqid, embed, None)
+    try:
+        transform.quant_2D(s1, s2)
+    except ValueError:  # Too few positions to transform at all
+        return None
+
+    return transform.trans[1]
+
+
+def load_cache(file: str) -> dict:
+    """Returns the arrays in a cache file, or an empty dict if it does not exist.
+
+    :param file: cache file (.npz)
+    :return: dict of arrays
+    """
+
+    if not os.path.exists(file):
+        return {}
+    with np.load(file) as data:
+        return {key: data[key] for key in data.files}
+
+
+def cached_keys(file: str) -> set:
+    """Returns the keys of every configuration that was computed for a cache file, including
+    configurations whose DCT could not be computed.
+
+    :param file: cache file (.npz)
+    :return: set of keys
+    """
+
+    if not os.path.exists(file):
+        return set()
+    with np.load(file) as data:
+        return set(data['keys'].tolist()) if 'keys' in data.files else set()
+
+
+def same_queries(file: str, queries: list) -> bool:
+    """Returns True if a query cache file was computed for the same queries.
+
+    :param file: query cache file (.npz)
+    :param queries: list of tuples from make_queries.read_queries
+    :return: True if the cached queries are the same
+    """
+
+    if not os.path.exists(file):
+        return False
+    with np.load(file) as data:
+        return 'descs' in data.files and data['descs'].tolist() == [q[3] for q in queries]
+
+
+def missing_layers(done: set, args: argparse.Namespace, aggs: list) -> list:
+    """Returns the layers that have any configuration not computed in a cache.
+
+    :param done: set of keys returned by cached_keys
+    :param args: argparse.Namespace object with layers and dct dimensions
+    :param aggs: aggregations (list with an empty string for queries)
+    :return: list of layers
+    """
+
+    return [layer for layer in args.l if any(dct_key(layer, s1, s2, agg) not in done
+            for s1 in args.s1 for s2 in args.s2 for agg in aggs)]
+
+
+def fam_dcts(fam: str, models: tuple, layers: list, args: argparse.Namespace) -> dict:
+    """Returns the DCTs of a family for each layer, DCT dimension, and aggregation. Embeddings are
+    summed over consensus positions batch by batch so only one batch is held in memory.
+
+    :param fam: Pfam family
+    :param models: tuple of tokenizer, model, and device
+    :param layers: layers of ESM2
+    :param args: argparse.Namespace object with dct dimensions, aggregations, and batch size
+    :return: dict where key is dct_key and value is DCT vector
+    """
+
+    sequences = get_seqs(fam)
+    positions = cons_pos(sequences)
+    seqs = [(sid, str(seq).replace('.', '')) for sid, seq in sequences.items()]
+    length = max((cols[-1]+1 for cols, _ in positions.values() if len(cols)), default=0)
+    sums, counts = {}, np.zeros(length, dtype=np.int64)
+    dct_sums, dct_counts = {}, Counter()
+    for i in range(0, len(seqs), args.b):
+        batch = seqs[i:i+args.b]
+        embeds = embed_layers(batch, *models, layers)
+        batch_pos = {sid: positions[sid] for sid, _ in batch}
+        for layer in layers:
+            layer_embeds = {sid: embed[layer] for (sid, _), embed in zip(batch, embeds)}
+
+            # Sum embeddings over consensus positions
+            if 'cons' in args.a:
+                bsums, bcounts = cons_sums(batch_pos, layer_embeds)
+                sums.setdefault(layer, np.zeros((length, bsums.shape[1])))[:len(bsums)] += bsums
+                if layer == layers[0]:
+                    counts[:len(bcounts)] += bcounts
+
+            # Sum DCT of each sequence
+            if 'mean' in args.a:
+                for sid, embed in layer_embeds.items():
+                    for s1 in args.s1:
+                        for s2 in args.s2:
+                            vec = seq_dct(sid, embed, s1, s2)
+                            if vec is not None:
+                                key = dct_key(layer, s1, s2, 'mean')
+                                dct_sums[key] = dct_sums.get(key, 0) + vec.astype(np.int64)
+                                dct_counts[key] += 1
+
+    # DCT of average embedding and average of DCTs
+    dcts = {}
+    for layer in sums:
+        avg_embed = cons_mean(sums[layer], counts)
+        for s1 in args.s1:
+            for s2 in args.s2:
+                vec = seq_dct(fam, avg_embed, s1, s2)
+                if vec is not None:
+                    dcts[dct_key(layer, s1, s2, 'cons')] = vec
+    for key, total in dct_sums.items():
+        dcts[key] = (total // dct_counts[key]).astype(np.int8)
+
+    return dcts
+
+
+def cache_fam(fam: str, models: tuple, args: argparse.Namespace):
+    """Computes and caches the DCTs of a family for any layer that is not already cached.
+
+    :param fam: Pfam family
+    :param models: tuple of tokenizer, model, and device
+    :param args: argparse.Namespace object with sweep parameters
+    """
+
+    file = f'{args.c}/fams/{fam}.npz'
+    keys = cached_keys(file)
+    layers = missing_layers(keys, args, args.a)
+    if not layers:
+        return
+
+    cache = load_cache(file)
+    cache.update(fam_dcts(fam, models, layers, args))
+    keys.update(dct_key(layer, s1, s2, agg) for layer in layers
+                for s1 in args.s1 for s2 in args.s2 for agg in args.a)
+    cache['keys'] = np.array(sorted(keys))
+    save_part(file, cache)
+
+
+def cache_queries(queries: list, models: tuple, args: argparse.Namespace):
+    """Computes and caches the DCT of every query for any layer that is not already cached.
+    Queries whose embedding is too small for a DCT dimension are marked as not valid.
+
+    :param queries: list of tuples from make_queries.read_queries
+    :param models: tuple of tokenizer, model, and device
+    :param args: argparse.Namespace object with sweep parameters
+    """
+
+    file = f'{args.c}/queries.npz'
+    descs = np.array([query[3] for query in queries])
+    cache = load_cache(file) if same_queries(file, queries) else {'keys': np.array([])}
+    keys = set(cache['keys'].tolist())
+    layers = missing_layers(keys, args, [''])
+    if not layers:
+        return
+
+    dcts = {dct_key(layer, s1, s2): np.zeros((len(queries), s1 * s2), dtype=np.int8)
+            for layer in layers for s1 in args.s1 for s2 in args.s2}
+    valid = {key: np.zeros(len(queries), dtype=bool) for key in dcts}
+    for i in range(0, len(queries), args.b):
+        batch = [(query[1], query[2]) for query in queries[i:i+args.b]]
+        for j, embeds in enumerate(embed_layers(batch, *models, layers)):
+            for layer, embed in embeds.items():
+                for s1 in args.s1:
+                    for s2 in args.s2:
+                        vec = seq_dct(batch[j][0], embed, s1, s2)
+                        if vec is not None:
+                            key = dct_key(layer, s1, s2)
+                            dcts[key][i+j], valid[key][i+j] = vec, True
+        logging.info('Embedded %s/%s queries', min(i+args.b, len(queries)), len(queries))
+
+    keys.update(dcts)
+    cache.update(dcts)
+    cache.update({f'valid_{key}': val for key, val in valid.items()})
+    cache.update({'descs': descs, 'keys': np.array(sorted(keys))})
+    save_part(file, cache)
+
+
+def search_config(dbs: tuple, qdcts: np.ndarray, query_fams: list, top: int,
+                   fam_clans: dict) -> dict:
+    """Returns the results of searching every query against a database of family DCTs.
+
+    :param dbs: tuple of list of families and array of their DCTs (families x dim)
+    :param qdcts: array of query DCTs (queries x dim)
+    :param query_fams: family of each query
+    :param top: number of results to consider
+    :param fam_clans: dict returned by parse_clans.load_clans
+    :return: dict of counts from parse_clans.clan_metrics
+    """
+
+    fams, db = dbs
+    rows = {fam: i for i, fam in enumerate(fams)}
+    query_rows = np.array([rows.get(fam, -1) for fam in query_fams], dtype=np.int64)
+    results_rows = np.full((len(qdcts), min(top, len(fams))), -1, dtype=np.int64)
+
+    # Smallest Manhattan distance is most similar, ties stay in database order
+    for i in range(0, len(qdcts), 256):
+        dists = cdist(qdcts[i:i+256], db, 'cityblock')
+        results_rows[i:i+256] = np.argsort(dists, axis=1, kind='stable')[:, :top]
+
+    return clan_metrics(query_rows, results_rows, clan_ids(fams, fam_clans))
+
+
+def eval_layer(layer: int, fams: list, query_fams: list, fam_clans: dict,
+               args: argparse.Namespace) -> list:
+    """Returns the search results of every DCT dimension and aggregation for one layer. Each
+    family's cache is read once for all configurations of the layer.
+
+    :param layer: layer of ESM2
+    :param fams: list of families
+    :param query_fams: family of each query
+    :param fam_clans: dict returned by parse_clans.load_clans
+    :param args: argparse.Namespace object with sweep parameters
+    :return: list of dicts with configuration and results
+    """
+
+    configs = [(s1, s2, agg) for s1 in args.s1 for s2 in args.s2 for agg in args.a]
+    dbs = {config: ([], []) for config in configs}
+    for fam in fams:
+        cache = load_cache(f'{args.c}/fams/{fam}.npz')
+        for s1, s2, agg in configs:
+            key = dct_key(layer, s1, s2, agg)
+            if key in cache:
+                dbs[(s1, s2, agg)][0].append(fam)
+                dbs[(s1, s2, agg)][1].append(cache[key])
+
+    queries = load_cache(f'{args.c}/queries.npz')
+    table = []
+    for s1, s2, agg in configs:
+        key = dct_key(layer, s1, s2)
+        valid = queries[f'valid_{key}']
+        db_fams, db = dbs[(s1, s2, agg)]
+        if not db_fams or not valid.any():
+            continue
+        counts = search_config((db_fams, np.stack(db)), queries[key][valid],
+                               [fam for fam, val in zip(query_fams, valid) if val],
+                               args.t, fam_clans)
+        table.append({'layer': layer, 's1': s1, 's2': s2, 'agg': agg, **counts,
+                      'acc': counts['match'] / counts['total']})
+
+    return table
+
+
+def run_sweep(args: argparse.Namespace) -> list:
+    """Returns the search results of every configuration in a sweep, embedding and caching any
+    DCTs that are not already cached.
+
+    :param args: argparse.Namespace object with sweep parameters
+    :return: list of dicts with configuration and results
+    """
+
+    queries = read_queries(args.q)
+    fams = sorted(os.listdir('data/families_gaps'))
+    os.makedirs(f'{args.c}/fams', exist_ok=True)
+
+    # Embed queries and families once for every layer, loading encoder only if needed
+    fam_cached = all(not missing_layers(cached_keys(f'{args.c}/fams/{fam}.npz'), args, args.a)
+                     for fam in fams)
+    query_cached = (same_queries(f'{args.c}/queries.npz', queries) and
+                    not missing_layers(cached_keys(f'{args.c}/queries.npz'), args, ['']))
+    if not (fam_cached and query_cached):
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        tokenizer, model = load_model('esm2', device)
+        models = (tokenizer, model, device)
+        cache_queries(queries, models, args)
+        for i, fam in enumerate(fams):
+            cache_fam(fam, models, args)
+            logging.info('Cached %s, %s', fam, i)
+        del models, model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    # Search every configuration, one layer per process
+    fam_clans = load_clans(args.cl) if args.cl else {}
+    func = partial(eval_layer, fams=fams, query_fams=[query[0] for query in queries],
+                   fam_clans=fam_clans, args=args)
+    table = []
+    for layer, results in map_fams(func, args.l, args.p, chunk=1):
+        for res in results:
+            logging.info('Layer %s, %sx%s, %s: Queries: %s, Matches: %s, Top%s: %s, Clan: %s',
+                         layer, res['s1'], res['s2'], res['agg'], res['total'], res['match'],
+                         args.t, res['top'], res['clan'])
+        table.extend(results)
+
+    return table
+
+
+def main():
+    """Main runs a sweep and writes its results table to a tsv file.
+
+    args:
+        -a: aggregations of family DCTs (cons, mean)
+        -b: number of sequences embedded at once
+        -c: directory to cache DCTs in
+        -cl: file from parse_clans.py (empty string to skip clan results)
+        -l: layers of ESM2
+        -o: tsv file to write results to
+        -p: number of processes
+        -q: query manifest from make_queries.py
+        -s1: first dimensions of dct
+        -s2: second dimensions of dct
+        -t: number of results to consider for top n
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', type=str, nargs='+', default=['cons', 'mean'],
+                        choices=['cons', 'mean'])
+    parser.add_argument('-b', type=int, default=8)
+    parser.add_argument('-c', type=str, default='data/sweep')
+    parser.add_argument('-cl', type=str, default='data/clans.npz')
+    parser.add_argument('-l', type=int, nargs='+', default=[17, 25])
+    parser.add_argument('-o', type=str, default='data/sweep.tsv')
+    parser.add_argument('-p', type=int, default=1)
+    parser.add_argument('-q', type=str, default='data/queries.fa')
+    parser.add_argument('-s1', type=int, nargs='+', default=[3, 4, 5, 6, 7, 8])
+    parser.add_argument('-s2', type=int, nargs='+', default=[20, 30, 40, 50, 60, 70, 80])
+    parser.add_argument('-t', type=int, default=100)
+    args = parser.parse_args()
+
+    table = run_sweep(args)
+    cols = ['layer', 's1', 's2', 'agg', 'total', 'match', 'top', 'clan', 'clan_top', 'acc']
+    with open(args.o, 'w', encoding='utf8') as file:
+        file.write('\t'.join(cols) + '\n')
+        for res in table:
+            file.write('\t'.join(str(res[col]) for col in cols) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""This script defines timers and counters for measuring each stage of the search pipeline (loading
+sequences, tokenizing, the encoder's forward pass, DCT, searching, and evaluating results). Stages
+are timed with a context manager and every call is kept so the summary can report percentiles
+instead of only an average. Timing is off until enable() is called, so scripts that do not ask
+for it only check a flag.
+
+__author__ = "Ben Iovino"
+__date__ = "09/21/23"
+"""
+
+import cProfile
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+STATE = {'enabled': False}
+TIMES = defaultdict(list)  # stage name -> list of times in seconds
+COUNTS = Counter()  # counter name -> total
+
+
+def enable(enabled: bool = True):
+    """Turns timing on or off.
+
+    :param enabled: True to time stages and count events
+    """
+
+    STATE['enabled'] = enabled
+
+
+def reset():
+    """Removes all times and counts.
+    """
+
+    TIMES.clear()
+    COUNTS.clear()
+
+
+@contextmanager
+def stage(name: str):
+    """Times the code run inside a with block and adds it to the stage's times.
+
+    :param name: name of stage
+    """
+
+    if not STATE['enabled']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        TIMES[name].append(time.perf_counter() - start)
+
+
+def count(name: str, num: int = 1):
+    """Adds to a counter, e.g. the number of candidates scored by a search.
+
+    :param name: name of counter
+    :param num: number to add
+    """
+
+    if STATE['enabled']:
+        COUNTS[name] += num
+
+
+def mark() -> dict:
+    """Returns the number of times kept for each stage so far, to be passed to since().
+
+    :return: dict where key is stage name and value is number of times
+    """
+
+    return {name: len(times) for name, times in TIMES.items()}
+
+
+def since(marks: dict) -> dict:
+    """Returns the total time of each stage timed after mark() was called, e.g. the time of each
+    stage for one query.
+
+    :param marks: dict returned by mark()
+    :return: dict where key is stage name and value is time in seconds
+    """
+
+    return {name: sum(times[marks.get(name, 0):]) for name, times in TIMES.items()
+            if len(times) > marks.get(name, 0)}
+
+
+def summary() -> dict:
+    """Returns the number of calls, total time, and latency percentiles of each stage along
+    with the total of each counter.
+
+    :return: dict with stages and counters
+    """
+
+    stages = {}
+    for name, times in TIMES.items():
+        times = np.array(times)
+        p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+        stages[name] = {'calls': len(times), 'total_s': times.sum(),
+                        'mean_ms': times.mean() * 1000, 'p50_ms': p50, 'p95_ms': p95,
+                        'p99_ms': p99}
+
+    return {'stages': stages, 'counts': dict(COUNTS)}
+
+
+def report() -> str:
+    """Returns a table of the summary of each stage and counter.
+
+    :return: summary as a string
+    """
+
+    stats = summary()
+    lines = [f"{'stage':<16}{'calls':>8}{'total s':>10}{'mean ms':>10}"
+             f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+    for name, stg in stats['stages'].items():
+        lines.append(f"{name:<16}{stg['calls']:>8}{stg['total_s']:>10.2f}{stg['mean_ms']:>10.2f}"
+                     f"{stg['p50_ms']:>10.2f}{stg['p95_ms']:>10.2f}{stg['p99_ms']:>10.2f}")
+    for name, total in stats['counts'].items():
+        lines.append(f'{name}: {total}')
+
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profile(file: str):
+    """Runs cProfile on the code run inside a with block and saves the stats to a file, which can
+    be read with pstats or snakeviz. Nothing is profiled if file is empty, so the block can also be
+    sampled from outside by py-spy without cProfile's overhead.
+
+    :param file: file to save stats to (empty string to not profile)
+    """
+
+    if not file:
+        yield
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(file)
@@ -11,7 +11,10 @@ import torch
 import numpy as np
 from scipy.fft import dct, idct
 from transformers import T5EncoderModel, T5Tokenizer
-from scipy.spatial.distance import cityblock
+from scipy.spatial.distance import cdist, cityblock
+from timing import stage
+
+DB_CACHE = {'db': None}  # Last database searched by Transform.search and its stacked DCTs
 
 
 def load_model(encoder: str, device: str) -> tuple:
@@ -39,6 +42,114 @@ def load_model(encoder: str, device: str) -> tuple:
     return tokenizer, model
 
 
+def get_fams(results: dict) -> list:
+    """Returns a list of family names from a dictionary of search results:
+
+    :param results: dict where key is family name and value is similarity score
+    :return: list of family names
+    """
+
+    result_fams = []
+    for name in results.keys():
+        if '_cluster' in name:
+            result_fams.append('_'.join(name.split('_')[:-1]))
+        else:
+            result_fams.append(name)
+
+    return result_fams
+
+
+def fam_rows(names: list) -> tuple:
+    """Returns the families in a database, in the order of their first row, and the family of
+    each row. Clusters of a family (family_cluster#) are rows of the same family.
+
+    :param names: name of each row in the database
+    :return: tuple of list of families and array of family index of each row
+    """
+
+    row_fams = [get_fams({name: None})[0] for name in names]
+    fams = list(dict.fromkeys(row_fams))
+    index = {fam: i for i, fam in enumerate(fams)}
+
+    return fams, np.array([index[fam] for fam in row_fams], dtype=np.int64)
+
+
+def max_fams(sims: np.ndarray, row_fams: np.ndarray, fams: list, top: int) -> dict:
+    """Returns the top families by their most similar row, so families with many clusters do not
+    take up more than one of the top results.
+
+    :param sims: similarity of query to each row (or a subset of rows)
+    :param row_fams: family index of each row in sims
+    :param fams: list of families
+    :param top: number of results to return
+    :return: dict where keys are family names and values are similarity scores
+    """
+
+    best = np.full(len(fams), -np.inf)
+    np.maximum.at(best, row_fams, sims)
+    order = np.argsort(-best, kind='stable')[:top]
+
+    return {fams[i]: best[i] for i in order if best[i] > -np.inf}
+
+
+def embed_batch(seqs: list, tokenizer, model, device: str, encoder: str, layer: int) -> list:
+    """Returns a list of Embedding objects for a batch of sequences. ESM2 embeds the whole batch
+    in one forward pass, ProtT5 embeds each sequence individually.
+
+    :param seqs: list of tuples containing protein ID and sequence
+    :param tokenizer: tokenizer
+    :param model: encoder model
+    :param device: gpu/cpu
+    :param encoder: prott5 or esm2
+    :param layer: layer to extract features from (if using esm2)
+    :return: list of Embedding objects
+    """
+
+    embeds = [Embedding(seqid, seq, None) for seqid, seq in seqs]
+    if encoder != 'esm2':
+        for embed in embeds:
+            embed.embed_seq(tokenizer, model, device, encoder, layer)
+        return embeds
+
+    # Embed sequences
+    with stage('tokenize'):
+        _, _, batch_tokens = tokenizer([(seqid, seq.upper()) for seqid, seq in seqs])
+        batch_tokens = batch_tokens.to(device)  # send tokens to gpu
+    with stage('forward'), torch.no_grad():
+        results = model(batch_tokens, repr_layers=[layer])
+        batch = results["representations"][layer].cpu().numpy()
+
+    # Remove padding but keep start/end tokens, same as embedding each sequence individually
+    for embed, emb, (_, seq) in zip(embeds, batch, seqs):
+        embed.seq[1] = seq.upper()
+        embed.embed[1] = emb[:len(seq)+2]
+
+    return embeds
+
+
+def embed_layers(seqs: list, tokenizer, model, device: str, layers: list) -> list:
+    """Returns the embeddings of a batch of sequences from several layers of ESM2, all from one
+    forward pass.
+
+    :param seqs: list of tuples containing protein ID and sequence
+    :param tokenizer: tokenizer
+    :param model: ESM2 model
+    :param device: gpu/cpu
+    :param layers: layers to extract features from
+    :return: list of dicts where key is layer and value is embedding (with start/end tokens)
+    """
+
+    with stage('tokenize'):
+        _, _, batch_tokens = tokenizer([(seqid, seq.upper()) for seqid, seq in seqs])
+        batch_tokens = batch_tokens.to(device)  # send tokens to gpu
+    with stage('forward'), torch.no_grad():
+        results = model(batch_tokens, repr_layers=layers)
+        reps = {layer: results["representations"][layer].cpu().numpy() for layer in layers}
+
+    return [{layer: reps[layer][i][:len(seq)+2] for layer in layers}
+            for i, (_, seq) in enumerate(seqs)]
+
+
 class Embedding:
     """This class stores embeddings for a single protein sequence.
     """
@@ -78,15 +189,16 @@ class Embedding:
         """
 
         # Tokenize, encode, and load sequence
-        self.clean_seq()
-        ids = tokenizer.batch_encode_plus(self.seq[1], add_special_tokens=True, padding=True)
-        input_ids = torch.tensor(ids['input_ids']).to(device)  # pylint: disable=E1101
-        attention_mask = torch.tensor(ids['attention_mask']).to(device)  # pylint: disable=E1101
+        with stage('tokenize'):
+            self.clean_seq()
+            ids = tokenizer.batch_encode_plus(self.seq[1], add_special_tokens=True, padding=True)
+            input_ids = torch.tensor(ids['input_ids']).to(device)  # pylint: disable=E1101
+            attention_mask = torch.tensor(ids['attention_mask']).to(device)  # pylint: disable=E1101
 
         # Extract sequence features
-        with torch.no_grad():
+        with stage('forward'), torch.no_grad():
             embedding = model(input_ids=input_ids,attention_mask=attention_mask)
-        embedding = embedding.last_hidden_state.cpu().numpy()  # pylint: disable=E1101
+            embedding = embedding.last_hidden_state.cpu().numpy()  # pylint: disable=E1101
 
         # Remove padding and special tokens
         features = []
@@ -109,13 +221,14 @@ class Embedding:
         """
 
         # Embed sequences
-        self.seq[1] = self.seq[1].upper()  # tok does not convert to uppercase
-        _, _, batch_tokens = tokenizer([self.seq])
-        batch_tokens = batch_tokens.to(device)  # send tokens to gpu
+        with stage('tokenize'):
+            self.seq[1] = self.seq[1].upper()  # tok does not convert to uppercase
+            _, _, batch_tokens = tokenizer([self.seq])
+            batch_tokens = batch_tokens.to(device)  # send tokens to gpu
 
-        with torch.no_grad():
+        with stage('forward'), torch.no_grad():
             results = model(batch_tokens, repr_layers=[layer])
-        embed = results["representations"][layer].cpu().numpy()
+            embed = results["representations"][layer].cpu().numpy()
         self.embed[1] = embed[0]
 
 
@@ -251,20 +364,21 @@ class Transform:
 
 
     def search(self, search_db: np.ndarray, top: int) -> dict:
-        """Searches transform against a database of transforms:
+        """Searches transform against a database of transforms. Databases with more than one row
+        per family (family_cluster#) are scored by the most similar row of each family.
 
         :param database: array of transforms
         :param top: number of results to return
         :return: dict where keys are family names and values are similarity scores
         """
 
-        # Search query against every dct embedding
-        sims = {}
-        for transform in search_db:
-            fam, db_dct = transform[0], transform[1]  # family name, dct vector for family
-            sims[fam] = 1-cityblock(db_dct, self.trans[1]) # compare query to dct
+        # Stack database once, it is searched by every query
+        if DB_CACHE['db'] is not search_db:
+            fams, row_fams = fam_rows([transform[0] for transform in search_db])
+            DB_CACHE.update(db=search_db, fams=fams, rows=row_fams,
+                            dcts=np.stack([transform[1] for transform in search_db]).astype(float))
 
-        # Return first n results
-        sims = dict(sorted(sims.items(), key=lambda item: item[1], reverse=True)[0:top])
+        # Compare query to every dct and keep most similar row of each family
+        sims = 1 - cdist(self.trans[1][None].astype(float), DB_CACHE['dcts'], 'cityblock')[0]
 
-        return sims
+        return max_fams(sims, DB_CACHE['rows'], DB_CACHE['fams'], top)